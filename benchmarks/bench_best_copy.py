@@ -0,0 +1,73 @@
+"""
+Measures what best-copy selection costs: forwarding latency added by the hold window and CPU time per transmission with
+many windows open at once.
+
+Latency runs gateways2miners.py once per window size with the load generator of bench_engine_latency.py, the p50
+latency of window 0 is the forwarding path itself so the difference is the added latency (window plus timer tick).
+
+    python3 benchmarks/bench_best_copy.py --windows 0 5 20 50 --rate 200 --duration 5
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_engine_latency import run_engine, percentile
+from src.best_copy import BestCopySelector
+
+
+def bench_selector(transmissions, gateways, in_flight):
+    """
+    :param transmissions: number of transmissions
+    :param gateways: copies of each transmission
+    :param in_flight: windows open at any time
+    :return: seconds per transmission for hold, copies and flush
+    """
+    sim_ts = [0.0]
+    step = 0.001
+    selector = BestCopySelector(window=in_flight * step, clock=lambda: sim_ts[0])
+    rxpks = [dict(rssi=-120 + i, lsnr=0.0) for i in range(gateways)]
+    macs = [f"GW{i}" for i in range(gateways)]
+    start = time.perf_counter()
+    for key in range(transmissions):
+        sim_ts[0] += step
+        selector.hold(key, rxpks[0], macs[0])
+        for i in range(1, gateways):
+            selector.add_copy(key, rxpks[i], macs[i])
+        selector.flush_due()
+    return (time.perf_counter() - start) / transmissions
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark best-copy hold window")
+    parser.add_argument('-w', '--windows', help='hold windows in ms', nargs='+', default=[0, 5, 20, 50], type=float)
+    parser.add_argument('-m', '--miners', help='number of stub miners', default=3, type=int)
+    parser.add_argument('-r', '--rate', help='PUSH_DATA per second from load generator', default=200, type=float)
+    parser.add_argument('-t', '--duration', help='seconds of load per window', default=5, type=float)
+    parser.add_argument('-e', '--engine', help='event loop engine', default='blocking', choices=['blocking', 'asyncio'])
+    parser.add_argument('--in-flight', help='open windows for selector CPU benchmark', nargs='+', default=[10, 1000, 10000], type=int)
+    args = parser.parse_args()
+
+    print(f"{'in flight':>10} {'us/transmission (3 copies)':>27}")
+    for in_flight in args.in_flight:
+        print(f"{in_flight:>10} {bench_selector(100000, 3, in_flight) * 1e6:>27.2f}")
+    print()
+
+    print(f"{'window ms':>10} {'delivered':>12} {'p50 ms':>8} {'p99 ms':>8} {'added p50 ms':>13}")
+    base = None
+    for window in args.windows:
+        run_args = argparse.Namespace(miners=args.miners, rate=args.rate, duration=args.duration,
+                                      middleman_args=f"--best-copy-window {window}")
+        latencies, expected, datagrams = run_engine(args.engine, run_args)
+        p50 = percentile(latencies, 50)
+        if base is None:
+            base = p50
+        print(f"{window:>10.1f} {len(latencies):>6}/{expected:<6}{p50 * 1e3:>8.3f} {percentile(latencies, 99) * 1e3:>8.3f} "
+              f"{(p50 - base) * 1e3:>13.3f}")
+
+
+if __name__ == '__main__':
+    main()
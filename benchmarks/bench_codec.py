@@ -0,0 +1,75 @@
+"""
+Decode / encode throughput of src/messages.py per message type and JSON backend.
+
+dup/s is decode plus de-duplication key of every rxpk, i.e. the cost of a duplicate PUSH_DATA.
+
+    python3 benchmarks/bench_codec.py
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import messages
+from src.dedup import rxpk_key
+
+
+def fixtures():
+    rxpk = dict(tmst=3512348611, time='2020-10-10T12:00:00.000000Z', chan=2, rfch=0, freq=904.3, stat=1,
+                modu='LORA', datr='SF9BW125', codr='4/5', lsnr=2.5, rssi=-95, size=52, data='A' * 72)
+    txpk = dict(imme=False, tmst=3513348611, freq=927.5, rfch=0, powe=27, modu='LORA', datr='SF10BW500',
+                codr='4/5', ipol=True, size=32, data='B' * 44)
+    return [
+        dict(_NAME_=messages.MsgPushData.NAME, identifier=messages.MsgPushData.IDENT, ver=2, token=0x1234,
+             MAC='AA:55:5A:00:00:00:00:01', data=dict(rxpk=[rxpk])),
+        dict(_NAME_=messages.MsgPushData.NAME, identifier=messages.MsgPushData.IDENT, ver=2, token=0x1234,
+             MAC='AA:55:5A:00:00:00:00:01', data=dict(rxpk=[rxpk] * 8)),
+        dict(_NAME_=messages.MsgPullData.NAME, identifier=messages.MsgPullData.IDENT, ver=2, token=0x1234,
+             MAC='AA:55:5A:00:00:00:00:01'),
+        dict(_NAME_=messages.MsgPullResp.NAME, identifier=messages.MsgPullResp.IDENT, ver=2, token=0x1234,
+             data=dict(txpk=txpk)),
+        dict(_NAME_=messages.MsgTxAck.NAME, identifier=messages.MsgTxAck.IDENT, ver=2, token=0x1234,
+             MAC='AA:55:5A:00:00:00:00:01', data=dict(txpk_ack=dict(error='NONE'))),
+        dict(_NAME_=messages.MsgPushAck.NAME, identifier=messages.MsgPushAck.IDENT, ver=2, token=0x1234),
+    ]
+
+
+def dedup_keys(raw):
+    msg = messages.decode_message(raw, return_ack=True)[0]
+    return [rxpk_key(rxpk) for rxpk in msg.get('data', {}).get('rxpk', [])]
+
+
+def ops_per_sec(func, arg, min_time=0.3):
+    n = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(100):
+            func(arg)
+        n += 100
+        elapsed = time.perf_counter() - start
+        if elapsed > min_time:
+            return n / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark Semtech protocol codec")
+    parser.add_argument('-b', '--backends', help='JSON backends to test', nargs='+',
+                        default=['json', 'orjson'] if messages.orjson else ['json'])
+    args = parser.parse_args()
+
+    print(f"{'backend':>8} {'message':>12} {'bytes':>6} {'decode/s':>10} {'dup/s':>10} {'encode/s':>10}")
+    for backend in args.backends:
+        messages.use_json_backend(backend)
+        for msg in fixtures():
+            raw = messages.encode_message(msg)
+            name = msg['_NAME_'] + (f"x{len(msg['data']['rxpk'])}" if 'rxpk' in msg.get('data', {}) else '')
+            decode = ops_per_sec(lambda r: messages.decode_message(r, return_ack=True), raw)
+            dup = ops_per_sec(dedup_keys, raw)
+            encode = ops_per_sec(messages.encode_message, msg)
+            print(f"{backend:>8} {name:>12} {len(raw):>6} {decode:>10.0f} {dup:>10.0f} {encode:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Feeds synthetic packet keys through the de-duplication cache and reports throughput and process memory.
+Each transmission is heard by several gateways so most lookups are repeats, same as a real multi-gateway site.
+Memory should stay flat once the ttl window / entry cap is reached.
+
+    python3 benchmarks/bench_dedup.py -n 10000000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.dedup import DedupCache
+
+
+def rss_kb():
+    """
+    :return: resident set size of this process in kB (0 if unavailable)
+    """
+    try:
+        with open('/proc/self/status', 'r') as fd:
+            for line in fd:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark rxpk de-duplication cache")
+    parser.add_argument('-n', '--packets', help='number of synthetic packets', default=10_000_000, type=int)
+    parser.add_argument('-r', '--rate', help='simulated packets per second', default=200, type=float)
+    parser.add_argument('-g', '--gateways', help='copies of each transmission (gateways hearing it)', default=3, type=int)
+    parser.add_argument('--ttl', help='cache ttl in seconds', default=60, type=float)
+    parser.add_argument('--max', help='cache max entries', default=100000, type=int)
+    parser.add_argument('--samples', help='number of memory samples to print', default=10, type=int)
+    args = parser.parse_args()
+
+    sim_ts = [0.0]
+    cache = DedupCache(ttl=args.ttl, max_entries=args.max, clock=lambda: sim_ts[0])
+    step = 1 / args.rate
+    sample_every = max(1, args.packets // args.samples)
+
+    print(f"{'packets':>12} {'cache size':>10} {'rss kB':>10} {'pkts/s':>12}")
+    start = time.perf_counter()
+    last = start
+    for i in range(args.packets):
+        sim_ts[0] += step
+        key = ('SF9BW125', '4/5', '904.1', 52, i // args.gateways)
+        if key not in cache:
+            cache[key] = sim_ts[0]
+        if (i + 1) % sample_every == 0:
+            now = time.perf_counter()
+            print(f"{i + 1:>12} {len(cache):>10} {rss_kb():>10} {sample_every / (now - last):>12.0f}")
+            last = now
+    elapsed = time.perf_counter() - start
+    print(f"total: {args.packets} packets in {elapsed:.1f}s ({args.packets / elapsed:.0f} pkts/s)")
+    print(f"cache stats: {cache.stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Measures forwarding latency of gateways2miners.py, time from a gateway PUSH_DATA being sent to the PUSH_DATA arriving
+at each miner, for each event loop engine.
+
+A middleman process is started per engine listening on localhost.  Stub miners are UDP sockets on localhost, a load
+generator acting as a gateway sends PUSH_DATA with a unique sequence number in each payload.
+
+    python3 benchmarks/bench_engine_latency.py --miners 6 --rate 500 --duration 10
+
+extra middleman arguments can be given to compare options, e.g. batching:
+
+    python3 benchmarks/bench_engine_latency.py --middleman-args="--batch-window 10"
+"""
+
+import argparse
+import base64
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from src import messages
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_configs(directory, miner_ports):
+    for i, port in enumerate(miner_ports):
+        config = dict(gateway_conf=dict(
+            gateway_ID=f"AA555A{i:010X}",
+            server_address='127.0.0.1',
+            serv_port_up=port,
+            serv_port_down=port
+        ))
+        with open(os.path.join(directory, f"miner{i}.json"), 'w') as fd:
+            json.dump(config, fd)
+
+
+def make_push(seq):
+    payload = struct.pack('<Q', seq) + bytes(44)
+    rxpk = dict(
+        tmst=seq & 0xFFFFFFFF, chan=0, rfch=0, freq=904.1, stat=1, modu='LORA', datr='SF9BW125', codr='4/5',
+        lsnr=5.5, rssi=-80, size=len(payload), data=base64.b64encode(payload).decode()
+    )
+    return messages.encode_message(dict(
+        _NAME_=messages.MsgPushData.NAME, identifier=messages.MsgPushData.IDENT, ver=2, token=seq & 0xFFFF,
+        MAC='AA:55:5A:FF:FF:FF:FF:FF', data=dict(rxpk=[rxpk])
+    ))
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_engine(engine, args):
+    miners = []
+    for _ in range(args.miners):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(0.5)
+        miners.append(sock)
+
+    sent_ts = dict()
+    latencies = []
+    datagrams = [0]
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def miner_rx(sock):
+        while not stop.is_set():
+            try:
+                data, addr = sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            rx_ts = time.perf_counter()
+            try:
+                msg = messages.decode_message(data)
+            except ValueError:
+                continue
+            if msg['_NAME_'] != messages.MsgPushData.NAME or 'rxpk' not in msg['data']:
+                continue
+            with lock:
+                datagrams[0] += 1
+            for rxpk in msg['data']['rxpk']:
+                seq = struct.unpack_from('<Q', base64.b64decode(rxpk['data']))[0]
+                with lock:
+                    if seq in sent_ts:
+                        latencies.append(rx_ts - sent_ts[seq])
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_configs(tmpdir, [m.getsockname()[1] for m in miners])
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'gateways2miners.py'), '-p', str(port), '-c', tmpdir, '-e', engine] + args.middleman_args.split(),
+            cwd=tmpdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        threads = [threading.Thread(target=miner_rx, args=(m,), daemon=True) for m in miners]
+        for t in threads:
+            t.start()
+        try:
+            time.sleep(1.5)  # let middleman start
+            gw = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            interval = 1 / args.rate
+            next_ts = time.perf_counter()
+            end_ts = next_ts + args.duration
+            seq = 0
+            while time.perf_counter() < end_ts:
+                data = make_push(seq)
+                with lock:
+                    sent_ts[seq] = time.perf_counter()
+                gw.sendto(data, ('127.0.0.1', port))
+                seq += 1
+                next_ts += interval
+                delay = next_ts - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            time.sleep(1)
+            gw.close()
+        finally:
+            stop.set()
+            proc.terminate()
+            proc.wait()
+            for t in threads:
+                t.join()
+            for m in miners:
+                m.close()
+    expected = seq * args.miners
+    return latencies, expected, datagrams[0]
+
+
+def main():
+    parser = argparse.ArgumentParser("compare forwarding latency of blocking and asyncio engines")
+    parser.add_argument('-m', '--miners', help='number of stub miners', default=6, type=int)
+    parser.add_argument('-r', '--rate', help='PUSH_DATA per second from load generator', default=500, type=float)
+    parser.add_argument('-t', '--duration', help='seconds of load per engine', default=10, type=float)
+    parser.add_argument('-e', '--engines', help='engines to compare', nargs='+', default=['blocking', 'asyncio'])
+    parser.add_argument('-x', '--middleman-args', help='extra arguments for gateways2miners.py', default='')
+    args = parser.parse_args()
+
+    print(f"{'engine':>10} {'delivered':>12} {'datagrams':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for engine in args.engines:
+        latencies, expected, datagrams = run_engine(engine, args)
+        print(f"{engine:>10} {len(latencies):>6}/{expected:<6}{datagrams:>10} "
+              f"{percentile(latencies, 50) * 1e3:>8.3f} {percentile(latencies, 99) * 1e3:>8.3f} "
+              f"{(max(latencies) if latencies else float('nan')) * 1e3:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
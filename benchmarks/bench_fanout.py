@@ -0,0 +1,75 @@
+"""
+Compares CPU cost of fanning out one PUSH_DATA to many virtual gateways.
+
+  deepcopy:  copy.deepcopy(msg) + VirtualGateway.get_rxpks (full encode per miner), the original path
+  template:  shared fields serialized once, per miner metadata spliced in (VirtualGateway.get_rxpks_from_templates)
+
+    python3 benchmarks/bench_fanout.py --miners 1 10 100
+"""
+
+import argparse
+import base64
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import messages
+from src.vgateway import VirtualGateway
+
+
+def make_msg(n_rxpk):
+    rxpks = []
+    for i in range(n_rxpk):
+        rxpks.append(dict(
+            tmst=3512348611 + i, chan=2, rfch=0, freq=904.3, stat=1, modu='LORA', datr='SF9BW125', codr='4/5',
+            lsnr=2.5, rssi=-95, size=52, data=base64.b64encode(bytes([i]) * 52).decode()
+        ))
+    return dict(
+        _NAME_=messages.MsgPushData.NAME, identifier=messages.MsgPushData.IDENT, ver=2, token=1234,
+        MAC='AA:55:5A:FF:FF:FF:FF:FF', data=dict(rxpk=rxpks)
+    )
+
+
+def fanout_deepcopy(vgws, msg):
+    for vgw in vgws:
+        vgw.get_rxpks(copy.deepcopy(msg))
+
+
+def fanout_template(vgws, msg):
+    rxpks = msg['data']['rxpk']
+    templates = [messages.rxpk_template(rx) for rx in rxpks]
+    for vgw in vgws:
+        vgw.get_rxpks_from_templates(rxpks, templates, src_mac=msg['MAC'])
+
+
+def timeit(func, vgws, msg, min_time=0.5):
+    n = 0
+    start = time.perf_counter()
+    while True:
+        func(vgws, msg)
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > min_time:
+            return elapsed / n
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark PUSH_DATA fan-out to virtual gateways")
+    parser.add_argument('-m', '--miners', help='miner counts to test', nargs='+', type=int, default=[1, 2, 5, 10, 20, 50, 100])
+    parser.add_argument('-r', '--rxpks', help='rxpks per PUSH_DATA', default=1, type=int)
+    args = parser.parse_args()
+
+    msg = make_msg(args.rxpks)
+    print(f"{'miners':>6} {'deepcopy us':>12} {'template us':>12} {'speedup':>8}")
+    for n in args.miners:
+        vgws = [VirtualGateway(mac=f"AA:55:5A:00:00:00:{i >> 8:02X}:{i & 0xFF:02X}", server_address='127.0.0.1',
+                               port_up=1680, port_dn=1680) for i in range(n)]
+        t_old = timeit(fanout_deepcopy, vgws, msg)
+        t_new = timeit(fanout_template, vgws, msg)
+        print(f"{n:>6} {t_old * 1e6:>12.1f} {t_new * 1e6:>12.1f} {t_old / t_new:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
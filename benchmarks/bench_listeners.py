@@ -0,0 +1,208 @@
+"""
+Compares memory and CPU of N gateway fleets served by one process with --listeners versus N separate processes.
+
+Each fleet gets its own port and miners (local sink sockets counting datagrams).  After all listeners answer a PULL_DATA,
+idle memory is read from /proc (PSS counts pages shared between processes once, RSS counts them in every process), then
+the same synthetic traffic (tools/replay.py) is sent to every fleet at --rate datagrams/s and the CPU time used by the
+forwarding processes is read from /proc/<pid>/stat.  Linux only.
+
+    python3 benchmarks/bench_listeners.py --fleets 10 --packets 1000 --rate 200
+"""
+
+import argparse
+import json
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from src import messages
+from tools.replay import synthetic_records
+
+BASE_PORT = 41680
+
+
+class Sinks:
+    def __init__(self, count):
+        """
+        UDP sockets standing in for miners, a thread counts what they receive
+        :param count: number of sockets
+        """
+        self.selector = selectors.DefaultSelector()
+        self.socks = []
+        for _ in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+            self.socks.append(sock)
+        self.received = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            for key, _ in self.selector.select(0.1):
+                while True:
+                    try:
+                        key.fileobj.recv(4096)
+                    except BlockingIOError:
+                        break
+                    self.received += 1
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        for sock in self.socks:
+            sock.close()
+
+
+def write_fleets(tmpdir, fleets, miners, sinks):
+    """
+    :return: list of (port, config directory) per fleet
+    """
+    result = []
+    for fleet in range(fleets):
+        directory = os.path.join(tmpdir, f"fleet{fleet}")
+        os.mkdir(directory)
+        for miner in range(miners):
+            port = sinks.socks[fleet * miners + miner].getsockname()[1]
+            with open(os.path.join(directory, f"miner{miner}.json"), 'w') as fd:
+                json.dump(dict(gateway_conf=dict(gateway_ID=f"AA555A{fleet:04X}{miner:06X}", server_address='127.0.0.1',
+                                                 serv_port_up=port, serv_port_down=port)), fd)
+        result.append((BASE_PORT + fleet, directory))
+    return result
+
+
+def start(mode, fleets, tmpdir):
+    """
+    :return: list of Popen
+    """
+    common = [sys.executable, os.path.join(ROOT, 'gateways2miners.py'), '--log-file', os.path.join(tmpdir, 'log'),
+              '--stat', '3600', '--dns-ttl', '0']
+    if mode == 'listeners':
+        path = os.path.join(tmpdir, 'listeners.json')
+        with open(path, 'w') as fd:
+            json.dump(dict(listeners=[dict(name=str(i), port=port, configs=directory)
+                                      for i, (port, directory) in enumerate(fleets)]), fd)
+        commands = [common + ['--listeners', path]]
+    else:
+        commands = [common + ['-p', str(port), '-c', directory] for port, directory in fleets]
+    return [subprocess.Popen(command, cwd=tmpdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            for command in commands]
+
+
+def wait_ready(fleets, timeout=30):
+    pull = messages.encode_message(dict(_NAME_=messages.MsgPullData.NAME, identifier=messages.MsgPullData.IDENT,
+                                        ver=2, token=1, MAC='AA:55:5A:FF:00:00:00:01'))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.1)
+    deadline = time.monotonic() + timeout
+    try:
+        for port, _ in fleets:
+            while True:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"listener on port {port} did not answer")
+                sock.sendto(pull, ('127.0.0.1', port))
+                try:
+                    sock.recvfrom(64)
+                    break
+                except socket.timeout:
+                    continue
+    finally:
+        sock.close()
+
+
+def memory_kb(pid):
+    """
+    :return: tuple of (PSS, RSS) in kB, PSS equals RSS where smaps_rollup is not available
+    """
+    values = dict()
+    for path in (f"/proc/{pid}/smaps_rollup", f"/proc/{pid}/status"):
+        try:
+            with open(path) as fd:
+                for line in fd:
+                    name, _, rest = line.partition(':')
+                    if name in ('Pss', 'Rss', 'VmRSS') and name not in values:
+                        values[name] = int(rest.split()[0])
+        except OSError:
+            continue
+    rss = values.get('Rss', values.get('VmRSS', 0))
+    return values.get('Pss', rss), rss
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as fd:
+        fields = fd.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def send_traffic(fleets, records, rate):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    interval = 1 / rate
+    start_ts = time.perf_counter()
+    for i, (_, data, _) in enumerate(records):
+        delay = start_ts + i * interval - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        for port, _ in fleets:
+            sock.sendto(data, ('127.0.0.1', port))
+    sock.close()
+
+
+def run(mode, args, records):
+    sinks = Sinks(args.fleets * args.miners)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fleets = write_fleets(tmpdir, args.fleets, args.miners, sinks)
+        start_ts = time.perf_counter()
+        procs = start(mode, fleets, tmpdir)
+        try:
+            wait_ready(fleets)
+            startup = time.perf_counter() - start_ts
+            idle = [memory_kb(proc.pid) for proc in procs]
+            cpu_before = sum(cpu_seconds(proc.pid) for proc in procs)
+            received_before = sinks.received
+            send_traffic(fleets, records, args.rate)
+            time.sleep(1)
+            cpu = sum(cpu_seconds(proc.pid) for proc in procs) - cpu_before
+            loaded = [memory_kb(proc.pid) for proc in procs]
+            received = sinks.received - received_before
+        finally:
+            for proc in procs:
+                proc.terminate()
+            for proc in procs:
+                proc.wait()
+            sinks.close()
+    return dict(processes=len(procs), startup=startup, idle_pss=sum(pss for pss, rss in idle) / 1024,
+                idle_rss=sum(rss for pss, rss in idle) / 1024, loaded_pss=sum(pss for pss, rss in loaded) / 1024,
+                cpu=cpu, received=received)
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark several fleets in one process against one process per fleet")
+    parser.add_argument('-f', '--fleets', help='number of fleets', default=10, type=int)
+    parser.add_argument('-m', '--miners', help='miners per fleet', default=4, type=int)
+    parser.add_argument('-g', '--gateways', help='gateways hearing each transmission', default=3, type=int)
+    parser.add_argument('-p', '--packets', help='synthetic transmissions sent to every fleet', default=1000, type=int)
+    parser.add_argument('-r', '--rate', help='datagrams per second sent to every fleet', default=200, type=float)
+    args = parser.parse_args()
+
+    records = [record for record in synthetic_records(args.packets, args.gateways)]
+    print(f"{args.fleets} fleets x {args.miners} miners, {len(records)} datagrams per fleet at {args.rate:g}/s")
+    print(f"{'mode':<10} {'procs':>5} {'startup s':>9} {'idle PSS MB':>11} {'idle RSS MB':>11} {'loaded PSS MB':>13} "
+          f"{'CPU s':>6} {'forwarded':>9}")
+    for mode in ('listeners', 'processes'):
+        result = run(mode, args, records)
+        print(f"{mode:<10} {result['processes']:>5} {result['startup']:>9.2f} {result['idle_pss']:>11.1f} "
+              f"{result['idle_rss']:>11.1f} {result['loaded_pss']:>13.1f} {result['cpu']:>6.2f} {result['received']:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Measures packet loop throughput with logging at info and debug level, writing the log through:
+
+  sync:      file and console handlers called on the packet loop (how logging was configured before src/logpipe.py)
+  pipeline:  LogPipeline, records queued and written by a background thread, 20 messages/s per call site
+
+Synthetic traffic (tools/replay.py) is handled in-process with sends replaced by no-ops.  The log file is written to a
+temporary directory and the console goes to /dev/null.  --disk-latency adds a sleep to every log file write to
+simulate a slow SD card.  Also measured is the cost of a per-packet debug call with debug off, eagerly formatted as an
+f-string versus with lazy % arguments.
+
+    python3 benchmarks/bench_logging.py --packets 3000 --disk-latency 0.5
+"""
+
+import argparse
+import logging
+import logging.handlers
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from gateways2miners import GW2Miner
+from src.logpipe import DATE_FORMAT, LOG_FORMAT, LogPipeline
+from tools.replay import synthetic_records, write_configs
+
+
+class SlowFileHandler(logging.FileHandler):
+    def __init__(self, path, latency):
+        super().__init__(path)
+        self.latency = latency
+
+    def emit(self, record):
+        super().emit(record)
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def make_handlers(tmpdir, devnull, level, latency):
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
+    handlers = [SlowFileHandler(os.path.join(tmpdir, 'middleman.log'), latency), logging.StreamHandler(devnull)]
+    for handler in handlers:
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def run(records, miners, mode, level, latency, devnull):
+    """
+    :return: tuple of (seconds to handle records, seconds until everything is written)
+    """
+    root = logging.getLogger()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gw2miner = GW2Miner(0, write_configs(tmpdir, [30000 + i for i in range(miners)]))
+        gw2miner.sendto = lambda data, addr: None
+        gw2miner.outbound.sendto = lambda data, addr: None
+        handlers = make_handlers(tmpdir, devnull, level, latency)
+        pipeline = None
+        if mode == 'sync':
+            root.setLevel(level)
+            for handler in handlers:
+                root.addHandler(handler)
+        else:
+            pipeline = LogPipeline(handlers, level=level).start()
+        start = time.perf_counter()
+        for ts, data, addr in records:
+            msg, addr = gw2miner.decode_datagram(data, addr)
+            if msg:
+                gw2miner.handle_message(msg, addr)
+        elapsed = time.perf_counter() - start
+        if pipeline:
+            pipeline.stop()
+        else:
+            for handler in handlers:
+                root.removeHandler(handler)
+                handler.close()
+        drained = time.perf_counter() - start
+        gw2miner.sock.close()
+    return elapsed, drained
+
+
+def disabled_call_costs(n=200000):
+    """
+    :return: tuple of (seconds per eager f-string debug call, seconds per lazy debug call) with debug off
+    """
+    logger = logging.getLogger('VMiner')
+    logging.getLogger().setLevel(logging.INFO)
+    rxpk = dict(size=52, rssi=-101.0, lsnr=7.5)
+    key = 0x1234567890ABCDEF
+    start = time.perf_counter()
+    for _ in range(n):
+        logger.debug(f"new packet [{rxpk.get('size')}B, {rxpk.get('rssi')}dBm]: {key:016X}")
+    eager = (time.perf_counter() - start) / n
+    start = time.perf_counter()
+    for _ in range(n):
+        logger.debug("new packet [%sB, %sdBm]: %016X", rxpk.get('size'), rxpk.get('rssi'), key)
+    lazy = (time.perf_counter() - start) / n
+    return eager, lazy
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark logging on the packet path")
+    parser.add_argument('-p', '--packets', help='synthetic transmissions', default=3000, type=int)
+    parser.add_argument('-g', '--gateways', help='gateways hearing each transmission', default=3, type=int)
+    parser.add_argument('-m', '--miners', help='number of miners', default=4, type=int)
+    parser.add_argument('--disk-latency', help='ms added to every log file write', default=0, type=float)
+    parser.add_argument('--repeat', help='runs of each variant', default=3, type=int)
+    args = parser.parse_args()
+
+    # keeps logging.info() on the root logger from calling basicConfig between runs
+    logging.getLogger().addHandler(logging.NullHandler())
+    records = synthetic_records(args.packets, args.gateways)
+    variants = [(mode, level) for mode in ('sync', 'pipeline') for level in (logging.INFO, logging.DEBUG)]
+    best = {variant: (float('inf'), 0) for variant in variants}
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(args.repeat):
+            for variant in variants:
+                best[variant] = min(best[variant], run(records, args.miners, *variant, args.disk_latency / 1000,
+                                                       devnull))
+    eager, lazy = disabled_call_costs()
+    print(f"{len(records)} datagrams, {args.miners} miners, {args.disk_latency:g}ms per log write; debug call with "
+          f"debug off: f-string {eager * 1e6:.2f} us, lazy {lazy * 1e6:.2f} us")
+    print(f"{'handlers':<9} {'level':<6} {'us/datagram':>12} {'datagrams/s':>12} {'drained s':>10}")
+    for (mode, level), (elapsed, drained) in best.items():
+        print(f"{mode:<9} {logging.getLevelName(level):<6} {elapsed / len(records) * 1e6:>12.2f} "
+              f"{len(records) / elapsed:>12.0f} {drained:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
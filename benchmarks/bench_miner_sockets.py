@@ -0,0 +1,150 @@
+"""
+Compares sending to miners from the shared listening socket (sendto per datagram) with connected sockets per virtual
+gateway (--miner-sockets, send on a connect()ed socket).
+
+  raw:      one 250 byte datagram to every miner, only the socket calls
+  fan-out:  GW2Miner.forward_rxpks of one rxpk to every miner (metadata, encode, miner queues and send)
+
+Miners are UDP sockets in a separate process that reads and counts everything it receives.
+
+    python3 benchmarks/bench_miner_sockets.py --miners 100
+"""
+
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import selectors
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import gateways2miners
+from src.options import Options
+
+
+def run_sinks(conn, count):
+    selector = selectors.DefaultSelector()
+    ports = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.bind(('127.0.0.1', 0))
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        ports.append(sock.getsockname()[1])
+    selector.register(conn, selectors.EVENT_READ)
+    conn.send(ports)
+    received = 0
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is conn:
+                conn.recv()
+                conn.send(received)
+                received = 0
+                continue
+            while True:
+                try:
+                    key.fileobj.recv(4096)
+                except BlockingIOError:
+                    break
+                received += 1
+
+
+def timeit(func, min_time):
+    n = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > min_time:
+            return elapsed / n, n
+
+
+def write_configs(directory, ports):
+    paths = []
+    for i, port in enumerate(ports):
+        path = os.path.join(directory, f"miner{i}.json")
+        with open(path, 'w') as fd:
+            json.dump(dict(gateway_conf=dict(gateway_ID=f"AA555A{i:010X}", server_address='127.0.0.1',
+                                             serv_port_up=port, serv_port_down=port)), fd)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark sending to miners from the listening socket versus connected sockets")
+    parser.add_argument('-m', '--miners', help='number of miners', default=100, type=int)
+    parser.add_argument('-t', '--time', help='seconds per measurement', default=2, type=float)
+    args = parser.parse_args()
+
+    conn, child_conn = multiprocessing.Pipe()
+    sinks = multiprocessing.Process(target=run_sinks, args=(child_conn, args.miners), daemon=True)
+    sinks.start()
+    ports = conn.recv()
+    addrs = [('127.0.0.1', port) for port in ports]
+
+    def received():
+        time.sleep(0.2)
+        conn.send('count')
+        return conn.recv()
+
+    data = os.urandom(250)
+    listening = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listening.bind(('127.0.0.1', 0))
+    connected = []
+    for addr in addrs:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(addr)
+        connected.append(sock)
+
+    def raw_sendto():
+        sendto = listening.sendto
+        for addr in addrs:
+            sendto(data, addr)
+
+    def raw_send():
+        for sock in connected:
+            sock.send(data)
+
+    print(f"{args.miners} miners, datagrams per second sent (and received by miners)")
+    print(f"{'test':<8} {'sendto':>18} {'connected':>18} {'speedup':>8}")
+    results = []
+    for func in (raw_sendto, raw_send):
+        per_call, calls = timeit(func, args.time)
+        results.append((args.miners / per_call, received() / (calls * args.miners)))
+    print(f"{'raw':<8} {results[0][0]:>10.0f} ({results[0][1]:>4.0%}) {results[1][0]:>10.0f} ({results[1][1]:>4.0%}) "
+          f"{results[1][0] / results[0][0]:>7.2f}x")
+    listening.close()
+    for sock in connected:
+        sock.close()
+
+    rxpk = dict(tmst=3512348611, chan=2, rfch=0, freq=904.3, stat=1, modu='LORA', datr='SF9BW125', codr='4/5',
+                lsnr=2.5, rssi=-95, size=24, data=base64.b64encode(bytes(24)).decode())
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = write_configs(tmpdir, ports)
+        for miner_sockets in (False, True):
+            gw2miner = gateways2miners.GW2Miner(0, paths, options=Options(miner_sockets=miner_sockets))
+
+            def fan_out():
+                gw2miner.forward_rxpks([rxpk], src_mac='AA:55:5A:FF:FF:FF:FF:FF')
+                gw2miner.service_queues()
+            per_call, calls = timeit(fan_out, args.time)
+            while gw2miner.outbound.active:
+                gw2miner.outbound.drain()
+            results.append((args.miners / per_call, received() / (calls * args.miners)))
+            gw2miner.sock.close()
+            if gw2miner.miner_sockets:
+                gw2miner.miner_sockets.close()
+    print(f"{'fan-out':<8} {results[0][0]:>10.0f} ({results[0][1]:>4.0%}) {results[1][0]:>10.0f} ({results[1][1]:>4.0%}) "
+          f"{results[1][0] / results[0][0]:>7.2f}x")
+    sinks.terminate()
+
+
+if __name__ == '__main__':
+    main()
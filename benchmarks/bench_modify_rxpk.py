@@ -0,0 +1,76 @@
+"""
+Compares CPU cost per rxpk of modifying metadata for many virtual gateways.
+
+  single:  RXMetadataModification.modify_metadata per rxpk per virtual gateway, the original path
+  python:  modify_rxpk.modify_rxpks batch with pure Python jitter (random.choices)
+  numpy:   modify_rxpk.modify_rxpks batch with NumPy jitter and clipping (if installed)
+
+    python3 benchmarks/bench_modify_rxpk.py --miners 1 10 100 --rxpks 1
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import modify_rxpk
+from src.modify_rxpk import RXMetadataModification, modify_rxpks
+
+SRC_MAC = 'AA:55:5A:00:00:00:00:00'
+
+
+def make_rxpks(n_rxpk):
+    return [dict(
+        tmst=3512348611 + i, time='2020-10-10T12:00:00.000000Z', chan=2, rfch=0, freq=904.3, stat=1, modu='LORA',
+        datr='SF9BW125', codr='4/5', lsnr=2.5, rssi=-95, size=52, data='A' * 72
+    ) for i in range(n_rxpk)]
+
+
+def modify_single(rxpks, modifiers):
+    for dest_mac, modifier in modifiers:
+        for rx in rxpks:
+            modifier.modify_metadata(rx, src_mac=SRC_MAC, dest_mac=dest_mac)
+
+
+def modify_batch(rxpks, modifiers):
+    modify_rxpks(rxpks, SRC_MAC, modifiers)
+
+
+def timeit(func, rxpks, modifiers, min_time=0.5):
+    n = 0
+    start = time.perf_counter()
+    while True:
+        func(rxpks, modifiers)
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > min_time:
+            return elapsed / n / len(rxpks)
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark rxpk metadata modification for many virtual gateways")
+    parser.add_argument('-m', '--miners', help='miner counts to test', nargs='+', type=int, default=[1, 2, 5, 10, 20, 50, 100])
+    parser.add_argument('-r', '--rxpks', help='rxpks per PUSH_DATA', default=1, type=int)
+    args = parser.parse_args()
+
+    numpy = modify_rxpk.numpy
+    rxpks = make_rxpks(args.rxpks)
+    print(f"{'miners':>6} {'single us':>10} {'python us':>10} {'numpy us':>10}   (per rxpk)")
+    for n in args.miners:
+        modifiers = [(SRC_MAC if i == 0 else f"AA:55:5A:00:00:00:{i >> 8:02X}:{i & 0xFF:02X}", RXMetadataModification())
+                     for i in range(n)]
+        t_single = timeit(modify_single, rxpks, modifiers)
+        modify_rxpk.numpy = None
+        t_python = timeit(modify_batch, rxpks, modifiers)
+        modify_rxpk.numpy = numpy
+        t_numpy = float('nan')
+        if numpy is not None:
+            threshold, modify_rxpk.NUMPY_MIN_BATCH = modify_rxpk.NUMPY_MIN_BATCH, 0
+            t_numpy = timeit(modify_batch, rxpks, modifiers)
+            modify_rxpk.NUMPY_MIN_BATCH = threshold
+        print(f"{n:>6} {t_single * 1e6:>10.1f} {t_python * 1e6:>10.1f} {t_numpy * 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Measures the overhead of --profile: CPU time to handle synthetic traffic (tools/replay.py) in-process with stage timing
+off and with several sample rates.  Sends are replaced by no-ops so only forwarding work is compared.  Runs of the
+variants are interleaved and the fastest of each is used.
+
+End to end differences of a few percent are within run to run noise on a busy machine, so the overhead of each sample
+rate is also estimated from its parts: commit() of an unsampled datagram, swapping wrappers in and out, and the extra
+time of a fully timed datagram (sample rate 1).
+
+    python3 benchmarks/bench_profile.py --packets 3000 --rates 0.01 0.05 1 --repeat 7
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from gateways2miners import GW2Miner
+from src.metrics import StageTimer
+from tools.replay import synthetic_records, write_configs
+
+
+def run(records, sample_rate, miners):
+    """
+    :param sample_rate: None for no stage timing
+    :return: seconds to handle records
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gw2miner = GW2Miner(0, write_configs(tmpdir, [30000 + i for i in range(miners)]))
+    gw2miner.sendto = lambda data, addr: None
+    gw2miner.outbound.sendto = lambda data, addr: None
+    timer = None
+    if sample_rate is not None:
+        timer = StageTimer(sample_rate=sample_rate)
+        gw2miner.enable_stage_timing(timer)
+    start = time.process_time()
+    for ts, data, addr in records:
+        msg, addr = gw2miner.decode_datagram(data, addr)
+        if msg:
+            gw2miner.handle_message(msg, addr)
+        if timer:
+            timer.commit()
+    elapsed = time.process_time() - start
+    gw2miner.sock.close()
+    return elapsed
+
+
+def part_costs(miners, n=100000):
+    """
+    :return: tuple of (seconds per unsampled commit, seconds to swap wrappers in or out once)
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gw2miner = GW2Miner(0, write_configs(tmpdir, [30000 + i for i in range(miners)]))
+    timer = StageTimer(sample_rate=0.0)
+    gw2miner.enable_stage_timing(timer)
+    timer.commit()
+    start = time.perf_counter()
+    for _ in range(n):
+        timer.commit()
+    commit = (time.perf_counter() - start) / n
+    start = time.perf_counter()
+    for i in range(n // 10):
+        timer._install(i % 2 == 0)
+    swap = (time.perf_counter() - start) / (n // 10)
+    gw2miner.sock.close()
+    return commit, swap
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark profiling overhead")
+    parser.add_argument('-p', '--packets', help='synthetic transmissions', default=3000, type=int)
+    parser.add_argument('-g', '--gateways', help='gateways hearing each transmission', default=3, type=int)
+    parser.add_argument('-m', '--miners', help='number of miners', default=4, type=int)
+    parser.add_argument('-r', '--rates', help='sample rates to test', nargs='+', default=[0.01, 0.05, 1.0], type=float)
+    parser.add_argument('--repeat', help='runs of each variant', default=7, type=int)
+    args = parser.parse_args()
+
+    records = synthetic_records(args.packets, args.gateways)
+    variants = [None] + args.rates
+    best = {variant: float('inf') for variant in variants}
+    for _ in range(args.repeat):
+        for variant in variants:
+            best[variant] = min(best[variant], run(records, variant, args.miners))
+    base = best[None] / len(records)
+    full = max(best.get(1.0, base) / len(records) - base, 0)
+    commit, swap = part_costs(args.miners)
+    print(f"{len(records)} datagrams, {args.miners} miners; unsampled commit {commit * 1e6:.3f} us, "
+          f"wrapper swap {swap * 1e6:.2f} us, timed datagram +{full * 1e6:.2f} us")
+    print(f"{'profile':>8} {'us/datagram':>12} {'measured':>9} {'estimated':>10}")
+    for variant in variants:
+        name = 'off' if variant is None else f"{variant:g}"
+        estimate = 0.0
+        if variant is not None:
+            # a sampled datagram swaps wrappers in and (unless the next is sampled too) out again
+            estimate = (commit + variant * full + 2 * variant * (1 - variant) * swap) / base
+        print(f"{name:>8} {best[variant] / len(records) * 1e6:>12.2f} {best[variant] / best[None] - 1:>9.1%} "
+              f"{estimate:>10.1%}")
+
+
+if __name__ == '__main__':
+    main()
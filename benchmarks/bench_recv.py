@@ -0,0 +1,165 @@
+"""
+Compares the receive path before and after preallocated buffers under burst load.
+
+A sender fills the listening socket with bursts of PUSH_DATA (1 to 8 rxpks each, as an 8 channel gateway reports them)
+and each receive strategy reads them back:
+
+    recvfrom   previous GW2Miner.get_message: settimeout + recvfrom(1024) per datagram, one datagram per loop wakeup
+    pooled     BatchReceiver: one select per wakeup then recvfrom_into preallocated buffers until the socket is empty
+
+Socket calls are counted per packet (settimeout is one ioctl, recvfrom with a timeout is a poll plus the recvfrom, select
+and recvfrom_into are one syscall each).  Allocations are the tracemalloc blocks still alive after receiving a burst
+while the results are kept, i.e. what each packet costs the allocator before decoding.
+
+    python3 benchmarks/bench_recv.py --burst 32 --rounds 500
+"""
+
+import argparse
+import base64
+import os
+import random
+import select
+import socket
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import messages
+from src.receiver import BatchReceiver, set_receive_buffer
+
+# syscalls made by each socket method as called by the strategies below
+SYSCALLS = dict(settimeout=1, recvfrom=2, recvfrom_into=1, select=1)
+
+
+class CountingSocket:
+    def __init__(self, sock):
+        """
+        :param sock: socket whose method calls are counted
+        """
+        self.sock = sock
+        self.calls = Counter()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def settimeout(self, timeout):
+        self.calls['settimeout'] += 1
+        self.sock.settimeout(timeout)
+
+    def recvfrom(self, size):
+        self.calls['recvfrom'] += 1
+        return self.sock.recvfrom(size)
+
+    def recvfrom_into(self, buffer):
+        self.calls['recvfrom_into'] += 1
+        return self.sock.recvfrom_into(buffer)
+
+    def syscalls(self):
+        return sum(count * SYSCALLS[name] for name, count in self.calls.items())
+
+
+def push_data(rng, rxpk_count):
+    rxpks = []
+    for _ in range(rxpk_count):
+        rxpks.append(dict(
+            tmst=rng.getrandbits(32), chan=rng.randint(0, 7), rfch=0, freq=904.1, stat=1, modu='LORA',
+            datr='SF9BW125', codr='4/5', lsnr=5.5, rssi=-100, size=52,
+            data=base64.b64encode(rng.getrandbits(8 * 52).to_bytes(52, 'little')).decode()
+        ))
+    return messages.encode_message(dict(
+        _NAME_=messages.MsgPushData.NAME, identifier=messages.MsgPushData.IDENT, ver=2, token=rng.getrandbits(16),
+        MAC='AA:55:5A:00:00:00:00:01', data=dict(rxpk=rxpks)))
+
+
+def receive_recvfrom(sock, counting, count):
+    # previous GW2Miner.get_message, called once per loop iteration
+    received = []
+    while len(received) < count:
+        counting.settimeout(1)
+        data, addr = counting.recvfrom(1024)
+        received.append((data, addr))
+    return received
+
+
+def receive_pooled(sock, counting, count, receiver):
+    received = []
+    while len(received) < count:
+        counting.calls['select'] += 1
+        select.select([sock], [], [], 1)
+        received.extend(receiver.receive())
+    return received
+
+
+def run(strategy, sock, sender, datagrams, rounds):
+    counting = CountingSocket(sock)
+    receiver = BatchReceiver(counting, count=max(64, len(datagrams)))
+    if strategy == 'pooled':
+        sock.setblocking(False)
+        receive = lambda: receive_pooled(sock, counting, len(datagrams), receiver)
+    else:
+        receive = lambda: receive_recvfrom(sock, counting, len(datagrams))
+    addr = sock.getsockname()
+
+    elapsed = 0.0
+    truncated = 0
+    for _ in range(rounds + 1):
+        for data in datagrams:
+            sender.sendto(data, addr)
+        if _ == rounds:
+            break
+        start = time.perf_counter()
+        received = receive()
+        elapsed += time.perf_counter() - start
+        truncated += sum(len(data) < len(sent) for (data, addr), sent in zip(received, datagrams))
+
+    # allocations while receiving the last burst, results kept alive
+    counting.calls.clear()
+    tracemalloc.start()
+    received = receive()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics('filename')
+    allocations = sum(stat.count for stat in stats)
+    allocated = sum(stat.size for stat in stats)
+    packets = len(received)
+    del received
+    return dict(
+        pkts_per_sec=rounds * len(datagrams) / elapsed,
+        syscalls=counting.syscalls() / packets,
+        allocations=allocations / packets,
+        allocated=allocated / packets,
+        truncated=truncated
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark receive path with and without preallocated buffers")
+    parser.add_argument('-b', '--burst', help='datagrams per burst', default=32, type=int)
+    parser.add_argument('-r', '--rounds', help='number of bursts', default=500, type=int)
+    parser.add_argument('--rcvbuf', help='SO_RCVBUF of receiving socket in bytes', default=1 << 21, type=int)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    datagrams = [push_data(rng, rng.randint(1, 8)) for _ in range(args.burst)]
+    sizes = sorted(len(data) for data in datagrams)
+    print(f"{args.burst} PUSH_DATA per burst, {sizes[0]}-{sizes[-1]} bytes, "
+          f"{sum(size > 1024 for size in sizes)} larger than 1024 bytes")
+    print(f"{'strategy':>10} {'pkts/s':>10} {'syscalls/pkt':>13} {'allocs/pkt':>11} {'bytes/pkt':>10} {'truncated':>10}")
+    for strategy in ('recvfrom', 'pooled'):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        set_receive_buffer(sock, args.rcvbuf)
+        sock.bind(('127.0.0.1', 0))
+        try:
+            result = run(strategy, sock, sender, datagrams, args.rounds)
+        finally:
+            sock.close()
+            sender.close()
+        print(f"{strategy:>10} {result['pkts_per_sec']:>10.0f} {result['syscalls']:>13.2f} "
+              f"{result['allocations']:>11.2f} {result['allocated']:>10.0f} {result['truncated']:>10}")
+
+
+if __name__ == '__main__':
+    main()
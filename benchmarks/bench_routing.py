@@ -0,0 +1,128 @@
+"""
+Measures finding the miners an rxpk is routed to with many miners and mixed routing rules.
+
+  scan:   every rule of every miner checked per rxpk, what a straightforward implementation would do
+  index:  RoutingIndex lookup (cached bitmask AND of per-field masks), first pass fills the cache
+
+and the full GW2Miner.forward_rxpks with and without rules, sending to a counting stub instead of a socket.  Miners get
+one of four rule sets in turn: everything, PoC only (SF8/SF9, 48-80 bytes), two specific source gateways, or channels
+0-3.
+
+    python3 benchmarks/bench_routing.py --miners 200 --rxpks 20000
+"""
+
+import argparse
+import base64
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from gateways2miners import GW2Miner
+from src.routing import RoutingIndex, parse_rules
+from src.vgateway import VirtualGateway
+
+GATEWAYS = [f"AA:55:5A:00:00:00:00:{i:02X}" for i in range(50)]
+DATRS = ['SF7BW125', 'SF8BW125', 'SF9BW125', 'SF10BW125']
+
+
+def rule_sets():
+    return [
+        None,
+        [dict(datr=['SF8BW125', 'SF9BW125'], size=[48, 80])],
+        [dict(gateways=[mac.replace(':', '') for mac in GATEWAYS[:2]])],
+        [dict(chan=[0, 1, 2, 3])],
+    ]
+
+
+def make_vgateways(n):
+    vgws = []
+    sets = rule_sets()
+    for i in range(n):
+        vgw = VirtualGateway(mac=f"AA:55:5A:00:00:01:{i >> 8:02X}:{i & 0xFF:02X}", server_address='127.0.0.1',
+                             port_up=20000 + i, port_dn=20000 + i)
+        rules = sets[i % len(sets)]
+        vgw.routing_rules = parse_rules(rules) if rules is not None else None
+        vgws.append(vgw)
+    return vgws
+
+
+def make_rxpks(n, seed=1):
+    rnd = random.Random(seed)
+    rxpks = []
+    for i in range(n):
+        size = rnd.choice([12, 24, 52, 64, 80, 100])
+        rxpks.append((dict(
+            tmst=3512348611 + i, chan=rnd.randrange(8), rfch=0, freq=904.3, stat=1, modu='LORA', datr=rnd.choice(DATRS),
+            codr='4/5', lsnr=2.5, rssi=-95, size=size, data=base64.b64encode(bytes([i & 0xFF]) * size).decode()
+        ), rnd.choice(GATEWAYS)))
+    return rxpks
+
+
+def scan(vgws, rxpk, src_mac):
+    targets = []
+    for vgw in vgws:
+        rules = vgw.routing_rules
+        if rules is None:
+            targets.append(vgw)
+            continue
+        for gateways, chans, datrs, size in rules:
+            if ((gateways is None or src_mac in gateways) and (chans is None or rxpk['chan'] in chans)
+                    and (datrs is None or rxpk['datr'] in datrs)
+                    and (size is None or size[0] <= rxpk['size'] <= size[1])):
+                targets.append(vgw)
+                break
+    return targets
+
+
+def bench_lookup(func, rxpks):
+    fanout = 0
+    start = time.perf_counter()
+    for rxpk, src_mac in rxpks:
+        fanout += len(func(rxpk, src_mac))
+    return (time.perf_counter() - start) / len(rxpks), fanout / len(rxpks)
+
+
+def bench_forward(vgws, rxpks, routed):
+    gw2miner = GW2Miner(0, [])
+    for vgw in vgws:
+        gw2miner.vgateways_by_mac[vgw.mac] = vgw
+    gw2miner.router = RoutingIndex(vgws) if routed else None
+    sent = [0]
+
+    def count(data, addr, mac=None):
+        sent[0] += 1
+    gw2miner.send_to_miner = count
+    start = time.perf_counter()
+    for rxpk, src_mac in rxpks:
+        gw2miner.forward_rxpks([rxpk], src_mac)
+    elapsed = time.perf_counter() - start
+    gw2miner.sock.close()
+    return elapsed / len(rxpks), sent[0] / len(rxpks)
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark rule-based routing")
+    parser.add_argument('-m', '--miners', help='number of miners', default=200, type=int)
+    parser.add_argument('-r', '--rxpks', help='rxpks to route', default=20000, type=int)
+    args = parser.parse_args()
+
+    vgws = make_vgateways(args.miners)
+    rxpks = make_rxpks(args.rxpks)
+    router = RoutingIndex(vgws)
+
+    print(f"{args.miners} miners, {len(rxpks)} rxpks from {len(GATEWAYS)} gateways")
+    print(f"{'path':<22} {'us/rxpk':>10} {'rxpks/s':>10} {'avg fan-out':>12}")
+    for name, result in (
+            ('rule scan', bench_lookup(lambda rxpk, src_mac: scan(vgws, rxpk, src_mac), rxpks)),
+            ('index, cold cache', bench_lookup(router.targets, rxpks)),
+            ('index, warm cache', bench_lookup(router.targets, rxpks)),
+            ('forward, no rules', bench_forward(vgws, rxpks, routed=False)),
+            ('forward, index', bench_forward(vgws, rxpks, routed=True))):
+        seconds, fanout = result
+        print(f"{name:<22} {seconds * 1e6:>10.2f} {1 / seconds:>10.0f} {fanout:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Compares the original tuple + md5 rxpk key with the compact 64 bit key from dedup.rxpk_key.
+Reports time to compute a key, time to look it up in a dict (tuple keys re-hash every lookup) and memory held per
+key in the de-duplication cache.
+
+    python3 benchmarks/bench_rxpk_key.py
+"""
+
+import argparse
+import base64
+import os
+import random
+import sys
+import time
+from hashlib import md5
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.dedup import rxpk_key
+
+
+def legacy_rxpk_key(rxpk):
+    hash = md5()
+    hash.update(rxpk['data'].encode())
+    return (
+        rxpk['datr'],
+        rxpk['codr'],
+        str(round(rxpk['freq'], 2)),
+        rxpk['size'],
+        rxpk['data'] if len(rxpk['data']) < 40 else hash.hexdigest()
+    )
+
+
+def make_rxpks(n, size):
+    rxpks = []
+    for _ in range(n):
+        rxpks.append(dict(
+            freq=random.choice([903.9, 904.1, 904.3, 904.5, 904.7, 904.9, 905.1, 905.3]),
+            datr=random.choice(['SF7BW125', 'SF8BW125', 'SF9BW125', 'SF10BW125']),
+            codr='4/5', size=size, data=base64.b64encode(os.urandom(size)).decode()
+        ))
+    return rxpks
+
+
+def deep_sizeof(key):
+    if isinstance(key, tuple):
+        return sys.getsizeof(key) + sum(sys.getsizeof(k) for k in key)
+    return sys.getsizeof(key)
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark rxpk de-duplication key")
+    parser.add_argument('-n', '--packets', help='number of rxpks per size', default=100000, type=int)
+    parser.add_argument('-s', '--sizes', help='payload sizes in bytes', nargs='+', type=int, default=[12, 24, 52, 120])
+    args = parser.parse_args()
+
+    print(f"{'':>5} {'key ns':>19} {'lookup ns':>19} {'bytes per key':>19}")
+    print(f"{'size':>5} {'legacy':>9} {'compact':>9} {'legacy':>9} {'compact':>9} {'legacy':>9} {'compact':>9}")
+    for size in args.sizes:
+        rxpks = make_rxpks(args.packets, size)
+        results = []
+        for func in (legacy_rxpk_key, rxpk_key):
+            start = time.perf_counter()
+            keys = [func(rx) for rx in rxpks]
+            key_ns = (time.perf_counter() - start) / len(rxpks) * 1e9
+            cache = dict.fromkeys(keys)
+            start = time.perf_counter()
+            for key in keys:
+                key in cache
+            lookup_ns = (time.perf_counter() - start) / len(keys) * 1e9
+            results.append((key_ns, lookup_ns, deep_sizeof(keys[0])))
+        (old_key, old_lookup, old_size), (new_key, new_lookup, new_size) = results
+        print(f"{size:>5} {old_key:>9.0f} {new_key:>9.0f} {old_lookup:>9.0f} {new_lookup:>9.0f} {old_size:>9} {new_size:>9}")
+
+
+if __name__ == '__main__':
+    main()
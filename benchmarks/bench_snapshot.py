@@ -0,0 +1,83 @@
+"""
+Measures the cost of state snapshots with a full de-duplication cache: time the packet loop is blocked copying state,
+longest gap of a select loop while a snapshot is written, time to write on the background thread, file size and time to
+load and restore on start.
+
+    python3 benchmarks/bench_snapshot.py --keys 10000 100000
+"""
+
+import argparse
+import os
+import random
+import select
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src.dedup import DedupCache
+from src.snapshot import StateSnapshot
+
+
+def make_cache(n, now):
+    rnd = random.Random(1)
+    cache = DedupCache(ttl=60, max_entries=n, clock=lambda: now)
+    for i in range(n):
+        cache.add(rnd.getrandbits(64), now - 60 + 60 * i / n)
+    return cache
+
+
+def max_loop_gap(snapshot, cache, gateways, offsets):
+    """
+    :return: longest time between iterations of a select loop (0.5ms timeout) while a snapshot is taken and written
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    last = time.perf_counter()
+    gap = 0
+    saved = False
+    while not saved or snapshot.thread.is_alive():
+        if not saved:
+            snapshot.save(cache, gateways, offsets)
+            saved = True
+        select.select([sock], [], [], 0.0005)
+        now = time.perf_counter()
+        gap = max(gap, now - last)
+        last = now
+    sock.close()
+    return gap
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark state snapshots")
+    parser.add_argument('-k', '--keys', help='dedup cache sizes to test', nargs='+', type=int, default=[10000, 100000])
+    parser.add_argument('-g', '--gateways', help='number of gateways', default=500, type=int)
+    args = parser.parse_args()
+
+    now = time.time()
+    gateways = {f"AA:55:5A:00:00:00:{i >> 8:02X}:{i & 0xFF:02X}": (f"10.0.{i >> 8}.{i & 0xFF}", 40000 + i)
+                for i in range(args.gateways)}
+    offsets = {mac: i for i, mac in enumerate(gateways)}
+    print(f"{'keys':>8} {'loop ms':>8} {'max gap ms':>11} {'write ms':>9} {'size kB':>8} {'load ms':>8} {'restore ms':>11}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'state.snap')
+        for n in args.keys:
+            cache = make_cache(n, now)
+            snapshot = StateSnapshot(path)
+            start = time.perf_counter()
+            snapshot.save(cache, gateways, offsets)
+            loop = time.perf_counter() - start
+            snapshot.thread.join()
+            gap = max_loop_gap(snapshot, cache, gateways, offsets)
+            start = time.perf_counter()
+            state = snapshot.load()
+            load = time.perf_counter() - start
+            start = time.perf_counter()
+            DedupCache(ttl=60, max_entries=n).restore(state.dedup)
+            restore = time.perf_counter() - start
+            print(f"{n:>8} {loop * 1e3:>8.2f} {gap * 1e3:>11.2f} {snapshot.last_duration * 1e3:>9.2f} {os.path.getsize(path) / 1e3:>8.0f} "
+                  f"{load * 1e3:>8.2f} {restore * 1e3:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,92 +1,347 @@
 
 import argparse
+import asyncio
+import copy
 import os
 import json
 import logging
+import multiprocessing as mp
 import time
+import select
+import signal
 import socket
-import copy
-from hashlib import md5
+import sys
+import warnings
 
 from src import messages
-from src.vgateway import VirtualGateway
+from src.vgateway import VirtualGateway, STAT_COUNTERS
+from src.dedup import DedupCache, rxpk_key
+from src import shard as sharding
+from src.batcher import PushDataBatcher
+from src.modify_rxpk import modify_rxpks
+from src.capture import CaptureWriter
+from src.metrics import MetricsServer, StageTimer
+from src.config_watch import ConfigWatcher, list_configs
+from src.resolver import Resolver
+from src.outbound import OutboundQueues
+from src.receiver import BatchReceiver, set_receive_buffer
+from src.best_copy import BestCopySelector
+from src.downlink import DownlinkScheduler
+from src.txack import TxAckTracker, lead_seconds, RESULT_SENT
+from src.listeners import ListenerGroup, load_listeners, open_listening_socket, from_sockaddr, to_sockaddr
+from src.routing import RoutingIndex, parse_rules
+from src.snapshot import StateSnapshot
+from src.profiling import Profiler, format_stage_report
+from src.logpipe import configure_pipeline
+from src.miner_sockets import MinerSockets
+from src.options import Options
 
 
 
 class GW2Miner:
-    def __init__(self, port, vminer_configs_paths, keepalive_interval=10, stat_interval=30, debug=True):
-
+    def __init__(self, port, vminer_configs_paths, keepalive_interval=None, stat_interval=None, debug=None, options=None,
+                 shard=None, resolver=None, host='0.0.0.0', name=None):
+        """
+        :param port: port to listen for gateways on
+        :param vminer_configs_paths: list of virtual gateway config paths
+        :param keepalive_interval: deprecated, use Options(keepalive_interval=...)
+        :param stat_interval: deprecated, use Options(stat_interval=...)
+        :param debug: deprecated and unused
+        :param options: Options with tuning and optional subsystems, defaults if None
+        :param shard: ShardRouter when running as one of multiple workers
+        :param resolver: Resolver for miner host names, a new one if None
+        :param host: address to listen on
+        :param name: listener name when running several listeners
+        """
+        options = options or Options()
+        if keepalive_interval is not None or stat_interval is not None or debug is not None:
+            warnings.warn("keepalive_interval, stat_interval and debug arguments of GW2Miner are deprecated, pass "
+                          "options=Options(keepalive_interval=..., stat_interval=...)",
+                          DeprecationWarning, stacklevel=2)
+            options = copy.copy(options)
+            if keepalive_interval is not None:
+                options.keepalive_interval = keepalive_interval
+            if stat_interval is not None:
+                options.stat_interval = stat_interval
+        self.options = options
 
-        self.vgw_logger = logging.getLogger('VGW')
-        self.vminer_logger = logging.getLogger('VMiner')
+        # listeners in one process log under their own child loggers, e.g. VGW.east
+        self.vgw_logger = logging.getLogger(f"VGW.{name}" if name else 'VGW')
+        self.vminer_logger = logging.getLogger(f"VMiner.{name}" if name else 'VMiner')
 
         # load virtual gateways configs
         # =============================
         self.vgateways_by_addr = dict()
         self.vgateways_by_mac = dict()
-        for path in vminer_configs_paths:
+        self.vgateway_paths = dict()  # keys = config path, values = MAC
+        self.timer = None  # StageTimer when per stage latency is measured
+        # bound per instance so stage timing of one listener does not wrap the module function for all of them
+        self.modify_rxpks = modify_rxpks
+        self.batcher = None
+        self.router = None  # RoutingIndex if any virtual gateway has routing rules
+        # resolves server_address of miners, see start_resolver
+        self.resolver = resolver or Resolver(ipv6=':' in host or options.miner_sockets)
+        # datagrams to each miner go through its own bounded queue so a slow miner cannot delay the others
+        self.outbound = OutboundQueues(self.send_nowait, max_len=options.miner_queue_size, rate=options.miner_rate,
+                                       burst=options.miner_burst, policy=options.drop_policy)
+        self.miner_sockets = None  # MinerSockets when each virtual gateway sends from its own connected socket
+        if options.miner_sockets:
+            self.miner_sockets = MinerSockets()
+            self.outbound.sendto = self.miner_sockets.sendto
+        self.load_vgateways(vminer_configs_paths)
+        self.config_watcher = options.config_watcher  # ConfigWatcher when configs are reloaded on change
+
+        # start listening socket
+        # =============================
+        # sends never wait for socket buffer space, datagrams to miners stay queued instead (see src/outbound.py)
+        self.sock = open_listening_socket(host, port, reuseport=shard is not None)
+        # IPv6 sockets are dual-stack, addresses are converted so the rest of GW2Miner only sees (ip, port)
+        self.ipv6 = self.sock.family == socket.AF_INET6
+        if options.rcvbuf:
+            logging.info(f"receive buffer {set_receive_buffer(self.sock, options.rcvbuf)} bytes (requested {options.rcvbuf})")
+        self.receiver = BatchReceiver(self.sock, count=options.recv_batch)
+        logging.info(f"listening on {f'[{host}]' if self.ipv6 else host}:{port}")
+
+        # setup other class variables
+        # =============================
+        self.rxpk_cache = DedupCache(ttl=options.dedup_ttl, max_entries=options.dedup_max_entries)
+        self.gw_listening_addrs = dict() # keys = MAC, values = (ip, port) tuple
+        self.keepalive_interval = options.keepalive_interval
+        self.stat_interval = options.stat_interval
+        self.last_stat_ts = 0
+        self.last_keepalive_ts = 0
+        self.shard = shard  # ShardRouter when running as one of multiple workers
+        if options.batch_window > 0:
+            self.batcher = PushDataBatcher(window=options.batch_window, max_size=options.batch_max_size)
+        self.capture = options.capture  # CaptureWriter recording received datagrams for replay
+        self.best_copy = None  # BestCopySelector when copies from all gateways are compared before forwarding
+        if options.best_copy_window > 0:
+            self.best_copy = BestCopySelector(window=options.best_copy_window, scorer=options.best_copy_scorer)
+        # DownlinkScheduler when PULL_RESP may be sent by any gateway that heard the device
+        self.downlink = DownlinkScheduler() if options.downlink_scheduler else None
+        self.tx_tracker = TxAckTracker()  # matches TX_ACK of gateways to forwarded PULL_RESP
+        self.snapshot = options.snapshot  # StateSnapshot when state is saved for warm restarts
+        self.profiler = options.profiler  # Profiler handling cProfile/tracemalloc signals in --profile mode
+        if self.snapshot:
+            self.restore_snapshot()
+
+        # counters for metrics endpoint
+        # =============================
+        self.gateway_datagrams_in = dict()  # keys = (gateway MAC, message name), values = count
+        self.gateway_datagrams_out = dict()  # keys = gateway MAC, values = count of acks and PULL_RESP sent
+        self.miner_datagrams_in = dict()  # keys = (vGW MAC, message name), values = count
+        self.decode_errors = 0
+        self.socket_errors = 0
+
+    def read_vgateway_config(self, path):
+        """
+        :param path: path of virtual gateway config
+        :return: tuple of (mac, server_address, port_up, port_dn, limits, routing) or None if config is invalid.  limits
+            is a tuple of optional (miner_queue_size, miner_rate_limit) overriding command line defaults for this miner,
+            routing is the list of parsed routing rules or None if the miner receives all packets
+        """
+        try:
             with open(path, 'r') as fd:
                 config = json.load(fd)
-                if 'gateway_conf' in config:
-                    config = config['gateway_conf']
+        except (OSError, ValueError) as e:
+            self.vgw_logger.error(f"could not read config file {path}: {e}")
+            return None
+        if 'gateway_conf' in config:
+            config = config['gateway_conf']
 
-                mac = ''
-                if 'gateway_ID' not in config or 'server_address' not in config:
-                    self.vgw_logger.error(f"invalid config file {path}, missing required parameters")
-                    continue
-                try:
-                    server_ip = socket.gethostbyname(config.get('server_address'))
-                except socket.gaierror:
-                    self.vgw_logger.error(f"invalid server_address \"{config.get('server_address')}\" in config {path}")
+        mac = ''
+        if 'gateway_ID' not in config or 'server_address' not in config:
+            self.vgw_logger.error(f"invalid config file {path}, missing required parameters")
+            return None
+        for i in range(0, len(config.get('gateway_ID')), 2):
+            mac += config.get('gateway_ID')[i:i+2] + ':'
+        mac = mac[:-1].upper()
+        limits = (config.get('miner_queue_size'), config.get('miner_rate_limit'))
+        routing = None
+        if 'routing' in config:
+            try:
+                routing = parse_rules(config['routing'])
+            except (KeyError, TypeError, ValueError) as e:
+                self.vgw_logger.error(f"invalid routing rules in config file {path}: {e}")
+                return None
+        return mac, config.get('server_address'), config.get('serv_port_up'), config.get('serv_port_down'), limits, routing
+
+    def load_vgateways(self, config_paths, wait=True, resolved=None):
+        """
+        create, update and remove virtual gateways to match configs.  Virtual gateways that still exist keep their state
+        (tmst offset, counters).  The new mappings replace the old ones in one step so a datagram is never handled with
+        half applied configs
+        :param config_paths: list of virtual gateway config paths
+        :param wait: if False host names that are not cached are resolved in the background and their configs are
+            applied later by apply_dns_changes, until then a virtual gateway of the same path keeps its old config
+        :param resolved: dictionary of host -> IP (None if lookup failed) from finished background lookups
+        :return: tuple of (added, removed, changed) counts
+        """
+        resolved = resolved or dict()
+        configs = [(path, self.read_vgateway_config(path)) for path in config_paths]
+        # host names are resolved concurrently (and cached) instead of one at a time
+        hosts = set(config[1] for path, config in configs if config)
+        server_ips = self.resolver.resolve_all(hosts - set(resolved), wait=wait)
+        server_ips.update(resolved)
+
+        vgateways_by_mac = dict()
+        vgateway_paths = dict()
+        added = changed = 0
+        for path, config in configs:
+            if config and config[1] not in server_ips:
+                self.vgw_logger.info(f"resolving server_address \"{config[1]}\" of config {path} in the background")
+                config = None
+            elif config and server_ips[config[1]] is None:
+                self.vgw_logger.error(f"invalid server_address \"{config[1]}\" in config {path}")
+                config = None
+            if config is None:
+                # keep virtual gateway of a config that became invalid, e.g. while it is being written
+                vgw = self.vgateways_by_mac.get(self.vgateway_paths.get(path))
+                if not vgw:
                     continue
-                for i in range(0, len(config.get('gateway_ID')), 2):
-                    mac += config.get('gateway_ID')[i:i+2] + ':'
-                mac = mac[:-1].upper()
+                queue = self.outbound.queue(vgw.mac)
+                config = (vgw.mac, vgw.server_host, vgw.port_up, vgw.port_dn, (queue.max_len, queue.rate),
+                          vgw.routing_rules)
+                server_ips[vgw.server_host] = vgw.server_address
+            mac, server_host, port_up, port_dn, (queue_size, rate_limit), routing_rules = config
+            server_ip = server_ips[server_host]
 
+            vgw = self.vgateways_by_mac.get(mac)
+            if vgw is None:
                 vgw = VirtualGateway(
                         mac=mac,
                         server_address=server_ip,
-                        port_dn=config.get('serv_port_down'),
-                        port_up=config.get('serv_port_up')
+                        port_dn=port_dn,
+                        port_up=port_up,
+                        server_host=server_host
                     )
-                self.vgateways_by_mac[mac] = vgw
+                if self.timer:
+                    self.instrument_vgateway(vgw)
+                added += 1
+                self.vgw_logger.info(f"added vgateway for miner at {server_ip} port: {port_up}(up)/{port_dn}(dn)")
+            elif (vgw.server_address, vgw.port_up, vgw.port_dn) != (server_ip, port_up, port_dn):
+                self.vgw_logger.info(f"changed vgateway {mac[-8:]} miner from {vgw.server_address} port: {vgw.port_up}(up)/{vgw.port_dn}(dn) to {server_ip} port: {port_up}(up)/{port_dn}(dn)")
+                vgw.server_address, vgw.port_up, vgw.port_dn = server_ip, port_up, port_dn
+                changed += 1
+            vgw.server_host = server_host
+            vgw.routing_rules = routing_rules
+            self.outbound.queue(
+                mac,
+                max_len=self.outbound.max_len if queue_size is None else queue_size,
+                rate=self.outbound.rate if rate_limit is None else rate_limit
+            )
+            vgateways_by_mac[mac] = vgw
+            vgateway_paths[path] = mac
 
-                self.vgateways_by_addr[(server_ip, config.get('serv_port_down'))] = vgw
-                self.vgateways_by_addr[(server_ip, config.get('serv_port_up'))] = vgw
-                self.vgw_logger.info(f"added vgateway for miner at {server_ip} port: {config.get('serv_port_up')}(up)/{config.get('serv_port_down')}(dn)")
-        # start listening socket
-        # =============================
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind(("0.0.0.0", port))
-        logging.info(f"listening on port {port}")
+        removed = 0
+        for mac, vgw in self.vgateways_by_mac.items():
+            if mac not in vgateways_by_mac:
+                self.vgw_logger.info(f"removed vgateway for miner at {vgw.server_address} port: {vgw.port_up}(up)/{vgw.port_dn}(dn)")
+                if self.batcher:
+                    self.batcher.discard(vgw)
+                self.outbound.remove(mac)
+                if self.timer:
+                    self.timer.discard(vgw)
+                removed += 1
+        router = None
+        if any(vgw.routing_rules is not None for vgw in vgateways_by_mac.values()):
+            router = RoutingIndex(list(vgateways_by_mac.values()))
+        self.vgateways_by_mac, self.vgateways_by_addr, self.vgateway_paths, self.router = \
+            vgateways_by_mac, self.index_by_addr(vgateways_by_mac), vgateway_paths, router
+        self.resolver.prune(vgw.server_host for vgw in vgateways_by_mac.values())
+        if self.miner_sockets:
+            self.miner_sockets.update(vgateways_by_mac)
+        return added, removed, changed
 
-        # setup other class variables
-        # =============================
-        self.rxpk_cache = dict()
-        self.gw_listening_addrs = dict() # keys = MAC, values = (ip, port) tuple
-        self.keepalive_interval = keepalive_interval
-        self.stat_interval = stat_interval
-        self.last_stat_ts = 0
-        self.last_keepalive_ts = 0
+    @staticmethod
+    def index_by_addr(vgateways_by_mac):
+        """
+        :param vgateways_by_mac: dictionary of MAC -> VirtualGateway
+        :return: dictionary of (ip, port) -> VirtualGateway for up and down ports of each miner
+        """
+        vgateways_by_addr = dict()
+        for vgw in vgateways_by_mac.values():
+            vgateways_by_addr[(vgw.server_address, vgw.port_dn)] = vgw
+            vgateways_by_addr[(vgw.server_address, vgw.port_up)] = vgw
+        return vgateways_by_addr
+
+    def restore_snapshot(self):
+        """
+        restore de-duplication keys, gateway addresses and tmst offsets saved before the last restart
+        :return:
+        """
+        start = time.perf_counter()
+        state = self.snapshot.load()
+        if state is None:
+            return
+        restored = self.rxpk_cache.restore(state.dedup)
+        for mac, addr in state.gateways.items():
+            self.gw_listening_addrs.setdefault(mac, addr)
+        offsets = 0
+        for mac, tmst_offset in state.offsets.items():
+            if mac in self.vgateways_by_mac:
+                self.vgateways_by_mac[mac].rxmodifier.tmst_offset = tmst_offset
+                offsets += 1
+        logging.info(f"restored snapshot from {time.time() - state.saved_ts:.0f}s ago in "
+                     f"{(time.perf_counter() - start) * 1e3:.1f}ms: {restored} of {len(state.dedup)} dedup keys, "
+                     f"{len(state.gateways)} gateways, {offsets} tmst offsets")
+
+    def save_snapshot(self, wait=False):
+        """
+        :param wait: write snapshot before returning instead of on a background thread
+        :return:
+        """
+        offsets = {vgw.mac: vgw.rxmodifier.tmst_offset for vgw in self.vgateways_by_mac.values()}
+        self.snapshot.save(self.rxpk_cache, self.gw_listening_addrs, offsets, wait=wait)
+
+    def apply_dns_changes(self):
+        """
+        point virtual gateways at new IPs of miner host names re-resolved in the background and apply reloaded configs
+        whose host names were resolved in the background
+        :return:
+        """
+        resolved = self.resolver.pop_resolved()
+        if resolved and self.config_watcher:
+            self.reload_configs(resolved)
+        changes = self.resolver.pop_changes()
+        if not changes:
+            return
+        for vgw in self.vgateways_by_mac.values():
+            if vgw.server_host in changes:
+                self.vgw_logger.info(f"vgateway {vgw.mac[-8:]} miner {vgw.server_host} moved from {vgw.server_address} to {changes[vgw.server_host]}")
+                vgw.server_address = changes[vgw.server_host]
+        self.vgateways_by_addr = self.index_by_addr(self.vgateways_by_mac)
+        if self.miner_sockets:
+            self.miner_sockets.update(self.vgateways_by_mac)
+
+    def check_configs(self):
+        """
+        reload virtual gateway configs if they changed
+        :return:
+        """
+        if not self.config_watcher or not self.config_watcher.poll():
+            return
+        self.reload_configs()
+
+    def reload_configs(self, resolved=None):
+        """
+        apply configs of the config watcher without waiting for DNS, new host names are resolved in the background
+        :param resolved: dictionary of host -> IP (None if lookup failed) from finished background lookups
+        :return:
+        """
+        start = time.perf_counter()
+        added, removed, changed = self.load_vgateways(self.config_watcher.config_paths(), wait=False, resolved=resolved)
+        self.vgw_logger.info(f"reloaded configs in {(time.perf_counter() - start) * 1e3:.1f}ms: {added} added, "
+                             f"{removed} removed, {changed} changed, {len(self.vgateways_by_mac)} vgateways")
 
     def __rxpk_key__(self, rxpk):
         """
         get key for rx payload that will be unique for each transmission but the same regardless of gateway that
         received.  spreading factor, coding rate, frequency, and data
         :param rxpk: dictionary of rxpk
-        :return:
+        :return: 64 bit int, see dedup.rxpk_key
         """
-        hash = md5()
-        hash.update(rxpk['data'].encode())
-        key = (
-            rxpk['datr'],
-            rxpk['codr'],
-            str(round(rxpk['freq'], 2)),
-            rxpk['size'],
-            rxpk['data'] if len(rxpk['data']) < 40 else hash.hexdigest()
-        )
-        return key
-
+        return rxpk_key(rxpk)
 
     def run(self):
         """
@@ -95,25 +350,291 @@ class GW2Miner:
         """
         start_ts = time.time()
         while True:
-            if time.time() - self.last_keepalive_ts > self.keepalive_interval:
-                self.send_keepalive()
-            if time.time() - self.last_stat_ts > self.stat_interval:
-                self.send_stats()
+            self.run_timers()
 
             # logging.debug(f"loop time: {time.time() - start_ts:.4f}")
 
-            msg, addr = self.get_message(timeout=5)
-
             start_ts = time.time()
-            if not msg:
-                continue
+            for msg, addr in self.get_messages(timeout=self.poll_timeout(5)):
+                self.handle_message(msg, addr)
+                if self.timer:
+                    self.timer.commit()
+            self.service_queues()
+            if self.timer:
+                self.timer.commit()
 
-            if msg['_NAME_'] == messages.MsgPushData.NAME:
-                self.handle_PUSH_DATA(msg, addr)
-            elif msg['_NAME_'] == messages.MsgPullResp.NAME:
-                self.handle_PULL_RESP(msg, addr)
-            elif msg['_NAME_'] == messages.MsgPullData.NAME:
-                self.handle_PULL_DATA(msg, addr)
+    def poll_timeout(self, timeout):
+        """
+        :param timeout: max seconds to wait for a datagram
+        :return: seconds to wait for a datagram before pending batches or queued datagrams must be sent
+        """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return timeout
+        return min(timeout, max(deadline - time.monotonic(), 0.0005))
+
+    def next_deadline(self):
+        """
+        :return: monotonic timestamp when service_queues must be called next or None if nothing is waiting
+        """
+        deadlines = [self.outbound.next_deadline()]
+        if self.batcher:
+            deadlines.append(self.batcher.next_deadline())
+        if self.best_copy:
+            deadlines.append(self.best_copy.next_deadline())
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def service_queues(self):
+        """
+        forward best copies and send batches whose window elapsed, then datagrams waiting in miner queues
+        :return:
+        """
+        if self.best_copy:
+            self.flush_best_copies()
+        if self.batcher:
+            self.flush_batches()
+        self.outbound.drain()
+
+    def flush_best_copies(self):
+        """
+        forward the best copy of each transmission whose hold window elapsed
+        :return:
+        """
+        by_gateway = dict()  # keys = MAC of gateway with best copy, values = (list of rxpks, list of arrival times)
+        for rxpk, src_mac, gateways, received in self.best_copy.flush_due():
+            self.vminer_logger.debug("best copy from GW:%s, heard by %d gateways", src_mac[-8:], gateways)
+            rxpks, arrivals = by_gateway.setdefault(src_mac, ([], []))
+            rxpks.append(rxpk)
+            arrivals.append(received)
+        for src_mac, (rxpks, arrivals) in by_gateway.items():
+            # metadata is computed for the time rxpks arrived, not the end of the hold window
+            self.forward_rxpks(rxpks, src_mac=src_mac, received=arrivals)
+
+    def flush_batches(self):
+        """
+        send batched PUSH_DATA whose aggregation window elapsed
+        :return:
+        """
+        for vgw, (data, addr) in self.batcher.flush_due_by_vgateway():
+            self.send_to_miner(data, addr, vgw.mac)
+
+    def enable_stage_timing(self, timer):
+        """
+        measure time per datagram spent in each stage of the forwarding path: receive (all datagrams of a wakeup,
+        counted with the first), decode (parse + ack), key (rxpk keys), dedup (cache), modify (metadata for all miners),
+        encode (PUSH_DATA for all miners) and send (all sendto calls)
+        :param timer: metrics.StageTimer
+        :return:
+        """
+        self.timer = timer
+        timer.wrap(self.receiver, 'receive', 'receive')
+        timer.wrap(self, 'decode_datagram', 'decode')
+        timer.wrap(self, '__rxpk_key__', 'key')
+        timer.wrap(self, 'handle_PUSH_DATA', 'dedup')
+        timer.wrap(self, 'modify_rxpks', 'modify')
+        timer.wrap(self, 'forward_rxpks', 'encode')
+        for vgw in self.vgateways_by_mac.values():
+            self.instrument_vgateway(vgw)
+        timer.wrap(self, 'sendto', 'send')
+        timer.wrap(self.outbound, 'sendto', 'send')
+
+    def instrument_vgateway(self, vgw):
+        self.timer.wrap(vgw, 'encode_rxpks', 'encode')
+        self.timer.wrap(vgw, 'get_PUSH_DATA_rxpks', 'encode')
+
+    def collect_metrics(self):
+        """
+        called from metrics server thread, only reads counters
+        :return: list of metric families for metrics.format_prometheus
+        """
+        cache = self.rxpk_cache.stats()
+        outbound = self.outbound.stats()
+        best_copy = self.best_copy.stats() if self.best_copy else dict(heard_by=dict())
+        downlink = self.downlink.stats() if self.downlink else dict()
+        snapshot = self.snapshot.stats() if self.snapshot else dict()
+        families = [
+            ('gw2m_gateway_datagrams_received_total', 'counter', 'datagrams received from gateways',
+             [(dict(gateway=mac, type=name), count) for (mac, name), count in list(self.gateway_datagrams_in.items())]),
+            ('gw2m_gateway_datagrams_sent_total', 'counter', 'acks and PULL_RESP sent to gateways',
+             [(dict(gateway=mac), count) for mac, count in list(self.gateway_datagrams_out.items())]),
+            ('gw2m_miner_datagrams_received_total', 'counter', 'datagrams received from miners',
+             [(dict(vgw=mac, type=name), count) for (mac, name), count in list(self.miner_datagrams_in.items())]),
+            ('gw2m_miner_datagrams_sent_total', 'counter', 'datagrams sent to miners',
+             [(dict(vgw=vgw.mac), vgw.datagrams_sent) for vgw in self.vgateways_by_mac.values()]),
+            ('gw2m_miner_rxpks_sent_total', 'counter', 'rxpks sent to miners',
+             [(dict(vgw=vgw.mac), vgw.rxpks_sent) for vgw in self.vgateways_by_mac.values()]),
+            ('gw2m_miner_queue_depth', 'gauge', 'datagrams waiting in miner outbound queue',
+             [(dict(vgw=mac), stats['depth']) for mac, stats in outbound.items()]),
+            ('gw2m_miner_queue_dropped_total', 'counter', 'datagrams to miner dropped because its queue was full',
+             [(dict(vgw=mac), stats['dropped']) for mac, stats in outbound.items()]),
+            ('gw2m_miner_send_errors_total', 'counter', 'datagrams to miner dropped because sending failed',
+             [(dict(vgw=mac), stats['errors']) for mac, stats in outbound.items()]),
+            ('gw2m_dedup_hits_total', 'counter', 'rxpks dropped as duplicates', [(dict(), cache['hits'])]),
+            ('gw2m_dedup_misses_total', 'counter', 'rxpks not seen before', [(dict(), cache['misses'])]),
+            ('gw2m_dedup_hit_ratio', 'gauge', 'fraction of rxpks that were duplicates', [(dict(), cache['hit_ratio'])]),
+            ('gw2m_rxpk_cache_entries', 'gauge', 'rxpk keys remembered for de-duplication', [(dict(), cache['size'])]),
+            ('gw2m_decode_errors_total', 'counter', 'datagrams that could not be decoded', [(dict(), self.decode_errors)]),
+            ('gw2m_socket_errors_total', 'counter', 'socket errors (ICMP unreachable from previous sends)',
+             [(dict(), self.socket_errors + self.receiver.socket_errors +
+               (self.miner_sockets.socket_errors if self.miner_sockets else 0))]),
+            ('gw2m_oversized_datagrams_total', 'counter', 'datagrams dropped for exceeding the receive buffer',
+             [(dict(), self.receiver.oversized)]),
+            ('gw2m_best_copy_transmissions_total', 'counter', 'transmissions forwarded after best copy selection by number of gateways that heard them',
+             [(dict(gateways=str(gateways)), count) for gateways, count in list(best_copy['heard_by'].items())]),
+            ('gw2m_downlinks_total', 'counter', 'PULL_RESP scheduled by downlink scheduler by result',
+             [(dict(result=result), count) for result, count in list(downlink.items()) if result not in ('devices', 'gateways')]),
+            ('gw2m_downlink_devices', 'gauge', 'devices in downlink scheduler index', [(dict(), downlink.get('devices', 0))]),
+            ('gw2m_snapshots_total', 'counter', 'state snapshots by result',
+             [(dict(result=result), snapshot[result]) for result in ('saves', 'skipped', 'errors') if snapshot]),
+            ('gw2m_tx_acks_total', 'counter', 'downlinks forwarded to gateways by gateway and TX_ACK result (timeout if none)',
+             [(dict(gateway=mac, result=result), count) for mac, results in list(self.tx_tracker.by_gateway.items())
+              for result, count in list(results.items())]),
+            ('gw2m_miner_downlinks_total', 'counter', 'downlinks of miners forwarded to gateways by TX_ACK result',
+             [(dict(vgw=mac, result=result), count) for mac, results in list(self.tx_tracker.by_miner.items())
+              for result, count in list(results.items())]),
+            ('gw2m_downlinks_in_flight', 'gauge', 'downlinks waiting for TX_ACK', [(dict(), len(self.tx_tracker.in_flight))]),
+            ('gw2m_tx_acks_unmatched_total', 'counter', 'TX_ACK matching no forwarded PULL_RESP', [(dict(), self.tx_tracker.unmatched)]),
+            ('gw2m_tx_ack_seconds', 'histogram', 'time from forwarding PULL_RESP to TX_ACK of gateway',
+             [(dict(gateway=mac), hist) for mac, hist in list(self.tx_tracker.ack_latency.items())]),
+            ('gw2m_downlink_lead_seconds', 'histogram', 'time left until transmit time when PULL_RESP was received',
+             [(dict(vgw=mac), hist) for mac, hist in list(self.tx_tracker.lead.items())]),
+            ('gw2m_downlink_forward_seconds', 'histogram', 'time from receiving PULL_RESP to sending it to a gateway',
+             [(dict(), self.tx_tracker.forward_latency)]),
+        ]
+        if self.timer:
+            families.append(('gw2m_stage_seconds', 'histogram', 'time per datagram in each forwarding stage',
+                             [(dict(stage=stage), hist) for stage, hist in list(self.timer.histograms.items())]))
+        return families
+
+    def run_asyncio(self):
+        """
+        run using asyncio event loop instead of blocking receive loop.  Keepalive and stat messages are sent from
+        scheduled tasks so they are not delayed by the receive timeout
+        :return:
+        """
+        from src.aio_engine import run_gw2miner
+        asyncio.run(run_gw2miner(self))
+
+    def run_timers(self):
+        """
+        send keepalive and stat messages if their interval elapsed
+        :return:
+        """
+        if time.time() - self.last_keepalive_ts > self.keepalive_interval:
+            self.send_keepalive()
+        if time.time() - self.last_stat_ts > self.stat_interval:
+            self.send_stats()
+        if self.config_watcher:
+            self.check_configs()
+        if self.resolver.changes or self.resolver.resolved:
+            self.apply_dns_changes()
+        if self.snapshot and self.snapshot.due():
+            self.save_snapshot()
+        if self.profiler:
+            self.profiler.poll()
+        if self.tx_tracker.in_flight:
+            self.tx_tracker.expire()
+
+    def handle_shard_messages(self):
+        """
+        handle messages from other workers when running with multiple workers
+        :return:
+        """
+        for msg in self.shard.recv():
+            if msg['t'] == sharding.MSG_RXPK:
+                push = dict(_NAME_=messages.MsgPushData.NAME, MAC=msg['MAC'], data=dict(rxpk=msg['rxpk']))
+                if msg.get('txMAC'):
+                    push['txMAC'] = msg['txMAC']
+                # the receiving worker already passed these copies to the downlink scheduler
+                push['_SHARD_'] = True
+                self.handle_PUSH_DATA(push, addr=None)
+            elif msg['t'] == sharding.MSG_GATEWAY:
+                self.gw_listening_addrs[msg['MAC']] = tuple(msg['addr'])
+            elif msg['t'] == sharding.MSG_TX_ACK:
+                self.handle_TX_ACK(dict(_NAME_=messages.MsgTxAck.NAME, MAC=msg['MAC'], token=msg['token'],
+                                        data=msg['data']), addr=None)
+            elif msg['t'] == sharding.MSG_OBSERVE:
+                if self.downlink:
+                    for device, lsnr, rssi, tmst_offset, join_us in msg['obs']:
+                        self.downlink.apply(msg['MAC'], bytes.fromhex(device) if device else None, lsnr, rssi,
+                                            tmst_offset, join_us)
+            elif msg['t'] == sharding.MSG_OFFSET:
+                vgw = self.vgateways_by_mac.get(msg['MAC'])
+                if vgw:
+                    vgw.rxmodifier.tmst_offset = msg['offset']
+            elif msg['t'] == sharding.MSG_STAT:
+                for mac, counts in msg['counts'].items():
+                    vgw = self.vgateways_by_mac.get(mac)
+                    if vgw:
+                        for name, count in counts.items():
+                            if name in STAT_COUNTERS:
+                                setattr(vgw, name, getattr(vgw, name) + count)
+
+    def handle_message(self, msg, addr, vgw=None):
+        """
+        dispatch a decoded message to appropriate handler
+        :param msg: decoded message dictionary
+        :param addr: tuple of (ip, port) of message origin
+        :param vgw: VirtualGateway whose connected socket received a message from its miner, looked up from addr if None
+        :return:
+        """
+        if msg['_NAME_'] == messages.MsgPushData.NAME:
+            self.handle_PUSH_DATA(msg, addr)
+        elif msg['_NAME_'] == messages.MsgPullResp.NAME:
+            self.handle_PULL_RESP(msg, addr, vgw)
+        elif msg['_NAME_'] == messages.MsgPullData.NAME:
+            self.handle_PULL_DATA(msg, addr)
+        elif msg['_NAME_'] == messages.MsgTxAck.NAME:
+            self.handle_TX_ACK(msg, addr)
+        elif msg['_NAME_'] == messages.MsgPushAck.NAME:
+            vgw = vgw or self.vgateways_by_addr.get(addr)
+            if vgw:
+                vgw.push_acked += 1
+
+    def sendto(self, data, addr):
+        """
+        send datagram (ack or PULL_RESP to a gateway) from listening socket.  Replaced by the asyncio transport when
+        running under asyncio
+        :param data: raw bytes to send
+        :param addr: destination (ip, port)
+        :return:
+        """
+        try:
+            self.sock.sendto(data, to_sockaddr(addr) if self.ipv6 else addr)
+        except OSError as e:
+            # socket buffer full or ICMP unreachable from a previous send, gateway will retry
+            self.socket_errors += 1
+            self.vgw_logger.debug("could not send to %s: %s", addr, e)
+
+    def send_nowait(self, data, addr):
+        """
+        used by miner queues to send from listening socket, replaced under asyncio and by MinerSockets.sendto
+        :param data: raw bytes to send
+        :param addr: destination (ip, port)
+        :return:
+        :raises BlockingIOError: if socket buffer is full
+        """
+        self.sock.sendto(data, to_sockaddr(addr) if self.ipv6 else addr)
+
+    def send_to_miner(self, data, addr, mac=None):
+        """
+        send datagram to miner through its outbound queue
+        :param data: raw bytes to send
+        :param addr: destination (ip, port) of miner
+        :param mac: MAC of virtual gateway of miner, looked up from addr if None
+        :return:
+        """
+        if mac is None:
+            vgw = self.vgateways_by_addr.get(addr)
+            mac = vgw.mac if vgw else addr
+        if self.miner_sockets:
+            addr = self.miner_sockets.socket_for(mac, addr)
+            if addr is None:
+                self.vgw_logger.debug("vgateway %s has no socket, dropped a datagram", str(mac)[-8:])
+                return
+        if not self.outbound.put(mac, data, addr):
+            self.vgw_logger.debug("queue for vgateway %s full, dropped a datagram", str(mac)[-8:])
 
     def handle_PUSH_DATA(self, msg, addr=None):
         """
@@ -129,66 +650,176 @@ class GW2Miner:
         new_rxpks = []
         self.vminer_logger.debug(
             f"PUSH_DATA from GW:{msg['MAC'][-8:]}")
+        not_owned = dict()
+        observations = []  # shared with other workers so each can schedule downlinks through any gateway
         for rxpk in msg['data']['rxpk']:
+            if self.downlink and not msg.get('txMAC') and not msg.get('_SHARD_'):
+                # every copy counts for which gateways hear a device, not only the forwarded one
+                observation = self.downlink.observe(rxpk, msg['MAC'])
+                if self.shard:
+                    observations.append(observation)
 
             key = self.__rxpk_key__(rxpk)
 
+            if self.shard and not self.shard.owns(key):
+                # another worker de-duplicates this key
+                not_owned.setdefault(self.shard.owner(key), []).append(rxpk)
+                continue
+
             if 48 <= rxpk.get('size') <= 80 and rxpk.get('datr') in ['SF8BW125', 'SF9BW125']:
                 if key in self.rxpk_cache:
-                    self.vminer_logger.info(f"repeat chlng. from GW:{msg['MAC'][-8:]} [{rxpk.get('size')}B]: {key}; rssi:{rxpk['rssi']:.0f}, snr:{rxpk['lsnr']:.0f}")
+                    self.vminer_logger.info("repeat chlng. from GW:%s [%sB]: %016X; rssi:%.0f, snr:%.0f", msg['MAC'][-8:], rxpk.get('size'), key, rxpk['rssi'], rxpk['lsnr'])
+                    if self.best_copy:
+                        self.best_copy.add_copy(key, rxpk, msg['MAC'])
                     continue
-                self.vminer_logger.info(f"new    chlng. from GW:{msg['MAC'][-8:]} [{rxpk.get('size')}B]: {key}; rssi:{rxpk['rssi']:.0f}, snr:{rxpk['lsnr']:.0f}")
+                self.vminer_logger.info("new    chlng. from GW:%s [%sB]: %016X; rssi:%.0f, snr:%.0f", msg['MAC'][-8:], rxpk.get('size'), key, rxpk['rssi'], rxpk['lsnr'])
             else:
                 if key in self.rxpk_cache:
-                    self.vminer_logger.debug(f"repeated packet  [{rxpk.get('size')}B, {rxpk.get('rssi')}dBm]: {key}")
+                    self.vminer_logger.debug("repeated packet  [%sB, %sdBm]: %016X", rxpk.get('size'), rxpk.get('rssi'), key)
+                    if self.best_copy:
+                        self.best_copy.add_copy(key, rxpk, msg['MAC'])
                     continue
-                self.vminer_logger.debug(f"new packet [{rxpk.get('size')}B, {rxpk.get('rssi')}dBm]: {key}")
+                self.vminer_logger.debug("new packet [%sB, %sdBm]: %016X", rxpk.get('size'), rxpk.get('rssi'), key)
             self.rxpk_cache[key] = time.time()
+            if self.best_copy and not msg.get('txMAC'):
+                # forwarded once copies from other gateways had a chance to arrive, see flush_best_copies
+                self.best_copy.hold(key, rxpk, msg['MAC'])
+                continue
             new_rxpks.append(rxpk)
 
+        for index, rxpks in not_owned.items():
+            self.shard.forward_rxpks(index, rxpks, src_mac=msg['MAC'], tx_mac=msg.get('txMAC'))
+        if observations:
+            self.shard.broadcast_observations(msg['MAC'], observations)
+
         if not new_rxpks:
             return
 
-        msg['data']['rxpk'] = new_rxpks
-        # send rxpks from each gateway to miners
-        for vgw in self.vgateways_by_mac.values():
+        self.forward_rxpks(new_rxpks, src_mac=msg['MAC'], tx_mac=msg.get('txMAC'))
+
+    def forward_rxpks(self, rxpks, src_mac, tx_mac=None, received=None):
+        """
+        send rxpks received by gateway src_mac to all miners whose routing rules accept them (all miners if no rules
+        are configured)
+        :param rxpks: list of new rxpk dictionaries
+        :param src_mac: MAC address of gateway that received rxpks
+        :param tx_mac: MAC of virtual gateway that transmitted these rxpks if generated from PULL_RESP
+        :param received: list of UTC datetimes rxpks arrived at if they were held, see modify_rxpk.modify_rxpks
+        :return:
+        """
+        if self.router:
+            # rxpks going to the same set of miners are sent together
+            routed = dict()
+            for i, rxpk in enumerate(rxpks):
+                routed.setdefault(self.router.targets(rxpk, src_mac), []).append(i)
+            for vgateways, indexes in routed.items():
+                if vgateways:
+                    self.send_rxpks([rxpks[i] for i in indexes], src_mac, vgateways, tx_mac,
+                                    received and [received[i] for i in indexes])
+            return
+        self.send_rxpks(rxpks, src_mac, self.vgateways_by_mac.values(), tx_mac, received)
+
+    def send_rxpks(self, rxpks, src_mac, vgateways, tx_mac=None, received=None):
+        """
+        send rxpks to miners of vgateways.  Fields that are the same for all miners are serialized once, only modified
+        metadata is serialized per virtual gateway
+        :param rxpks: list of new rxpk dictionaries
+        :param src_mac: MAC address of gateway that received rxpks
+        :param vgateways: iterable of VirtualGateway to send rxpks to
+        :param tx_mac: MAC of virtual gateway that transmitted these rxpks if generated from PULL_RESP
+        :param received: list of UTC datetimes rxpks arrived at if they were held, defaults to now
+        :return:
+        """
+        templates = [messages.rxpk_template(rx) for rx in rxpks]
+        receivers = vgateways
+        vgateways = []
+        for vgw in receivers:
             # ignore if this is a generated PUSH from this gateways transmission
-            if msg.get('txMAC') == vgw.mac:
-                self.vgw_logger.debug(f"ignoring rxpk for vGW {vgw.mac[-8:]}. Its generated from PULL_RESP from this vGW")
+            if tx_mac == vgw.mac:
+                self.vgw_logger.debug("ignoring rxpk for vGW %s. Its generated from PULL_RESP from this vGW", vgw.mac[-8:])
                 continue
+            vgateways.append(vgw)
+        # metadata for every virtual gateway is modified in one batch
+        metadata = self.modify_rxpks(rxpks, src_mac, [(vgw.mac, vgw.rxmodifier) for vgw in vgateways], received)
+        if self.shard and src_mac in self.vgateways_by_mac:
+            # tmst offset of the receiving gateway's vGW was updated, other workers use it too
+            self.shard.share_offset(src_mac, self.vgateways_by_mac[src_mac].rxmodifier.tmst_offset)
 
-            data, addr = vgw.get_rxpks(copy.deepcopy(msg))
+        # send rxpks from each gateway to miners
+        for vgw, vgw_metadata in zip(vgateways, metadata):
+            if self.batcher:
+                for data, addr in self.batcher.add(vgw, vgw.encode_rxpks(rxpks, templates, src_mac, vgw_metadata)):
+                    self.send_to_miner(data, addr, vgw.mac)
+                continue
+
+            data, addr = vgw.get_rxpks_from_templates(rxpks, templates, src_mac, vgw_metadata)
             if addr is None:
                 continue
-            self.sock.sendto(data, addr)
+            self.send_to_miner(data, addr, vgw.mac)
 
-    def handle_PULL_RESP(self, msg, addr=None):
+    def handle_PULL_RESP(self, msg, addr=None, vgw=None):
         """
         take PULL_RESP sent from a miner and forward to the appropriate gateway
         :param msg:
         :param addr:
+        :param vgw: VirtualGateway whose connected socket received msg, looked up from addr if None
         :return:
         """
-        vgw = self.vgateways_by_addr.get(addr)
+        vgw = vgw or self.vgateways_by_addr.get(addr)
         if not vgw:
             self.vgw_logger.error(f"PULL_RESP from unknown miner at {addr}, dropping transmit command")
             return
-        dest_addr = self.gw_listening_addrs.get(vgw.mac)
-        if not dest_addr:
-            self.vgw_logger.warning(f"PULL_RESP from {addr} has no matching real gateway, will only be received by Virtual Miners")
+        vgw.dwnb += 1
         txpk = msg['data'].get('txpk')
+        dest_mac = vgw.mac
+        if self.downlink and txpk:
+            dest_mac, tmst, result = self.downlink.schedule(txpk, vgw.mac, vgw.rxmodifier.tmst_offset, self.gw_listening_addrs)
+            if dest_mac is None:
+                self.vgw_logger.warning("PULL_RESP from %s not transmitted: %s", addr, result)
+            elif dest_mac != vgw.mac:
+                self.vgw_logger.info("PULL_RESP from vgw:%s scheduled on gateway %s (best reception of device), tmst:%s->%s", vgw.mac[-8:], dest_mac[-8:], txpk.get('tmst'), tmst)
+                msg['data']['txpk'] = dict(txpk, tmst=tmst) if tmst is not None else txpk
+        dest_addr = self.gw_listening_addrs.get(dest_mac)
+        if not dest_addr:
+            self.vgw_logger.warning("PULL_RESP from %s has no matching real gateway, will only be received by Virtual Miners", addr)
         rawmsg = messages.encode_message(msg)
         if dest_addr:
-            self.sock.sendto(rawmsg, dest_addr)
-            self.vgw_logger.info(f"forwarding PULL_RESP from {addr} to gateway {vgw.mac[-8:]}, (freq:{round(txpk['freq'], 2)}, sf:{txpk['datr']}, codr:{txpk['codr']}, size:{txpk['size']})")
+            self.sendto(rawmsg, dest_addr)
+            self.gateway_datagrams_out[dest_mac] = self.gateway_datagrams_out.get(dest_mac, 0) + 1
+            lead = lead_seconds(txpk, vgw.rxmodifier.tmst_offset) if txpk else None
+            self.tx_tracker.sent(dest_mac, msg['token'], vgw.mac, msg.get('_UNIX_TS_', time.time()), lead)
+            self.vgw_logger.info("forwarding PULL_RESP from %s to gateway %s, (freq:%s, sf:%s, codr:%s, size:%s)", addr, dest_mac[-8:], round(txpk['freq'], 2), txpk['datr'], txpk['codr'], txpk['size'])
 
 
 
         # make fake PUSH_DATA and forward to vgateways
         fake_push = messages.PULL_RESP2PUSH_DATA(msg, src_mac=vgw.mac)
-        self.vgw_logger.info(f"created fake rxpk for PULL_RESP from vgw:{vgw.mac[-8:]}")
+        self.vgw_logger.info("created fake rxpk for PULL_RESP from vgw:%s", vgw.mac[-8:])
         self.handle_PUSH_DATA(msg=fake_push, addr=None)
 
+    def handle_TX_ACK(self, msg, addr=None):
+        """
+        take TX_ACK sent from a gateway in answer to a forwarded PULL_RESP and record the outcome of the downlink
+        :param msg: dictionary containing header and contents of TX_ACK message
+        :param addr: tuple of (ip, port) of message origin
+        :return:
+        """
+        if self.shard and (msg['MAC'], msg['token']) not in self.tx_tracker.in_flight:
+            # PULL_RESP was forwarded by another worker, or this TX_ACK was broadcast by one
+            if addr is not None:
+                self.shard.broadcast_tx_ack(msg['MAC'], msg['token'], msg.get('data'))
+            return
+        vgw_mac, result = self.tx_tracker.acked(msg['MAC'], msg['token'], msg.get('data'))
+        if vgw_mac is None:
+            self.vgw_logger.debug("TX_ACK from gateway %s matches no forwarded PULL_RESP", msg['MAC'][-8:])
+            return
+        if result == RESULT_SENT:
+            vgw = self.vgateways_by_mac.get(vgw_mac)
+            if vgw:
+                vgw.txnb += 1
+        else:
+            self.vgw_logger.warning("gateway %s did not transmit downlink of vgw:%s: %s", msg['MAC'][-8:], vgw_mac[-8:], result)
+
     def handle_PULL_DATA(self, msg, addr=None):
         """
         take PULL_DATA sent from gateways and record the destination (ip, port) where this gateway MAC can be reached
@@ -198,40 +829,93 @@ class GW2Miner:
         """
         if msg['MAC'] not in self.gw_listening_addrs:
             self.vminer_logger.info(f"discovered gateway mac:{msg['MAC'][-8:]} at {addr}. {len(self.gw_listening_addrs) + 1} total gateways")
+        if self.shard and self.gw_listening_addrs.get(msg['MAC']) != addr:
+            # let other workers know so they can route PULL_RESP to this gateway
+            self.shard.broadcast_gateway(msg['MAC'], addr)
         self.gw_listening_addrs[msg['MAC']] = addr
 
-    def get_message(self, timeout=None):
+    def get_messages(self, timeout=None):
         """
-        waits for a datagram to be received from socket.  Once received it parses datagram into PROTOCOL.txt defined
-        payload.  If successful the parsed message and sending address is returned.  On socket timeout or parsing error
-        None, None is returned.
-        :param timeout: socket timeout if None will not timeout
-        :return: tuple of (message, addr) or (None, None) on error/timeout
+        waits for datagrams to be received from socket.  Once readable all waiting datagrams are read into preallocated
+        buffers and parsed into PROTOCOL.txt defined payloads.  Datagrams that fail parsing are skipped.
+        ICMP port unreachable errors from previous sends (ConnectionResetError, see
+        https://stackoverflow.com/questions/15228272/what-would-cause-a-connectionreset-on-an-udp-socket) are suppressed
+        :param timeout: seconds to wait, if None will not timeout
+        :return: generator of (message, addr), each datagram is decoded (and acked) when the previous one was handled
         """
-        if timeout:
-            self.sock.settimeout(timeout)
-        try:
-            data, addr = self.sock.recvfrom(1024)
+        # socket is non-blocking so wait here, also for messages from other workers and replies on miner sockets
+        waitables = [self.sock]
+        if self.shard:
+            waitables.append(self.shard)
+        if self.miner_sockets:
+            waitables.append(self.miner_sockets)
+        readable, _, _ = select.select(waitables, [], [], timeout)
+        if self.shard in readable:
+            self.handle_shard_messages()
+        if self.miner_sockets in readable:
+            self.handle_miner_datagrams()
+        if self.sock not in readable:
+            return
+        yield from self.receive_messages()
 
-        except (socket.timeout, BlockingIOError) as e:
-            # if recv timed out, no new data but time to send PULL_DATA or stat message
-            return None, None
+    def receive_messages(self):
+        """
+        read and decode all datagrams waiting on the listening socket without blocking
+        :return: generator of (message, addr)
+        """
+        # buffers are only reused by the next receive, decoded messages do not reference them
+        for data, addr in self.receiver.receive():
+            msg, addr = self.decode_datagram(data, addr)
+            if msg:
+                yield msg, addr
 
-        except ConnectionResetError as e:
-            # from https://stackoverflow.com/questions/15228272/what-would-cause-a-connectionreset-on-an-udp-socket
-            # indicates a previous send operation resulted in an ICMP Port Unreachable message.
-            # I am ok suppressing these errors
-            return None, None
+    def handle_miner_datagrams(self):
+        """
+        decode and handle datagrams received on connected miner sockets, attributed to the socket's virtual gateway
+        :return:
+        """
+        for data, addr, vgw in self.miner_sockets.receive():
+            msg, addr = self.decode_datagram(data, addr, vgw)
+            if msg:
+                self.handle_message(msg, addr, vgw)
+                if self.timer:
+                    self.timer.commit()
 
+    def decode_datagram(self, data, addr, vgw=None):
+        """
+        parse received datagram and send ack if appropriate
+        :param data: raw datagram, bytes or memoryview of a receive buffer
+        :param addr: tuple of (ip, port) of datagram origin
+        :param vgw: VirtualGateway whose connected socket received data, looked up from addr if None
+        :return: tuple of (message, addr) or (None, None) on parsing error
+        """
+        if self.ipv6:
+            addr = from_sockaddr(addr)
+        if self.capture:
+            self.capture.write(data, addr)
         try:
-            msg, ack = messages.decode_message(data, return_ack=True)
+            # stat only PUSH_DATA is acked without parsing, the gateway stat object is not used
+            msg, ack = messages.decode_message(data, return_ack=True, skip_stat=True)
         except ValueError as e:
             # invalid payload, ignore
+            self.decode_errors += 1
             return None, None
 
+        mac = msg.get('MAC')
+        if mac:
+            key = (mac, msg['_NAME_'])
+            self.gateway_datagrams_in[key] = self.gateway_datagrams_in.get(key, 0) + 1
+        else:
+            vgw = vgw or self.vgateways_by_addr.get(addr)
+            if vgw:
+                key = (vgw.mac, msg['_NAME_'])
+                self.miner_datagrams_in[key] = self.miner_datagrams_in.get(key, 0) + 1
+
         # send ack if appropriate
         if ack:
-            self.sock.sendto(ack, addr)
+            self.sendto(ack, addr)
+            if mac:
+                self.gateway_datagrams_out[mac] = self.gateway_datagrams_out.get(mac, 0) + 1
 
         return msg, addr
 
@@ -241,9 +925,46 @@ class GW2Miner:
         :return:
         """
         self.last_stat_ts = time.time()
+        if self.capture:
+            self.capture.flush()
+        if self.shard and not self.shard.is_primary:
+            # primary worker sends stats, only report counts since last report
+            counts = dict()
+            for gw in self.vgateways_by_mac.values():
+                gw_counts = {name: getattr(gw, name) for name in STAT_COUNTERS if getattr(gw, name)}
+                if gw_counts:
+                    counts[gw.mac] = gw_counts
+                for name in STAT_COUNTERS:
+                    setattr(gw, name, 0)
+            if counts:
+                self.shard.send_stat(counts)
+            return
         for gw in self.vgateways_by_mac.values():
             data, addr = gw.get_stat()
-            self.sock.sendto(data, addr)
+            self.send_to_miner(data, addr, gw.mac)
+        self.vminer_logger.debug(f"rxpk cache stats: {self.rxpk_cache.stats()}")
+        if self.batcher:
+            stats = self.batcher.stats()
+            self.vminer_logger.info(f"batched {stats['rxpks']} rxpks in {stats['datagrams']} PUSH_DATA, "
+                                    f"saved {stats['datagrams_saved']} datagrams ({stats['saved_per_sec']:.1f}/s), "
+                                    f"added latency avg:{stats['avg_latency_ms']:.1f}ms max:{stats['max_latency_ms']:.1f}ms")
+        if self.best_copy:
+            stats = self.best_copy.stats()
+            self.vminer_logger.info(f"best copy of {stats['transmissions']} transmissions forwarded, {stats['replaced']} times a later "
+                                    f"copy was better, transmissions by gateways that heard them: {stats['heard_by']}")
+        if self.downlink:
+            self.vgw_logger.info(f"downlink scheduler: {self.downlink.stats()}")
+        lines = self.tx_tracker.report()
+        if lines:
+            self.vgw_logger.info(f"downlinks by TX_ACK result, {self.tx_tracker.stats()}:\n" + '\n'.join(lines))
+        if self.profiler and self.timer:
+            lines = format_stage_report(self.timer)
+            if lines:
+                self.profiler.logger.info(f"time per datagram, {self.timer.sample_rate:.0%} of datagrams sampled:\n" + '\n'.join(lines))
+        for mac, stats in self.outbound.stats().items():
+            if stats['dropped'] or stats['errors']:
+                self.vgw_logger.warning(f"vgateway {str(mac)[-8:]} queue depth:{stats['depth']}, dropped:{stats['dropped']}, "
+                                        f"send errors:{stats['errors']} since start")
 
     def send_keepalive(self):
         """
@@ -251,60 +972,238 @@ class GW2Miner:
         :return:
         """
         self.last_keepalive_ts = time.time()
+        if self.shard and not self.shard.is_primary:
+            return
         for gw in self.vgateways_by_mac.values():
             data, addr = gw.get_PULL_DATA()
-            self.sock.sendto(data, addr)
+            self.send_to_miner(data, addr, gw.mac)
 
     def __del__(self):
         self.sock.close()
+        if self.miner_sockets:
+            self.miner_sockets.close()
 
 
-def configure_logger(debug=False):
-    # setup logger
-    # =============================
-    logformat = '%(asctime)s.%(msecs)03d %(name)-6s:[%(levelname)-8s] %(message)s'
-    logging.basicConfig(
-        format=logformat,
-        datefmt='%Y/%m/%d %H:%M:%S',
-        level=logging.DEBUG if debug else logging.INFO,
-        filename='middleman.log',
-        filemode='a'
-    )
-    console = logging.StreamHandler()
-    console.setLevel(logging.DEBUG if debug else logging.INFO)
-    formatter = logging.Formatter(logformat, datefmt='%Y/%m/%d %H:%M:%S')
-    # tell the handler to use this format
-    console.setFormatter(formatter)
-    logging.getLogger('').addHandler(console)
-
+def configure_logger(debug=False, path='middleman.log', max_bytes=10 * 1024 * 1024, backups=5, rate=20):
+    """
+    log to a rotating file and the console from a background thread, see src/logpipe.py
+    :return: started LogPipeline, stopped on exit to write what is still queued
+    """
+    return configure_pipeline(path, debug=debug, max_bytes=max_bytes, backups=backups, rate=rate)
 
 
 def main():
     parser = argparse.ArgumentParser("forward data from multiple concentrators to multiple miners with coercing of metadata")
     parser.add_argument('-p', '--port', help='port to listen for gateway on', default=1680, type=int)
+    parser.add_argument('--host', help='address to listen for gateways on, e.g. :: for IPv6 and IPv4', default='0.0.0.0', type=str)
+    parser.add_argument('--listeners', help='JSON file declaring several isolated listeners (port, host, configs) served by this process, replaces -p, --host and -c', default=None, type=str)
     parser.add_argument('-c', '--configs', help='path where to locate gateway configs', default='gw_configs/', type=str)
     parser.add_argument('-d', '--debug', action='store_true', help="print verbose debug messages")
     parser.add_argument('-k', '--keepalive', help='keep alive interval in seconds', default=10, type=int)
     parser.add_argument('-s', '--stat', help='stat interval in seconds', default=30, type=int)
+    parser.add_argument('-e', '--engine', help='event loop used to receive and forward packets', default='blocking', choices=['blocking', 'asyncio'])
+    parser.add_argument('-w', '--workers', help='number of worker processes sharing the listening port', default=1, type=int)
+    parser.add_argument('--batch-window', help='ms to hold rxpks for a miner so they can be sent in one PUSH_DATA (0 to disable)', default=0, type=float)
+    parser.add_argument('--batch-max-size', help='max size of batched PUSH_DATA in bytes', default=1400, type=int)
+    parser.add_argument('--dedup-ttl', help='seconds a received packet is remembered for de-duplication', default=60, type=float)
+    parser.add_argument('--dedup-max', help='max number of packets remembered for de-duplication', default=100000, type=int)
+    parser.add_argument('--metrics-port', help='serve Prometheus metrics on this localhost port (port + worker index with workers)', default=0, type=int)
+    parser.add_argument('--dns-ttl', help='seconds between re-resolving miner host names (0 to disable)', default=300, type=float)
+    parser.add_argument('--watch', action='store_true', help='reload configs when files in the config directory change')
+    parser.add_argument('--miner-queue', help='max datagrams waiting to be sent to each miner', default=64, type=int)
+    parser.add_argument('--miner-rate', help='max datagrams per second sent to each miner (0 for no limit)', default=0, type=float)
+    parser.add_argument('--miner-burst', help='datagrams a rate limited miner can receive at once', default=10, type=int)
+    parser.add_argument('--drop-policy', help='datagram dropped when a miner queue is full', default='oldest', choices=['oldest', 'newest'])
+    parser.add_argument('--miner-sockets', action='store_true', help='send to each miner from its own connected UDP socket (two if up and down ports differ), replies are matched to virtual gateways by socket instead of address')
+    parser.add_argument('--rcvbuf', help='socket receive buffer size in bytes (0 for system default)', default=0, type=int)
+    parser.add_argument('--best-copy-window', help='ms to wait for copies of a packet from other gateways and forward only the best (0 to forward first copy)', default=0, type=float)
+    parser.add_argument('--best-copy-scorer', help='how the forwarded copy is chosen', default='rssi', choices=['rssi', 'snr', 'gps'])
+    parser.add_argument('--schedule-downlinks', action='store_true', help='transmit PULL_RESP from the gateway that heard the device best instead of only the gateway with the virtual gateway MAC')
+    parser.add_argument('--snapshot', help='save dedup cache, gateway addresses and tmst offsets to this file and restore them on start (one file per worker or listener)', default=None, type=str)
+    parser.add_argument('--snapshot-interval', help='seconds between snapshots', default=30, type=float)
+    parser.add_argument('--snapshot-max-age', help='seconds after which gateway addresses and tmst offsets of a snapshot are too old to restore', default=300, type=float)
+    parser.add_argument('--profile', help='time each forwarding stage for this fraction of datagrams (0.01 if no value given) and log it every stat interval, SIGUSR1/SIGUSR2 toggle cProfile/tracemalloc', nargs='?', const=0.01, default=0, type=float)
+    parser.add_argument('--profile-dir', help='directory for cProfile and tracemalloc dumps', default='.', type=str)
+    parser.add_argument('--log-file', help='log file, rotated when it reaches --log-max-bytes', default='middleman.log', type=str)
+    parser.add_argument('--log-max-bytes', help='size in bytes at which the log file is rotated (0 to never rotate)', default=10 * 1024 * 1024, type=int)
+    parser.add_argument('--log-backups', help='rotated log files kept', default=5, type=int)
+    parser.add_argument('--log-rate', help='max log messages per second from each line of code, the rest are counted and summarized every minute (0 for no limit)', default=20, type=float)
+    parser.add_argument('--capture', help='record received datagrams to this file for tools/replay.py (one file per worker or listener)', default=None, type=str)
 
     args = parser.parse_args()
+    listeners = None
+    if args.listeners:
+        if args.workers > 1:
+            parser.error("--listeners cannot be combined with --workers")
+        try:
+            listeners = load_listeners(args.listeners)
+        except (OSError, ValueError) as e:
+            parser.error(f"invalid --listeners file: {e}")
 
-    configure_logger(args.debug)
+    log_pipeline = configure_logger(args.debug, args.log_file, args.log_max_bytes, args.log_backups, args.log_rate)
 
     logging.info(f"info log messages are enabled")
     logging.debug(f"debug log messages are enabled")
-    config_paths = []
-    for f in os.listdir(args.configs):
-        if os.path.isfile(os.path.join(args.configs, f)) and f[-4:].lower() == 'json':
-            config_paths.append(os.path.join(args.configs, f))
+    try:
+        if args.listeners:
+            run_listeners(args, listeners)
+            return
+        config_paths = list_configs(args.configs)
+        if args.workers > 1:
+            run_workers(args, config_paths, log_pipeline)
+        else:
+            run_gw2miner(args, config_paths)
+    finally:
+        log_pipeline.stop()
+
+def create_gw2miner(args, config_paths, port, host='0.0.0.0', configs_dir=None, suffix=None, shard=None, profiler=None,
+                    name=None):
+    """
+    build GW2Miner from command line arguments
+    :param args: parsed command line arguments
+    :param config_paths: list of virtual gateway config paths
+    :param port: port to listen on
+    :param host: address to listen on
+    :param configs_dir: directory watched for config changes, args.configs if None
+    :param suffix: appended to capture and snapshot paths so workers and listeners write their own files
+    :param shard: ShardRouter when running as one of multiple workers
+    :param profiler: Profiler in --profile mode
+    :param name: listener name when running several listeners
+    :return: GW2Miner, its resolver is started
+    """
+    capture = None
+    if args.capture:
+        capture = CaptureWriter(args.capture if suffix is None else f"{args.capture}.{suffix}")
+        logging.info(f"recording received datagrams to {capture.path}")
+    snapshot = None
+    if args.snapshot:
+        snapshot = StateSnapshot(args.snapshot if suffix is None else f"{args.snapshot}.{suffix}",
+                                 interval=args.snapshot_interval, max_age=args.snapshot_max_age)
+    config_watcher = None
+    if args.watch:
+        config_watcher = ConfigWatcher(configs_dir or args.configs)
+        logging.info(f"watching {config_watcher.directory} for config changes ({config_watcher.method})")
+    resolver = Resolver(ttl=args.dns_ttl, ipv6=':' in host or args.miner_sockets)
+    options = Options.from_args(args, capture=capture, config_watcher=config_watcher, snapshot=snapshot,
+                                profiler=profiler)
+    gw2miner = GW2Miner(port, config_paths, options=options, shard=shard, resolver=resolver, host=host, name=name)
+    resolver.start()
+    if args.metrics_port or args.profile:
+        gw2miner.enable_stage_timing(StageTimer(sample_rate=args.profile or 1.0))
+    return gw2miner
+
+def close_gw2miner(gw2miner):
+    """
+    write last snapshot, close capture and stop resolver of a GW2Miner built by create_gw2miner
+    :param gw2miner: GW2Miner
+    :return:
+    """
+    if gw2miner.snapshot:
+        gw2miner.save_snapshot(wait=True)
+    if gw2miner.capture:
+        gw2miner.capture.close()
+    gw2miner.resolver.stop()
 
-    gw2miner = GW2Miner(args.port, config_paths, args.keepalive, args.stat)
+def run_gw2miner(args, config_paths, shard=None):
+    profiler = Profiler(args.profile_dir).install_signals() if args.profile else None
+    gw2miner = create_gw2miner(args, config_paths, args.port, args.host, suffix=shard.index if shard else None,
+                               shard=shard, profiler=profiler)
+    metrics_server = None
+    if args.metrics_port:
+        port = args.metrics_port + (shard.index if shard else 0)
+        metrics_server = MetricsServer(port, gw2miner.collect_metrics).start()
+        logging.info(f"serving metrics on http://127.0.0.1:{port}/metrics")
+    if args.snapshot:
+        # exit through finally so the last snapshot is written when stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     logging.info(f"starting Gateway2Miner")
     try:
-        gw2miner.run()
+        if args.engine == 'asyncio':
+            gw2miner.run_asyncio()
+        else:
+            gw2miner.run()
     except FileNotFoundError as e: # change to general Exception for release
         logging.fatal("Gateway2Miner returned, packets will no longer be forwarded")
         raise e
+    finally:
+        close_gw2miner(gw2miner)
+        if metrics_server:
+            metrics_server.close()
+        if profiler:
+            profiler.stop()
+
+def run_listeners(args, listeners):
+    """
+    forward packets of several isolated listeners in this process, see src/listeners.py
+    :param args: parsed command line arguments
+    :param listeners: list of ListenerConfig
+    :return:
+    """
+    profiler = Profiler(args.profile_dir).install_signals() if args.profile else None
+    gw2miners = []
+    try:
+        for listener in listeners:
+            logging.info(f"listener {listener.name}: configs in {listener.configs}")
+            gw2miners.append(create_gw2miner(args, list_configs(listener.configs), listener.port, listener.host,
+                                             configs_dir=listener.configs, suffix=listener.name, profiler=profiler,
+                                             name=listener.name))
+        group = ListenerGroup([listener.name for listener in listeners], gw2miners)
+        metrics_server = None
+        if args.metrics_port:
+            metrics_server = MetricsServer(args.metrics_port, group.collect_metrics).start()
+            logging.info(f"serving metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+        if args.snapshot:
+            # exit through finally so the last snapshot is written when stopped
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        logging.info(f"starting Gateway2Miner with {len(listeners)} listeners")
+        try:
+            if args.engine == 'asyncio':
+                from src.aio_engine import run_gw2miners
+                asyncio.run(run_gw2miners(gw2miners))
+            else:
+                group.run()
+        finally:
+            if metrics_server:
+                metrics_server.close()
+    finally:
+        for gw2miner in gw2miners:
+            close_gw2miner(gw2miner)
+        if profiler:
+            profiler.stop()
+
+def run_worker(index, socks, args, config_paths):
+    run_gw2miner(args, config_paths, shard=sharding.ShardRouter(index, socks))
+
+def run_workers(args, config_paths, log_pipeline=None):
+    """
+    start args.workers processes all listening on args.port, each forwarding its share of the traffic
+    :param args: parsed command line arguments
+    :param config_paths: list of virtual gateway config paths
+    :param log_pipeline: LogPipeline of this process, workers log through it
+    :return:
+    """
+    # sockets are inherited by workers so fork is required
+    ctx = mp.get_context('fork')
+    if log_pipeline:
+        log_pipeline.share_with_children(ctx)
+    socks = sharding.create_internal_sockets(args.workers)
+    workers = []
+    for i in range(args.workers):
+        worker = ctx.Process(target=run_worker, args=(i, socks, args, config_paths), name=f"worker{i}")
+        worker.start()
+        workers.append(worker)
+    for sock in socks:
+        sock.close()
+    logging.info(f"started {args.workers} workers on port {args.port}")
+    # make sure workers are stopped when parent is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,151 @@
+"""
+asyncio based engine for GW2Miner.
+
+The listening socket is handed to an asyncio DatagramProtocol.  Received datagrams are decoded and acked directly in
+datagram_received, handling (de-duplication and fan-out to miners) is scheduled with call_soon so the loop goes back to
+reading the socket before sending to every miner.  Keepalive and stat messages run as independent periodic tasks.
+Several listeners (see src/listeners.py) run on one event loop with run_gw2miners.
+"""
+
+import asyncio
+import logging
+import time
+
+from .listeners import to_sockaddr
+
+
+class GW2MinerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, gw2miner):
+        """
+        :param gw2miner: GW2Miner instance that decodes and handles datagrams
+        """
+        self.gw2miner = gw2miner
+        self.transport = None
+        self.loop = None
+        self.flush_handle = None  # timer for sending batched PUSH_DATA and queued datagrams
+        self.logger = logging.getLogger('AIO')
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_event_loop()
+        # all sends go through transport which buffers instead of blocking if socket is not writable
+        self.gw2miner.sendto = self.sendto if self.gw2miner.ipv6 else transport.sendto
+        if self.gw2miner.timer:
+            self.gw2miner.timer.wrap(self.gw2miner, 'sendto', 'send')
+        if not self.gw2miner.miner_sockets:
+            # with connected miner sockets datagrams to miners do not use the listening socket
+            self.gw2miner.outbound.sendto = self.send_nowait
+            if self.gw2miner.timer:
+                self.gw2miner.timer.wrap(self.gw2miner.outbound, 'sendto', 'send')
+
+    def sendto(self, data, addr):
+        self.transport.sendto(data, to_sockaddr(addr))
+
+    def send_nowait(self, data, addr):
+        # datagrams to miners wait in their own queue rather than in the transport buffer shared by all miners
+        if self.transport.get_write_buffer_size():
+            raise BlockingIOError
+        self.transport.sendto(data, to_sockaddr(addr) if self.gw2miner.ipv6 else addr)
+
+    def datagram_received(self, data, addr):
+        msg, addr = self.gw2miner.decode_datagram(data, addr)
+        if not msg:
+            return
+        self.loop.call_soon(self.handle_message, msg, addr)
+
+    def handle_message(self, msg, addr):
+        self.gw2miner.handle_message(msg, addr)
+        if self.flush_handle is None:
+            self.schedule_flush()
+        if self.gw2miner.timer:
+            self.gw2miner.timer.commit()
+
+    def handle_shard_messages(self):
+        self.gw2miner.handle_shard_messages()
+        if self.flush_handle is None:
+            self.schedule_flush()
+
+    def handle_miner_datagrams(self):
+        self.gw2miner.handle_miner_datagrams()
+        if self.flush_handle is None:
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        deadline = self.gw2miner.next_deadline()
+        if deadline is not None:
+            self.flush_handle = self.loop.call_later(max(deadline - time.monotonic(), 0), self.flush_batches)
+
+    def flush_batches(self):
+        self.flush_handle = None
+        self.gw2miner.service_queues()
+        self.schedule_flush()
+
+    def error_received(self, exc):
+        # ICMP port unreachable from a previous send shows up here as ConnectionRefusedError / ConnectionResetError
+        # same as blocking engine these are suppressed
+        self.gw2miner.socket_errors += 1
+        self.logger.debug(f"socket error: {exc}")
+
+
+async def periodic(interval, func):
+    """
+    call func every interval seconds, starting immediately
+    :param interval: seconds between calls
+    :param func: function with no arguments
+    :return:
+    """
+    while True:
+        func()
+        await asyncio.sleep(interval)
+
+
+async def run_gw2miner(gw2miner):
+    """
+    run GW2Miner forever on the running event loop
+    :param gw2miner: GW2Miner instance, its listening socket is used
+    :return:
+    """
+    loop = asyncio.get_event_loop()
+    gw2miner.sock.setblocking(False)
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: GW2MinerProtocol(gw2miner),
+        sock=gw2miner.sock
+    )
+    if gw2miner.shard:
+        # messages from other workers
+        loop.add_reader(gw2miner.shard.fileno(), protocol.handle_shard_messages)
+    if gw2miner.miner_sockets:
+        # replies of miners on their connected sockets, see src/miner_sockets.py
+        loop.add_reader(gw2miner.miner_sockets.fileno(), protocol.handle_miner_datagrams)
+    tasks = [
+        asyncio.ensure_future(periodic(gw2miner.keepalive_interval, gw2miner.send_keepalive)),
+        asyncio.ensure_future(periodic(gw2miner.stat_interval, gw2miner.send_stats))
+    ]
+    if gw2miner.resolver.ttl > 0 or gw2miner.config_watcher:
+        tasks.append(asyncio.ensure_future(periodic(1, gw2miner.apply_dns_changes)))
+    if gw2miner.config_watcher:
+        tasks.append(asyncio.ensure_future(periodic(gw2miner.config_watcher.interval, gw2miner.check_configs)))
+    if gw2miner.snapshot:
+        tasks.append(asyncio.ensure_future(periodic(gw2miner.snapshot.interval, gw2miner.save_snapshot)))
+    if gw2miner.profiler:
+        tasks.append(asyncio.ensure_future(periodic(1, gw2miner.profiler.poll)))
+    tasks.append(asyncio.ensure_future(periodic(1, gw2miner.tx_tracker.expire)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if gw2miner.shard:
+            loop.remove_reader(gw2miner.shard.fileno())
+        if gw2miner.miner_sockets:
+            loop.remove_reader(gw2miner.miner_sockets.fileno())
+        transport.close()
+
+
+async def run_gw2miners(gw2miners):
+    """
+    run several GW2Miner, one per listener, forever on the running event loop
+    :param gw2miners: list of GW2Miner instances
+    :return:
+    """
+    await asyncio.gather(*(run_gw2miner(gw2miner) for gw2miner in gw2miners))
@@ -0,0 +1,137 @@
+"""
+Optional micro-batching of PUSH_DATA sent to miners.
+
+Instead of one PUSH_DATA per received packet, serialized rxpks for a virtual gateway are held for a short window and
+sent together in one PUSH_DATA rxpk array.  This trades a little latency for fewer datagrams (syscalls, encodes and
+tokens) which matters on small ARM boxes when several gateways report bursts.
+"""
+
+import logging
+import time
+
+from .messages import PUSH_DATA_MAX_SIZE, PUSH_DATA_RXPK_OVERHEAD
+
+
+class _Pending:
+    __slots__ = ('rxpks_raw', 'size', 'deadline', 'added_ts_sum')
+
+    def __init__(self, deadline):
+        self.rxpks_raw = []
+        self.size = PUSH_DATA_RXPK_OVERHEAD - 1  # first rxpk has no separating comma
+        self.deadline = deadline
+        self.added_ts_sum = 0.0
+
+
+class PushDataBatcher:
+    def __init__(self, window=0.02, max_size=1400, clock=time.monotonic):
+        """
+        :param window: seconds the first rxpk of a batch waits for more rxpks
+        :param max_size: max size of PUSH_DATA datagram in bytes, a batch is sent early rather than exceed this
+        :param clock: monotonic clock function, replaceable for testing
+        """
+        if max_size > PUSH_DATA_MAX_SIZE:
+            raise ValueError(f"max PUSH_DATA size {max_size} exceeds packet forwarder limit of {PUSH_DATA_MAX_SIZE} bytes")
+        self.window = window
+        self.max_size = max_size
+        self.clock = clock
+        # keys = VirtualGateway, values = _Pending.  Window is constant so insertion order is also deadline order
+        self.pending = dict()
+        self.logger = logging.getLogger('Batch')
+
+        # counters for stats
+        self.start_ts = clock()
+        self.rxpks = 0
+        self.datagrams = 0
+        self.unbatched_datagrams = 0  # datagrams that would have been sent without batching
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def add(self, vgw, rxpks_raw):
+        """
+        queue serialized rxpks for virtual gateway
+        :param vgw: VirtualGateway the rxpks are for
+        :param rxpks_raw: list of serialized rxpks from VirtualGateway.encode_rxpks
+        :return: list of (data, addr) that must be sent now because the batch is full
+        """
+        if not rxpks_raw:
+            return []
+        ready = []
+        now = self.clock()
+        self.unbatched_datagrams += 1
+        pending = self.pending.get(vgw)
+        for raw in rxpks_raw:
+            if pending and pending.size + len(raw) + 1 > self.max_size:
+                ready.append(self._flush(vgw, now))
+                pending = None
+            if pending is None:
+                pending = self.pending[vgw] = _Pending(now + self.window)
+            pending.rxpks_raw.append(raw)
+            pending.size += len(raw) + 1
+            pending.added_ts_sum += now
+        return ready
+
+    def flush_due(self, now=None):
+        """
+        :param now: monotonic timestamp, defaults to now
+        :return: list of (data, addr) for batches whose window elapsed
+        """
+        return [ready for vgw, ready in self.flush_due_by_vgateway(now)]
+
+    def flush_due_by_vgateway(self, now=None):
+        """
+        :param now: monotonic timestamp, defaults to now
+        :return: list of (VirtualGateway, (data, addr)) for batches whose window elapsed
+        """
+        if now is None:
+            now = self.clock()
+        ready = []
+        while self.pending:
+            vgw, pending = next(iter(self.pending.items()))
+            if pending.deadline > now:
+                break
+            ready.append((vgw, self._flush(vgw, now)))
+        return ready
+
+    def flush_all(self):
+        now = self.clock()
+        return [self._flush(vgw, now) for vgw in list(self.pending)]
+
+    def discard(self, vgw):
+        """
+        drop rxpks pending for virtual gateway, e.g. when it was removed from configs
+        :param vgw: VirtualGateway
+        :return:
+        """
+        self.pending.pop(vgw, None)
+
+    def next_deadline(self):
+        """
+        :return: monotonic timestamp when next batch must be sent or None if nothing is pending
+        """
+        if not self.pending:
+            return None
+        return next(iter(self.pending.values())).deadline
+
+    def _flush(self, vgw, now):
+        pending = self.pending.pop(vgw)
+        count = len(pending.rxpks_raw)
+        self.rxpks += count
+        self.datagrams += 1
+        self.latency_sum += count * now - pending.added_ts_sum
+        self.latency_max = max(self.latency_max, now - pending.deadline + self.window)
+        return vgw.get_PUSH_DATA_rxpks(pending.rxpks_raw)
+
+    def stats(self):
+        """
+        :return: dictionary of batching counters
+        """
+        elapsed = max(self.clock() - self.start_ts, 1e-9)
+        saved = self.unbatched_datagrams - self.datagrams
+        return dict(
+            rxpks=self.rxpks,
+            datagrams=self.datagrams,
+            datagrams_saved=saved,
+            saved_per_sec=saved / elapsed,
+            avg_latency_ms=self.latency_sum / self.rxpks * 1e3 if self.rxpks else 0.0,
+            max_latency_ms=self.latency_max * 1e3
+        )
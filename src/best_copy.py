@@ -0,0 +1,199 @@
+"""
+Optional best-copy selection for transmissions heard by several gateways.
+
+Without it the first copy to arrive over the backhaul is forwarded and later copies are dropped as repeats.  With a hold
+window the first copy of a transmission opens a window, copies from other gateways arriving within the window are
+scored and when the window closes only the best copy is forwarded, with the metadata of the gateway that heard it best.
+The arrival time of the first copy is kept with it so tmst of other virtual gateways is not shifted by the window.
+
+Open windows are kept in a hashed timer wheel so opening and closing a window is O(1) regardless of how many are open.
+"""
+
+import datetime as dt
+import logging
+import math
+import time
+
+from .modify_rxpk import rx_clock
+
+
+def score_rssi(rxpk):
+    return rxpk['rssi']
+
+
+def score_snr(rxpk):
+    return rxpk['lsnr']
+
+
+def score_gps(rxpk):
+    # copies from a gateway with a valid GPS timestamp win, between equal copies the first to arrive is kept
+    return 1 if rx_clock(rxpk)[1] else 0
+
+
+# scorer name: function(rxpk) returning a value, the copy with the highest value is forwarded (first copy on ties)
+SCORERS = dict(rssi=score_rssi, snr=score_snr, gps=score_gps)
+
+
+class TimerWheel:
+    def __init__(self, now, tick=0.001, slots=512):
+        """
+        hashed timer wheel, timers are put in the slot of their deadline tick so scheduling is O(1) and expiring is O(1)
+        per timer plus one step per elapsed tick.  Deadlines further away than slots ticks wait for later revolutions
+        :param now: monotonic timestamp the wheel starts at
+        :param tick: resolution in seconds
+        :param slots: number of slots, slots * tick should cover the usual deadline distance
+        """
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = math.floor(now / tick)  # last tick expired
+        self.count = 0
+
+    def schedule(self, deadline, item):
+        """
+        :param deadline: monotonic timestamp
+        :param item: returned by expire once deadline passed
+        :return:
+        """
+        tick = max(math.ceil(deadline / self.tick), self.current + 1)
+        self.slots[tick % len(self.slots)].append((tick, item))
+        self.count += 1
+
+    def expire(self, now):
+        """
+        :param now: monotonic timestamp
+        :return: list of items whose deadline passed, in deadline order
+        """
+        target = math.floor(now / self.tick)
+        if not self.count:
+            self.current = target
+            return []
+        due = []
+        if target - self.current >= len(self.slots):
+            # idle for more than a revolution, every slot is due once
+            ticks = range(self.current + 1, self.current + 1 + len(self.slots))
+        else:
+            ticks = range(self.current + 1, target + 1)
+        for tick in ticks:
+            index = tick % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            later = [timer for timer in slot if timer[0] > target]
+            if len(later) < len(slot):
+                due.extend(sorted(timer for timer in slot if timer[0] <= target) if later else slot)
+                self.slots[index] = later
+        self.current = target
+        self.count -= len(due)
+        return [item for tick, item in due]
+
+    def next_deadline(self):
+        """
+        :return: monotonic timestamp of the earliest tick with a timer, None if there are no timers
+        """
+        if not self.count:
+            return None
+        for tick in range(self.current + 1, self.current + 1 + len(self.slots)):
+            slot = self.slots[tick % len(self.slots)]
+            if any(timer[0] == tick for timer in slot):
+                return tick * self.tick
+        # only timers more than a revolution away
+        return min(timer[0] for slot in self.slots for timer in slot) * self.tick
+
+
+class _Held:
+    __slots__ = ('rxpk', 'src_mac', 'score', 'received', 'gateways', 'copies')
+
+    def __init__(self, rxpk, src_mac, score, received):
+        self.rxpk = rxpk
+        self.src_mac = src_mac
+        self.score = score
+        self.received = received  # UTC datetime first copy arrived
+        self.gateways = {src_mac}
+        self.copies = 1
+
+
+class BestCopySelector:
+    def __init__(self, window=0.02, scorer='rssi', clock=time.monotonic, tick=0.001, utc_clock=dt.datetime.utcnow):
+        """
+        :param window: seconds to wait for copies after the first copy of a transmission arrived
+        :param scorer: name in SCORERS or function(rxpk) returning a comparable score, highest is forwarded
+        :param clock: monotonic clock function, replaceable for testing
+        :param tick: timer resolution in seconds
+        :param utc_clock: function returning current UTC datetime, the arrival time of held copies
+        """
+        self.window = window
+        self.scorer = SCORERS[scorer] if isinstance(scorer, str) else scorer
+        self.clock = clock
+        self.utc_clock = utc_clock
+        self.wheel = TimerWheel(clock(), tick=tick, slots=max(64, 2 ** math.ceil(math.log2(window / tick + 2))))
+        self.held = dict()  # keys = rxpk key, values = _Held
+        self.logger = logging.getLogger('BestCopy')
+
+        # counters for stats
+        self.transmissions = 0
+        self.replaced = 0  # copies that were better than the copy held before them
+        self.heard_by = dict()  # keys = number of gateways, values = transmissions heard by that many gateways
+
+    def __contains__(self, key):
+        return key in self.held
+
+    def hold(self, key, rxpk, src_mac):
+        """
+        open window for first copy of a transmission
+        :param key: rxpk key, see dedup.rxpk_key
+        :param rxpk: rxpk dictionary
+        :param src_mac: MAC of gateway that received it
+        :return:
+        """
+        self.held[key] = _Held(rxpk, src_mac, self.scorer(rxpk), self.utc_clock())
+        self.wheel.schedule(self.clock() + self.window, key)
+
+    def add_copy(self, key, rxpk, src_mac):
+        """
+        offer another copy of a held transmission
+        :param key: rxpk key
+        :param rxpk: rxpk dictionary
+        :param src_mac: MAC of gateway that received it
+        :return: True if the transmission is held, False if its window already closed
+        """
+        held = self.held.get(key)
+        if held is None:
+            return False
+        held.copies += 1
+        held.gateways.add(src_mac)
+        score = self.scorer(rxpk)
+        if score > held.score:
+            held.rxpk, held.src_mac, held.score = rxpk, src_mac, score
+            self.replaced += 1
+        return True
+
+    def flush_due(self, now=None):
+        """
+        :param now: monotonic timestamp, defaults to now
+        :return: list of (rxpk, src_mac, gateways, received) for transmissions whose window closed, gateways is the
+            number of gateways that heard it and received the UTC datetime the first copy arrived
+        """
+        ready = []
+        for key in self.wheel.expire(self.clock() if now is None else now):
+            held = self.held.pop(key, None)
+            if held is None:
+                continue
+            gateways = len(held.gateways)
+            self.transmissions += 1
+            self.heard_by[gateways] = self.heard_by.get(gateways, 0) + 1
+            ready.append((held.rxpk, held.src_mac, gateways, held.received))
+        return ready
+
+    def next_deadline(self):
+        return self.wheel.next_deadline()
+
+    def stats(self):
+        """
+        :return: dictionary of selection counters
+        """
+        return dict(
+            transmissions=self.transmissions,
+            held=len(self.held),
+            replaced=self.replaced,
+            heard_by=dict(sorted(self.heard_by.items()))
+        )
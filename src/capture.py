@@ -0,0 +1,80 @@
+"""
+Capture of received datagrams to a compact binary log for later replay (see tools/replay.py).
+
+File layout is MAGIC followed by one record per datagram:
+
+    <d  arrival timestamp (unix seconds)
+    B   length of packed ip address (4 or 16)
+    H   source port
+    H   length of datagram
+    packed ip address (socket.inet_pton)
+    datagram
+
+A record cut short by the process being killed is ignored when reading.
+"""
+
+import socket
+import struct
+import time
+
+MAGIC = b'GW2MCAP1'
+_RECORD = struct.Struct('<dBHH')
+_FAMILIES = {4: socket.AF_INET, 16: socket.AF_INET6}
+
+
+def pack_record(ts, data, addr):
+    """
+    :param ts: arrival timestamp
+    :param data: raw datagram
+    :param addr: tuple of (ip, port, ...) of datagram origin
+    :return: bytes of one record
+    """
+    ip = socket.inet_pton(socket.AF_INET6 if ':' in addr[0] else socket.AF_INET, addr[0])
+    return _RECORD.pack(ts, len(ip), addr[1], len(data)) + ip + bytes(data)
+
+
+class CaptureWriter:
+    def __init__(self, path, clock=time.time):
+        """
+        append received datagrams to capture file, a new file starts with MAGIC
+        :param path: path of capture file
+        :param clock: function returning arrival timestamp
+        """
+        self.path = path
+        self.clock = clock
+        self.fd = open(path, 'ab', buffering=64 * 1024)
+        if self.fd.tell() == 0:
+            self.fd.write(MAGIC)
+        self.records = 0
+
+    def write(self, data, addr):
+        self.fd.write(pack_record(self.clock(), data, addr))
+        self.records += 1
+
+    def flush(self):
+        self.fd.flush()
+
+    def close(self):
+        self.fd.close()
+
+
+def read_capture(path):
+    """
+    read records from capture file
+    :param path: path of capture file written by CaptureWriter
+    :return: generator of (ts, data, (ip, port))
+    """
+    with open(path, 'rb') as fd:
+        if fd.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = fd.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            ts, ip_len, port, data_len = _RECORD.unpack(header)
+            if ip_len not in _FAMILIES:
+                raise ValueError(f"corrupt capture file {path}, invalid address length {ip_len}")
+            body = fd.read(ip_len + data_len)
+            if len(body) < ip_len + data_len:
+                return
+            yield ts, body[ip_len:], (socket.inet_ntop(_FAMILIES[ip_len], body[:ip_len]), port)
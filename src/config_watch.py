@@ -0,0 +1,125 @@
+"""
+Detect changes to the virtual gateway config directory so configs can be reloaded without restarting.
+
+On Linux inotify is used (through ctypes, no dependencies) so checking for changes is a single non-blocking read.
+Elsewhere, or if inotify is not available, modification time and size of every config file is compared.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+import time
+
+# inotify constants from sys/inotify.h
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+def list_configs(directory):
+    """
+    :param directory: directory with virtual gateway configs
+    :return: sorted list of paths of json files in directory
+    """
+    paths = []
+    for f in os.listdir(directory):
+        if os.path.isfile(os.path.join(directory, f)) and f[-4:].lower() == 'json':
+            paths.append(os.path.join(directory, f))
+    return sorted(paths)
+
+
+def _load_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class ConfigWatcher:
+    def __init__(self, directory, interval=1.0, use_inotify=True, clock=time.monotonic):
+        """
+        :param directory: directory with virtual gateway configs
+        :param interval: min seconds between checks, also lets an editor finish writing before configs are read
+        :param use_inotify: use inotify if available, otherwise poll modification times
+        :param clock: monotonic clock function
+        """
+        self.directory = directory
+        self.interval = interval
+        self.clock = clock
+        self.logger = logging.getLogger('Config')
+        self.inotify_fd = None
+        libc = _load_inotify() if use_inotify else None
+        if libc:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0 and libc.inotify_add_watch(fd, os.fsencode(directory), _WATCH_MASK) >= 0:
+                self.inotify_fd = fd
+            elif fd >= 0:
+                os.close(fd)
+        self.method = 'inotify' if self.inotify_fd is not None else 'mtime'
+        self.snapshot = self._snapshot()
+        self.last_check = clock()
+
+    def _snapshot(self):
+        snapshot = dict()
+        for path in list_configs(self.directory):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def _read_events(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 4096)
+            except BlockingIOError:
+                return changed
+            # struct inotify_event: int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+            offset = 0
+            while offset + 16 <= len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                if name[-4:].lower() == b'json':
+                    changed = True
+                offset += 16 + length
+
+    def poll(self):
+        """
+        check if configs changed, rate limited to once per interval
+        :return: True if configs were added, removed or modified since last time True was returned
+        """
+        now = self.clock()
+        if now - self.last_check < self.interval:
+            return False
+        self.last_check = now
+        if self.inotify_fd is not None and not self._read_events():
+            return False
+        snapshot = self._snapshot()
+        if snapshot == self.snapshot:
+            return False
+        self.snapshot = snapshot
+        return True
+
+    def config_paths(self):
+        return list_configs(self.directory)
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
@@ -0,0 +1,156 @@
+"""
+De-duplication of received packets heard by multiple gateways.
+
+The same LoRa transmission is usually heard by several gateways and each one sends its own PUSH_DATA.  Only the
+first copy should be forwarded to miners.  Copies arrive within a few seconds of each other (backhaul latency) so
+keys only need to be remembered for a short window.  Entries older than the window are expired and the total number
+of entries is capped so memory stays flat regardless of uptime.
+"""
+
+import struct
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+
+
+_KEY_HEADER = struct.Struct('<dI')
+
+
+def rxpk_key(rxpk):
+    """
+    get key for rx payload that will be unique for each transmission but the same regardless of gateway that
+    received.  spreading factor, coding rate, frequency (rounded to 10kHz), size and data are hashed into a 64 bit int.
+    data is hashed as base64 text without decoding it, only the '=' padding that some forwarders leave out is stripped.
+    The key is the same across processes and restarts so it can be shared between workers and saved to disk
+    :param rxpk: dictionary of rxpk
+    :return: int
+    """
+    raw = _KEY_HEADER.pack(round(rxpk['freq'], 2), rxpk['size']) + \
+        ('%s\0%s\0%s' % (rxpk['datr'], rxpk['codr'], rxpk['data'].rstrip('='))).encode()
+    return int.from_bytes(blake2b(raw, digest_size=8).digest(), 'little')
+
+
+class DedupCache:
+    def __init__(self, ttl=60, max_entries=100000, clock=time.time):
+        """
+        time windowed set of recently seen packet keys
+        :param ttl: seconds a key is remembered after it was first seen
+        :param max_entries: hard cap on number of keys, oldest keys are evicted first once reached
+        :param clock: function returning current unix timestamp, replaceable for testing and benchmarks
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+
+        # keys are kept in insertion order which is also timestamp order so expiry only ever looks at the front
+        self._entries = OrderedDict()
+
+        # counters for stats
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        """
+        check if key was seen inside the ttl window.  Counts a hit or miss
+        :param key: packet key
+        :return: True if key is a repeat
+        """
+        self.expire()
+        if key in self._entries:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def __setitem__(self, key, ts):
+        self.add(key, ts)
+
+    def __getitem__(self, key):
+        return self._entries[key]
+
+    def get(self, key, default=None):
+        return self._entries.get(key, default)
+
+    def add(self, key, ts=None):
+        """
+        record key as seen at ts
+        :param key: packet key
+        :param ts: unix timestamp key was seen, defaults to now
+        :return:
+        """
+        if ts is None:
+            ts = self.clock()
+        if key in self._entries:
+            # re-adding refreshes the timestamp, move to back to keep entries ordered by time
+            self._entries.move_to_end(key)
+        self._entries[key] = ts
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def expire(self, now=None):
+        """
+        drop all keys older than ttl.  Amortized O(1) per key as each key is removed at most once
+        :param now: current unix timestamp, defaults to now
+        :return: number of keys removed
+        """
+        if not self._entries:
+            return 0
+        if now is None:
+            now = self.clock()
+        cutoff = now - self.ttl
+        entries = self._entries
+        removed = 0
+        while entries:
+            key = next(iter(entries))
+            if entries[key] > cutoff:
+                break
+            del entries[key]
+            removed += 1
+        self.expired += removed
+        return removed
+
+    def clear(self):
+        self._entries.clear()
+
+    def items(self):
+        return self._entries.items()
+
+    def columns(self):
+        """
+        copy of all entries for snapshots.  Keys are read in dictionary storage order which is much faster than the
+        linked order of the OrderedDict, so entries are not sorted by timestamp
+        :return: tuple of (list of keys, list of timestamps)
+        """
+        return list(dict.keys(self._entries)), list(dict.values(self._entries))
+
+    def restore(self, entries):
+        """
+        add entries from a snapshot, entries outside the ttl window are skipped
+        :param entries: iterable of (key, ts) in any order
+        :return: number of entries added
+        """
+        cutoff = self.clock() - self.ttl
+        fresh = sorted((entry for entry in entries if entry[1] > cutoff), key=lambda entry: entry[1])
+        for key, ts in fresh:
+            self.add(key, ts)
+        return len(fresh)
+
+    def stats(self):
+        """
+        :return: dictionary of cache counters
+        """
+        lookups = self.hits + self.misses
+        return dict(
+            size=len(self._entries),
+            hits=self.hits,
+            misses=self.misses,
+            expired=self.expired,
+            evictions=self.evictions,
+            hit_ratio=self.hits / lookups if lookups else 0.0
+        )
@@ -0,0 +1,223 @@
+"""
+Choose which physical gateway transmits a miner's PULL_RESP.
+
+Without a scheduler a transmit command can only go to the gateway whose MAC equals the MAC of the miner's virtual
+gateway.  The scheduler indexes which gateways recently heard each device (DevAddr of data uplinks, DevEUI of join
+requests) at what RSSI/SNR from the rxpks passing through GW2Miner, and sends a downlink for a device through the
+gateway that heard it best.  Downlinks that cannot be matched to a device (e.g. PoC packets) keep the old behavior.
+
+Miners address a downlink with a tmst on their virtual gateway's clock.  Each gateway's tmst counter runs at a fixed
+offset from microseconds since midnight UTC (see modify_rxpk.rx_clock), the scheduler learns that offset per gateway so
+tmst can be converted to the clock of the gateway chosen.  Airtime already given to a gateway is remembered so two
+downlinks overlapping on one gateway go to the next best gateway instead of colliding.
+
+All lookups are dictionary lookups, the device index is an LRU capped at max_devices.  With multiple workers each
+worker observes the copies it received and shares what it learned (see observe and apply), so every worker's index
+covers all gateways whichever worker handles the miner's PULL_RESP.
+"""
+
+import base64
+import binascii
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+
+from .modify_rxpk import rx_clock
+
+# LoRaWAN MHDR message types
+MTYPE_JOIN_REQUEST = 0
+MTYPE_JOIN_ACCEPT = 1
+MTYPES_DATA = (2, 3, 4, 5)  # unconfirmed/confirmed data up/down, DevAddr follows MHDR
+
+JOIN_ACCEPT_DELAYS_US = (5000000, 6000000)  # join accept is sent 5s (RX1) or 6s (RX2) after join request
+JOIN_MATCH_TOLERANCE_US = 100000  # max difference between expected and recorded join request time
+OFFSET_REFRESH = 60  # seconds between updates of a gateway's tmst offset
+RESERVATION_TTL = 30  # seconds a scheduled transmission is remembered for collision checks
+
+_U32 = 2 ** 32
+
+
+def parse_device(data):
+    """
+    :param data: base64 LoRaWAN PHYPayload of rxpk or txpk
+    :return: tuple of (mtype, device) where device is DevAddr (data frames) or DevEUI (join requests) bytes, device is
+        None for other message types.  (None, None) if data is not LoRaWAN
+    """
+    try:
+        head = base64.b64decode(data[:24])
+    except (ValueError, binascii.Error):
+        return None, None
+    if not head:
+        return None, None
+    mtype = head[0] >> 5
+    if mtype in MTYPES_DATA and len(head) >= 5:
+        return mtype, head[1:5]
+    if mtype == MTYPE_JOIN_REQUEST and len(head) >= 17:
+        return mtype, head[9:17]
+    return mtype, None
+
+
+def lora_airtime(datr, codr, size, preamble=8):
+    """
+    time on air of a LoRa packet with explicit header and CRC (Semtech AN1200.13)
+    :param datr: e.g. 'SF9BW125'
+    :param codr: e.g. '4/5'
+    :param size: payload bytes
+    :param preamble: preamble symbols
+    :return: seconds
+    """
+    sf, bw = datr[2:].split('BW')
+    sf, bw = int(sf), int(bw) * 1000
+    t_sym = 2 ** sf / bw
+    de = 1 if t_sym > 0.016 else 0  # low data rate optimization
+    cr = int(codr.split('/')[1]) - 4
+    payload_symbols = 8 + max(math.ceil((8 * size - 4 * sf + 28 + 16) / (4 * (sf - 2 * de))) * (cr + 4), 0)
+    return (preamble + 4.25 + payload_symbols) * t_sym
+
+
+def _signed(diff):
+    return (diff + 2 ** 31) % _U32 - 2 ** 31
+
+
+class DownlinkScheduler:
+    def __init__(self, max_devices=10000, max_age=900, clock=time.time):
+        """
+        :param max_devices: max devices in index, least recently heard are forgotten first
+        :param max_age: seconds after which a gateway hearing a device is no longer used for its downlinks
+        :param clock: unix time function, replaceable for testing
+        """
+        self.max_devices = max_devices
+        self.max_age = max_age
+        self.clock = clock
+        self.devices = OrderedDict()  # keys = DevAddr/DevEUI bytes, values = dict of gateway MAC -> (lsnr, rssi, ts)
+        self.offsets = dict()  # keys = gateway MAC, values = (tmst offset to us since midnight UTC, ts learned)
+        self.joins = deque(maxlen=64)  # recent join requests as (us since midnight UTC, DevEUI)
+        self.reservations = dict()  # keys = gateway MAC, values = deque of (start tmst, end tmst, data, expiry ts)
+        self.results = dict()  # keys = result of schedule, values = count
+        self.logger = logging.getLogger('Downlink')
+
+    def observe(self, rxpk, src_mac):
+        """
+        record that gateway src_mac heard rxpk
+        :param rxpk: rxpk dictionary
+        :param src_mac: MAC of gateway that received rxpk
+        :return: tuple of (device, lsnr, rssi, tmst offset, join request us since midnight UTC) that was recorded, the
+            offset and join time are None unless they were learned from rxpk.  Other workers record it with apply
+        """
+        now = self.clock()
+        offset = self.offsets.get(src_mac)
+        mtype, device = parse_device(rxpk['data'])
+        tmst_offset = join_us = None
+        if offset is None or now - offset[1] > OFFSET_REFRESH or mtype == MTYPE_JOIN_REQUEST:
+            elapsed_us, gps_valid = rx_clock(rxpk)
+            tmst_offset = (rxpk['tmst'] - elapsed_us) % _U32
+            if mtype == MTYPE_JOIN_REQUEST and device is not None:
+                join_us = elapsed_us
+        self.apply(src_mac, device, rxpk['lsnr'], rxpk['rssi'], tmst_offset, join_us)
+        return device, rxpk['lsnr'], rxpk['rssi'], tmst_offset, join_us
+
+    def apply(self, src_mac, device, lsnr, rssi, tmst_offset=None, join_us=None):
+        """
+        record an uplink observed by this or another worker, see observe
+        :param src_mac: MAC of gateway that received the uplink
+        :param device: DevAddr or DevEUI bytes, None if uplink has no device
+        :param lsnr: SNR of uplink
+        :param rssi: RSSI of uplink
+        :param tmst_offset: offset of gateway tmst to us since midnight UTC, None to keep the known offset
+        :param join_us: us since midnight UTC of a join request, None for other uplinks
+        :return:
+        """
+        now = self.clock()
+        if tmst_offset is not None:
+            self.offsets[src_mac] = (tmst_offset, now)
+        if device is None:
+            return
+        if join_us is not None:
+            self.joins.append((join_us, device))
+        heard = self.devices.get(device)
+        if heard is None:
+            heard = self.devices[device] = dict()
+            if len(self.devices) > self.max_devices:
+                self.devices.popitem(last=False)
+        else:
+            self.devices.move_to_end(device)
+        heard[src_mac] = (lsnr, rssi, now)
+
+    def _device_for(self, txpk, mtype, device, vgw_offset):
+        if device is not None or mtype != MTYPE_JOIN_ACCEPT or 'tmst' not in txpk:
+            return device
+        # join accept is encrypted, match it to the join request it answers by time
+        sent_us = (txpk['tmst'] - vgw_offset) % _U32
+        for elapsed_us, dev_eui in reversed(self.joins):
+            for delay in JOIN_ACCEPT_DELAYS_US:
+                if abs(_signed(sent_us - delay - elapsed_us)) < JOIN_MATCH_TOLERANCE_US:
+                    return dev_eui
+        return None
+
+    def candidates(self, device):
+        """
+        :param device: DevAddr or DevEUI bytes
+        :return: list of gateway MACs that heard device within max_age, best first
+        """
+        heard = self.devices.get(device)
+        if not heard:
+            return []
+        cutoff = self.clock() - self.max_age
+        return [mac for (lsnr, rssi, ts), mac in sorted(
+            ((quality, mac) for mac, quality in heard.items() if quality[2] > cutoff), reverse=True)]
+
+    def schedule(self, txpk, vgw_mac, vgw_offset, gateways):
+        """
+        choose gateway to transmit txpk
+        :param txpk: txpk dictionary from PULL_RESP of miner, not modified
+        :param vgw_mac: MAC of virtual gateway of miner, the gateway used if device is unknown
+        :param vgw_offset: tmst offset of virtual gateway clock (RXMetadataModification.tmst_offset)
+        :param gateways: gateways that can be reached, MAC -> (ip, port)
+        :return: tuple of (gateway MAC or None, tmst on clock of that gateway or None if txpk has no tmst, result) where
+            result is 'device', 'fallback', 'collision', 'duplicate' or 'no_gateway'
+        """
+        mtype, device = parse_device(txpk.get('data', ''))
+        device = self._device_for(txpk, mtype, device, vgw_offset)
+        heard_by = [mac for mac in self.candidates(device) if mac in gateways] if device is not None else []
+        candidates = heard_by if vgw_mac in heard_by or vgw_mac not in gateways else heard_by + [vgw_mac]
+
+        collided = False
+        for mac in candidates:
+            tmst = txpk.get('tmst')
+            if tmst is not None and mac != vgw_mac:
+                offset = self.offsets.get(mac)
+                if offset is None:
+                    continue  # clock of this gateway is unknown
+                tmst = (tmst - vgw_offset + offset[0]) % _U32
+            if tmst is not None and not txpk.get('imme'):
+                conflict = self._reserve(mac, tmst, txpk)
+                if conflict == 'duplicate':
+                    return self._result(None, None, 'duplicate')
+                if conflict:
+                    collided = True
+                    continue
+            return self._result(mac, tmst, 'device' if mac in heard_by else 'fallback')
+        return self._result(None, None, 'collision' if collided else 'no_gateway')
+
+    def _reserve(self, mac, tmst, txpk):
+        now = self.clock()
+        reservations = self.reservations.setdefault(mac, deque())
+        while reservations and reservations[0][3] < now:
+            reservations.popleft()
+        end = (tmst + int(lora_airtime(txpk['datr'], txpk['codr'], txpk['size']) * 1e6)) % _U32
+        for start_r, end_r, data, expiry in reservations:
+            if _signed(tmst - end_r) < 0 and _signed(start_r - end) < 0:
+                return 'duplicate' if start_r == tmst and data == txpk.get('data') else 'collision'
+        reservations.append((tmst, end, txpk.get('data'), now + RESERVATION_TTL))
+        return None
+
+    def _result(self, mac, tmst, result):
+        self.results[result] = self.results.get(result, 0) + 1
+        return mac, tmst, result
+
+    def stats(self):
+        """
+        :return: dictionary of scheduler counters
+        """
+        return dict(devices=len(self.devices), gateways=len(self.offsets), **self.results)
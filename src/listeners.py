@@ -0,0 +1,170 @@
+"""
+Several isolated gateway-to-miner groups (listeners) in one process.
+
+Each listener is its own GW2Miner with its own listening socket, de-duplication cache, gateway addresses and virtual
+gateways, so fleets never see each other's packets.  ListenerGroup waits on all listening sockets with one selector
+and hands readable sockets to their GW2Miner, the asyncio engine creates one datagram endpoint per listener instead.
+Listeners are declared in a JSON file passed with --listeners:
+
+    {"listeners": [
+        {"name": "east", "port": 1680, "configs": "gw_configs/east/"},
+        {"name": "west", "host": "::", "port": 1681, "configs": "gw_configs/west/"}
+    ]}
+
+host defaults to 0.0.0.0.  An IPv6 host listens dual-stack so gateways and miners on IPv4 are still reachable, their
+addresses are converted to plain (ip, port) tuples as received and back to IPv4-mapped IPv6 when sending, so the rest of
+GW2Miner only sees (ip, port) tuples.
+"""
+
+import json
+import logging
+import selectors
+import socket
+
+_MAPPED_PREFIX = '::ffff:'
+
+
+def open_listening_socket(host, port, reuseport=False):
+    """
+    :param host: address to bind, IPv6 if it contains ':'
+    :param port: port to bind
+    :param reuseport: set SO_REUSEPORT so worker processes can share the port
+    :return: non-blocking bound UDP socket
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    if family == socket.AF_INET6:
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    if reuseport:
+        # all workers listen on same port, kernel distributes datagrams between them
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+
+def from_sockaddr(addr):
+    """
+    :param addr: address from an IPv6 socket, (ip, port, flowinfo, scope_id)
+    :return: (ip, port) with IPv4-mapped addresses as plain IPv4
+    """
+    ip = addr[0]
+    if ip.startswith(_MAPPED_PREFIX) and '.' in ip:
+        ip = ip[len(_MAPPED_PREFIX):]
+    return ip, addr[1]
+
+
+def to_sockaddr(addr):
+    """
+    :param addr: (ip, port) with IPv4 or IPv6 ip
+    :return: address an IPv6 socket can send to
+    """
+    if ':' in addr[0]:
+        return addr
+    return _MAPPED_PREFIX + addr[0], addr[1]
+
+
+class ListenerConfig:
+    __slots__ = ('name', 'host', 'port', 'configs')
+
+    def __init__(self, name, host, port, configs):
+        """
+        :param name: name of listener, used in logger names, metrics labels and snapshot/capture file names
+        :param host: address to bind
+        :param port: port to bind
+        :param configs: directory of virtual gateway configs of this listener
+        """
+        self.name = name
+        self.host = host
+        self.port = port
+        self.configs = configs
+
+
+def load_listeners(path):
+    """
+    :param path: JSON file with a "listeners" list, see module docstring
+    :return: list of ListenerConfig
+    :raises ValueError: if listeners are malformed, names or addresses are repeated
+    :raises OSError: if file cannot be read
+    """
+    with open(path, 'r') as fd:
+        raw = json.load(fd)
+    if not isinstance(raw, dict) or not isinstance(raw.get('listeners'), list) or not raw['listeners']:
+        raise ValueError(f"{path} must contain a non-empty \"listeners\" list")
+    listeners = []
+    for i, entry in enumerate(raw['listeners']):
+        try:
+            listener = ListenerConfig(str(entry.get('name', i)), str(entry.get('host', '0.0.0.0')), int(entry['port']),
+                                      str(entry['configs']))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise ValueError(f"invalid listener {entry}, port and configs are required")
+        if any(other.name == listener.name for other in listeners):
+            raise ValueError(f"listener name {listener.name} used twice")
+        if any((other.host, other.port) == (listener.host, listener.port) for other in listeners):
+            raise ValueError(f"listener address {listener.host}:{listener.port} used twice")
+        listeners.append(listener)
+    return listeners
+
+
+class ListenerGroup:
+    def __init__(self, names, gw2miners):
+        """
+        :param names: name of each listener
+        :param gw2miners: GW2Miner of each listener, same order as names
+        """
+        self.names = names
+        self.gw2miners = gw2miners
+        self.selector = selectors.DefaultSelector()
+        for gw2miner in gw2miners:
+            self.selector.register(gw2miner.sock, selectors.EVENT_READ, gw2miner)
+            if gw2miner.miner_sockets:
+                self.selector.register(gw2miner.miner_sockets, selectors.EVENT_READ, gw2miner)
+        self.logger = logging.getLogger('Listen')
+
+    def run(self):
+        """
+        infinite loop forwarding packets of all listeners
+        :return:
+        """
+        self.logger.info(f"forwarding for {len(self.gw2miners)} listeners: {', '.join(self.names)}")
+        try:
+            while True:
+                self.run_once()
+        finally:
+            self.selector.close()
+
+    def run_once(self, timeout=5):
+        """
+        same steps as one iteration of GW2Miner.run, for each listener whose socket is readable
+        :param timeout: max seconds to wait for a datagram
+        :return: number of listeners that received datagrams
+        """
+        for gw2miner in self.gw2miners:
+            gw2miner.run_timers()
+        events = self.selector.select(min(gw2miner.poll_timeout(timeout) for gw2miner in self.gw2miners))
+        for key, _ in events:
+            gw2miner = key.data
+            if key.fileobj is gw2miner.miner_sockets:
+                gw2miner.handle_miner_datagrams()
+                continue
+            for msg, addr in gw2miner.receive_messages():
+                gw2miner.handle_message(msg, addr)
+                if gw2miner.timer:
+                    gw2miner.timer.commit()
+        for gw2miner in self.gw2miners:
+            gw2miner.service_queues()
+            if gw2miner.timer:
+                gw2miner.timer.commit()
+        return len(events)
+
+    def collect_metrics(self):
+        """
+        metrics of all listeners with a listener label, called from metrics server thread
+        :return: list of metric families for metrics.format_prometheus
+        """
+        families = dict()
+        for name, gw2miner in zip(self.names, self.gw2miners):
+            for family, kind, help_text, samples in gw2miner.collect_metrics():
+                merged = families.setdefault(family, (family, kind, help_text, []))
+                merged[3].extend((dict(labels, listener=name), value) for labels, value in samples)
+        return list(families.values())
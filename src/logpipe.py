@@ -0,0 +1,198 @@
+"""
+Logging that does not block the packet loop.
+
+Records are put on a bounded queue by QueueHandler and written to the rotating log file and console by a
+QueueListener thread.  Messages are formatted on that thread too, so a per-packet call like
+
+    logger.debug("new packet [%sB]: %016X", rxpk.get('size'), key)
+
+only costs a level check when debug is off and building a LogRecord when it is on.  When the queue is full (disk
+stalled) records are dropped and counted instead of stalling forwarding, a "dropped N log messages" warning follows
+once there is room again.
+
+RateLimitFilter limits each call site (file and line) to a number of messages per second with a token bucket, errors
+always pass.  Suppressed messages are counted and summarized once per interval.
+"""
+
+import logging
+import logging.handlers
+import queue
+import time
+
+LOG_FORMAT = '%(asctime)s.%(msecs)03d %(name)-6s:[%(levelname)-8s] %(message)s'
+DATE_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue, lazy=True):
+        """
+        :param log_queue: queue.Queue or multiprocessing Queue with maxsize set
+        :param lazy: leave message formatting to the listener thread, requires a queue within the process because
+            arguments of records are not pickled
+        """
+        super().__init__(log_queue)
+        self.lazy = lazy
+        self.dropped = 0  # records dropped since last successful put
+        self.dropped_total = 0
+
+    def prepare(self, record):
+        """
+        unlike QueueHandler.prepare the message is not formatted here unless records leave the process
+        """
+        if record.exc_info:
+            # tracebacks keep frames alive and cannot be pickled, format them now
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if not self.lazy:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.dropped_total += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            notice = logging.LogRecord('Log', logging.WARNING, __file__, 0,
+                                       "dropped %d log messages, log queue was full", (dropped,), None)
+            try:
+                self.queue.put_nowait(notice)
+            except queue.Full:
+                self.dropped = dropped
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate=20, burst=None, interval=60, clock=time.monotonic):
+        """
+        :param rate: messages per second allowed from each call site
+        :param burst: messages a call site can log at once, defaults to rate
+        :param interval: seconds between summaries of suppressed messages
+        :param clock: monotonic time function, replaceable for testing
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.interval = interval
+        self.clock = clock
+        self.buckets = dict()  # (pathname, lineno) -> [tokens, last refill ts]
+        self.suppressed = dict()  # (pathname, lineno) -> [count, logger name, message template]
+        self.last_summary = clock()
+        self.summarizing = False
+        self.logger = logging.getLogger('Log')
+
+    def filter(self, record):
+        if self.summarizing or record.levelno >= logging.ERROR:
+            return True
+        now = self.clock()
+        if now - self.last_summary >= self.interval:
+            self.flush_summaries(now)
+        site = (record.pathname, record.lineno)
+        bucket = self.buckets.get(site)
+        if bucket is None:
+            bucket = self.buckets[site] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        entry = self.suppressed.get(site)
+        if entry is None:
+            self.suppressed[site] = [1, record.name, record.msg]
+        else:
+            entry[0] += 1
+        return False
+
+    def flush_summaries(self, now=None):
+        """
+        log one warning per call site that had messages suppressed since the last summary
+        :param now: current clock value
+        :return:
+        """
+        self.last_summary = self.clock() if now is None else now
+        suppressed, self.suppressed = self.suppressed, dict()
+        self.summarizing = True
+        try:
+            for count, name, msg in suppressed.values():
+                self.logger.warning("suppressed %d messages from %s like: %.80s", count, name, msg)
+        finally:
+            self.summarizing = False
+
+
+class LogPipeline:
+    def __init__(self, handlers, level=logging.INFO, max_queue=10000, rate=20, interval=60):
+        """
+        :param handlers: handlers doing I/O, called from the listener thread
+        :param level: root logger level
+        :param max_queue: records waiting to be written before new ones are dropped
+        :param rate: messages per second allowed from each call site, 0 for no limit
+        :param interval: seconds between summaries of rate limited messages
+        """
+        self.handlers = handlers
+        self.level = level
+        self.max_queue = max_queue
+        self.handler = NonBlockingQueueHandler(queue.Queue(max_queue))
+        self.rate_limit = None
+        if rate:
+            self.rate_limit = RateLimitFilter(rate, interval=interval)
+            self.handler.addFilter(self.rate_limit)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, *handlers, respect_handler_level=True)
+        self.running = False
+
+    def start(self):
+        root = logging.getLogger()
+        root.setLevel(self.level)
+        root.addHandler(self.handler)
+        self.listener.start()
+        self.running = True
+        return self
+
+    def stop(self):
+        """
+        write suppressed message summaries and everything still queued, then stop the listener thread
+        :return:
+        """
+        if self.rate_limit:
+            self.rate_limit.flush_summaries()
+        if self.running:
+            self.listener.stop()
+            self.running = False
+        logging.getLogger().removeHandler(self.handler)
+        for handler in self.handlers:
+            handler.close()
+
+    def share_with_children(self, ctx):
+        """
+        switch to a multiprocessing queue so forked worker processes log through this process' listener.  Messages are
+        then formatted before they are queued since arguments may not be picklable
+        :param ctx: multiprocessing context used to start workers
+        :return:
+        """
+        self.listener.stop()
+        self.handler.queue = self.listener.queue = ctx.Queue(self.max_queue)
+        self.handler.lazy = False
+        self.listener.start()
+
+
+def configure_pipeline(path='middleman.log', debug=False, max_bytes=10 * 1024 * 1024, backups=5, rate=20,
+                       max_queue=10000):
+    """
+    :param path: log file, rotated at max_bytes
+    :param debug: log debug messages
+    :param max_bytes: size at which the log file is rotated, 0 to never rotate
+    :param backups: rotated files kept
+    :param rate: messages per second allowed from each call site, 0 for no limit
+    :param max_queue: records waiting to be written before new ones are dropped
+    :return: started LogPipeline
+    """
+    level = logging.DEBUG if debug else logging.INFO
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
+    handlers = [logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+    return LogPipeline(handlers, level=level, max_queue=max_queue, rate=rate).start()
@@ -2,6 +2,9 @@
 """
 Parses messages as defined in https://github.com/Lora-net/packet_forwarder/blob/master/PROTOCOL.TXT
 
+Decoding works on a memoryview of the datagram so header fields and MAC are read without copying the datagram,
+headers use precompiled structs and MAC address string conversions are cached.  If orjson is installed it is used
+for JSON payloads, otherwise the standard library json module is used.
 """
 
 
@@ -12,9 +15,98 @@ import random
 import struct
 import time
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_HEADER = struct.Struct("=BHB")     # version, token, identifier
+_TOKEN = struct.Struct("=H")
+_MAC = struct.Struct("=BBBBBBBB")
+
+# JSON backend
+# =============================
+def _stdlib_loads(data):
+    if not isinstance(data, (bytes, str)):
+        data = str(data, 'utf-8')
+    return json.loads(data)
+
+_stdlib_encoder = json.JSONEncoder(separators=(',', ':'))
+
+def _stdlib_dumps(obj):
+    return _stdlib_encoder.encode(obj).encode()
+
+json_loads = _stdlib_loads
+json_dumps = _stdlib_dumps
+json_backend = 'json'
+
+def use_json_backend(name=None):
+    """
+    select library used for JSON payloads
+    :param name: 'orjson', 'json' or None for fastest available
+    :return: name of backend in use
+    """
+    global json_loads, json_dumps, json_backend
+    if name is None:
+        name = 'orjson' if orjson else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError("orjson is not installed")
+        json_loads, json_dumps = orjson.loads, orjson.dumps
+    elif name == 'json':
+        json_loads, json_dumps = _stdlib_loads, _stdlib_dumps
+    else:
+        raise ValueError(f"unknown JSON backend {name}")
+    json_backend = name
+    return name
+
+use_json_backend()
+
+# stat only PUSH_DATA decoded with skip_stat, every this many of them are still parsed to catch invalid payloads, 0 to
+# never parse them
+STAT_VALIDATE_INTERVAL = 100
+_stat_skipped = 0
+
+# MAC address conversion
+# =============================
+# gateways and virtual gateways are a small fixed set so conversions are cached, caches are cleared if they grow
+# past this size to keep memory bounded if junk datagrams with random MACs are received
+MAC_CACHE_MAX = 4096
+_mac_str_cache = dict()     # keys = 8 raw bytes, values = ':' separated hex string
+_mac_bytes_cache = dict()   # keys = ':' separated hex string, values = 8 raw bytes
+
+def mac_to_bytes(mac):
+    """
+    :param mac: ':' separated hex string
+    :return: 8 raw bytes
+    """
+    raw = _mac_bytes_cache.get(mac)
+    if raw is None:
+        raw = _MAC.pack(*[int(x, 16) for x in mac.split(':')])
+        if len(_mac_bytes_cache) >= MAC_CACHE_MAX:
+            _mac_bytes_cache.clear()
+        _mac_bytes_cache[mac] = raw
+    return raw
+
+def mac_from_bytes(raw):
+    """
+    :param raw: 8 raw bytes
+    :return: ':' separated upper case hex string
+    """
+    mac = _mac_str_cache.get(raw)
+    if mac is None:
+        mac = ':'.join([f"{x:02X}" for x in raw])
+        if len(_mac_str_cache) >= MAC_CACHE_MAX:
+            _mac_str_cache.clear()
+        _mac_str_cache[raw] = mac
+    return mac
+
+
 class Message:
     IDENT = 0xFF
     NAME = "None"
+    ACK = None      # identifier byte of ack sent in response, None if message is not acked
 
     def __init__(self, data=b''):
 
@@ -25,49 +117,86 @@ class Message:
             self.data = data
         if not self.data or len(self.data) < 4 or self.data[3] != self.IDENT:
             raise ValueError(f"invalid message {data}")
+        return self.decode_body(memoryview(self.data))
 
-        if len(self.data) < 4:
-            raise ValueError(f"invalid {self.NAME} message")
+    def encode(self, message_object):
+        self.data = self.encode_body(message_object)
+        return self.data
+
+    def ack(self):
+        return self.ack_body(self.data)
+
+    @classmethod
+    def decode_body(cls, view):
+        """
+        decode datagram, identifier must already be validated
+        :param view: memoryview (or bytes) of datagram
+        :return: message dictionary
+        """
         result = dict(
-            ver=self.data[0],
-            token=struct.unpack_from('H', self.data[1:])[0],
-            identifier=self.data[3],
-            _NAME_=self.NAME,
+            ver=view[0],
+            token=_TOKEN.unpack_from(view, 1)[0],
+            identifier=view[3],
+            _NAME_=cls.NAME,
             _UNIX_TS_=time.time()
         )
         return result
 
-    def encode(self, message_object):
-        self.data = struct.pack("=BHB", message_object.get('ver', 2), message_object.get('token'), message_object.get('identifier'))
-        return self.data
+    @classmethod
+    def encode_body(cls, message_object):
+        return _HEADER.pack(message_object.get('ver', 2), message_object.get('token'), message_object.get('identifier', cls.IDENT))
 
-    def ack(self):
-        return None
+    @classmethod
+    def ack_body(cls, view):
+        """
+        :param view: received datagram
+        :return: ack datagram for received datagram or None
+        """
+        if cls.ACK is None:
+            return None
+        return bytes(view[:3]) + cls.ACK
 
 class MsgPushData(Message):
     IDENT = 0x00
     NAME = "PUSH_DATA"
+    ACK = bytes([0x01])
 
-    def decode(self, data=None):
-        result = super().decode(data)
-        if len(self.data) < 14:
-            raise ValueError(f"invalid {self.NAME} message, too short {len(self.data)}/14 bytes")
+    @classmethod
+    def decode_body(cls, view):
+        result = super().decode_body(view)
+        if len(view) < 14:
+            raise ValueError(f"invalid {cls.NAME} message, too short {len(view)}/14 bytes")
 
-        result['MAC'] = ':'.join([f"{x:02X}" for x in self.data[4:12]])
-        result['data'] = json.loads(self.data[12:].decode())
+        result['MAC'] = mac_from_bytes(bytes(view[4:12]))
+        result['data'] = json_loads(view[12:])
         return result
 
-    def encode(self, message_object):
-        super().encode(message_object)
-        # add MAC address
-        self.data += struct.pack('=BBBBBBBB', *[int(x, 16) for x in message_object['MAC'].split(':')])
-        # add json payload
-        self.data += json.dumps(message_object['data']).encode()
-        return self.data
+    @classmethod
+    def decode_body_skip_stat(cls, view):
+        """
+        decode datagram like decode_body but stat only messages (no rxpk) decode to empty data without parsing the JSON
+        payload.  Every STAT_VALIDATE_INTERVAL th of them is still parsed so invalid payloads raise ValueError
+        :param view: memoryview (or bytes) of datagram
+        :return: message dictionary
+        """
+        global _stat_skipped
+        if b'"rxpk"' in bytes(view[12:]):
+            return cls.decode_body(view)
+        result = super().decode_body(view)
+        if len(view) < 14:
+            raise ValueError(f"invalid {cls.NAME} message, too short {len(view)}/14 bytes")
+
+        result['MAC'] = mac_from_bytes(bytes(view[4:12]))
+        _stat_skipped += 1
+        if STAT_VALIDATE_INTERVAL and _stat_skipped % STAT_VALIDATE_INTERVAL == 0:
+            json_loads(view[12:])
+        result['data'] = dict()
+        return result
 
-    def ack(self):
-        ack = self.data[:3] + bytes([0x01])
-        return ack
+    @classmethod
+    def encode_body(cls, message_object):
+        # header, MAC address and json payload
+        return super().encode_body(message_object) + mac_to_bytes(message_object['MAC']) + json_dumps(message_object['data'])
 
 class MsgPushAck(Message):
     IDENT = 0x01
@@ -76,26 +205,23 @@ class MsgPushAck(Message):
 class MsgPullData(Message):
     IDENT = 0x02
     NAME = "PULL_DATA"
+    ACK = bytes([0x04])
 
-    def decode(self, data=None):
+    @classmethod
+    def decode_body(cls, view):
 
-        result = super().decode(data)
-        if len(self.data) < 12:
-            raise ValueError(f"invalid {self.NAME} message, too short {len(self.data)}/12 bytes")
+        result = super().decode_body(view)
+        if len(view) < 12:
+            raise ValueError(f"invalid {cls.NAME} message, too short {len(view)}/12 bytes")
 
-        result['MAC'] = ':'.join([f"{x:02X}" for x in self.data[4:12]])
+        result['MAC'] = mac_from_bytes(bytes(view[4:12]))
 
         return result
 
-    def encode(self, message_object):
-        super().encode(message_object)
-        # add MAC address
-        self.data += struct.pack('=BBBBBBBB', *[int(x, 16) for x in message_object['MAC'].split(':')])
-        return self.data
-
-    def ack(self):
-        ack = self.data[:3] + bytes([0x04])
-        return ack
+    @classmethod
+    def encode_body(cls, message_object):
+        # header and MAC address
+        return super().encode_body(message_object) + mac_to_bytes(message_object['MAC'])
 
 class MsgPullAck(Message):
     IDENT = 0x04
@@ -106,44 +232,46 @@ class MsgPullResp(Message):
     IDENT = 0x03
     NAME = "PULL_RESP"
 
-    def decode(self, data=None):
+    @classmethod
+    def decode_body(cls, view):
 
-        result = super().decode(data)
-        if len(self.data) < 14:
-            raise ValueError(f"invalid {self.NAME} message, too short {len(self.data)}/14 bytes")
+        result = super().decode_body(view)
+        if len(view) < 14:
+            raise ValueError(f"invalid {cls.NAME} message, too short {len(view)}/14 bytes")
 
-        result['data'] = json.loads(self.data[4:].decode())
+        result['data'] = json_loads(view[4:])
         return result
 
-    def encode(self, message_object):
-        super().encode(message_object)
-        # add json payload
-        self.data += json.dumps(message_object['data']).encode()
-        return self.data
+    @classmethod
+    def encode_body(cls, message_object):
+        # header and json payload
+        return super().encode_body(message_object) + json_dumps(message_object['data'])
 
 
 class MsgTxAck(Message):
     IDENT = 0x05
     NAME = "TX_ACK"
-    def decode(self, data=None):
 
-        result = super().decode(data)
-        if len(self.data) < 12:
-            raise ValueError(f"invalid {self.NAME} message, too short {len(self.data)}/12 bytes")
+    @classmethod
+    def decode_body(cls, view):
+
+        result = super().decode_body(view)
+        if len(view) < 12:
+            raise ValueError(f"invalid {cls.NAME} message, too short {len(view)}/12 bytes")
 
 
-        result['MAC'] = ':'.join([f"{x:02X}" for x in self.data[4:12]])
-        if len(self.data) > 14:
-            result['data'] = json.loads(self.data[12:].decode())
+        result['MAC'] = mac_from_bytes(bytes(view[4:12]))
+        if len(view) > 14:
+            result['data'] = json_loads(view[12:])
         return result
 
-    def encode(self, message_object):
-        super().encode(message_object)
-        # add MAC address
-        self.data += struct.pack('=BBBBBBBB', *[int(x, 16) for x in message_object['MAC'].split(':')])
-        # add json payload
-        self.data += json.dumps(message_object['data']).encode()
-        return self.data
+    @classmethod
+    def encode_body(cls, message_object):
+        # header, MAC address and json payload
+        rawmsg = super().encode_body(message_object) + mac_to_bytes(message_object['MAC'])
+        if 'data' in message_object:
+            rawmsg += json_dumps(message_object['data'])
+        return rawmsg
 
 msg_types = {
     MsgPushData.IDENT: MsgPushData,
@@ -162,24 +290,78 @@ msg_types_name = {
     MsgTxAck.NAME: MsgTxAck
 }
 
-def decode_message(rawmsg, return_ack=False):
-    if len(rawmsg) < 4 or rawmsg[3] not in msg_types:
-        raise ValueError(f"invalid message: {rawmsg}, too short {len(rawmsg)}/4 bytes")
-
-    msg_obj = msg_types[rawmsg[3]](rawmsg)
-    msg_body = msg_obj.decode()
-    ack = msg_obj.ack()
+def decode_message(rawmsg, return_ack=False, skip_stat=False):
+    """
+    decode datagram without creating message class instance or copying datagram
+    :param rawmsg: bytes, bytearray or memoryview of received datagram
+    :param return_ack: if True return tuple of (message, ack) where ack is raw ack datagram or None
+    :param skip_stat: if True stat only PUSH_DATA is not parsed, see MsgPushData.decode_body_skip_stat
+    :return: message dictionary
+    """
+    view = memoryview(rawmsg)
+    if len(view) < 4 or view[3] not in msg_types:
+        raise ValueError(f"invalid message: {bytes(view)}, too short {len(view)}/4 bytes")
+
+    msg_cls = msg_types[view[3]]
+    if skip_stat and msg_cls is MsgPushData:
+        msg_body = msg_cls.decode_body_skip_stat(view)
+    else:
+        msg_body = msg_cls.decode_body(view)
     if return_ack:
-        return msg_body, ack
+        return msg_body, msg_cls.ack_body(view)
     return msg_body
 
 def encode_message(message_object):
-    if message_object.get('_NAME_') not in msg_types_name:
+    msg_cls = msg_types_name.get(message_object.get('_NAME_'))
+    if msg_cls is None:
         raise ValueError("invalid message object")
 
-    msg_obj = msg_types_name[message_object.get('_NAME_')]()
-    rawmsg = msg_obj.encode(message_object)
-    return rawmsg
+    return msg_cls.encode_body(message_object)
+
+# largest upstream datagram the Semtech packet forwarder sends (TX_BUFF_SIZE in lora_pkt_fwd.c, 8 rxpks + status)
+PUSH_DATA_MAX_SIZE = 4550
+# bytes of PUSH_DATA around serialized rxpks: header, MAC, '{"rxpk":[' and ']}'
+PUSH_DATA_RXPK_OVERHEAD = 12 + 9 + 2
+
+# rxpk fields that are rewritten for each virtual gateway, everything else is identical for all miners
+RXPK_METADATA_FIELDS = ('tmst', 'rssi', 'lsnr')
+
+def rxpk_template(rxpk):
+    """
+    serialize the fields of rxpk that are the same for every miner.  The result is a JSON object body without braces
+    which is combined with per miner metadata by encode_rxpk
+    :param rxpk: rxpk dictionary
+    :return: bytes
+    """
+    shared = {k: v for k, v in rxpk.items() if k not in RXPK_METADATA_FIELDS}
+    return json_dumps(shared)[1:-1]
+
+def encode_rxpk(template, tmst, rssi, lsnr):
+    """
+    build serialized rxpk JSON object from template and per miner metadata
+    :param template: bytes returned from rxpk_template
+    :param tmst: internal timestamp
+    :param rssi: RSSI in dBm
+    :param lsnr: SNR in dB
+    :return: bytes
+    """
+    meta = f'{{"tmst":{tmst},"rssi":{rssi},"lsnr":{lsnr}'.encode()
+    if template:
+        return meta + b',' + template + b'}'
+    return meta + b'}'
+
+def encode_push_data_rxpks(token, mac, rxpks_raw):
+    """
+    build PUSH_DATA datagram from already serialized rxpks
+    :param token: random token
+    :param mac: MAC address either as ':' separated hex string or 8 raw bytes
+    :param rxpks_raw: list of serialized rxpk objects as returned from encode_rxpk
+    :return: bytes
+    """
+    if isinstance(mac, str):
+        mac = mac_to_bytes(mac)
+    header = _HEADER.pack(2, token, MsgPushData.IDENT) + mac
+    return header + b'{"rxpk":[' + b','.join(rxpks_raw) + b']}'
 
 def print_message(rawmsg):
 
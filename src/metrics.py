@@ -0,0 +1,268 @@
+"""
+Lightweight latency histograms, memory usage and a Prometheus text format endpoint for the forwarding path.
+
+StageTimer wraps existing functions and methods so the hot path carries no timing code unless it is enabled (by
+--metrics-port, --profile or tools/replay.py).  Time spent in a wrapped call nested inside another wrapped call is only
+counted for the inner stage.  With a sample rate below 1 only that fraction of datagrams is timed, the wrappers are
+swapped in before a sampled datagram and the original functions restored after it so other datagrams run uninstrumented
+code.
+
+MetricsServer serves metrics from its own thread, it only reads counters maintained by the packet thread.
+"""
+
+import bisect
+import http.server
+import logging
+import math
+import os
+import random
+import threading
+import time
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# bucket upper bounds in seconds, 4 per octave from 0.5us to ~16s
+LATENCY_BOUNDS = tuple(0.5e-6 * 2 ** (i / 4) for i in range(141))
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        """
+        :param bounds: sorted bucket upper bounds, values above the last bound go in an overflow bucket
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """
+        :param pct: percentile 0-100
+        :return: upper bound of bucket containing percentile (never more than max observed value)
+        """
+        if not self.count:
+            return 0.0
+        target = pct / 100 * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def cumulative(self, step=1):
+        """
+        :param step: only every step-th bucket bound is returned, to keep exported histograms small
+        :return: list of (upper bound, count of values <= bound) ending with (inf, count)
+        """
+        result = []
+        cumulative = 0
+        for i, count in enumerate(self.counts[:-1]):
+            cumulative += count
+            if i % step == step - 1:
+                result.append((self.bounds[i], cumulative))
+        result.append((float('inf'), self.count))
+        return result
+
+
+class StageTimer:
+    def __init__(self, clock=time.perf_counter, sample_rate=1.0, random_func=random.random):
+        """
+        accumulate time spent per stage and record per datagram totals in a Histogram per stage
+        :param clock: monotonic high resolution clock
+        :param sample_rate: fraction of datagrams timed
+        :param random_func: function returning a float in [0, 1) used to draw how many datagrams to skip
+        """
+        self.clock = clock
+        self.sample_rate = sample_rate
+        self.random = random_func
+        self.sampling = sample_rate >= 1  # if datagram being handled is timed
+        self._skip = 0  # datagrams left until the next sampled one
+        self._wrapped = dict()  # keys = (id of obj, name), values = (obj, name, original, wrapped)
+        self.histograms = dict()  # keys = stage name, values = Histogram
+        self.totals = dict()  # time per stage for datagram being handled
+        self._child_time = []  # time of nested wrapped calls, per active wrapped call
+
+    def timed(self, stage, func):
+        """
+        :param stage: stage name
+        :param func: function to time
+        :return: wrapped function that adds its time (excluding nested wrapped calls) to stage
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            self._child_time.append(0.0)
+            start = self.clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = self.clock() - start
+                exclusive = elapsed - self._child_time.pop()
+                self.totals[stage] = self.totals.get(stage, 0.0) + exclusive
+                if self._child_time:
+                    self._child_time[-1] += elapsed
+        return wrapper
+
+    def wrap(self, obj, name, stage):
+        """
+        replace obj.name (method of an instance or function of a module) with timed version.  Wrapping the same
+        attribute again replaces the previous wrapper
+        :param obj: instance or module
+        :param name: attribute name
+        :param stage: stage name
+        :return:
+        """
+        key = (id(obj), name)
+        current = getattr(obj, name)
+        previous = self._wrapped.get(key)
+        original = previous[2] if previous and current is previous[3] else current
+        wrapped = self.timed(stage, original)
+        self._wrapped[key] = (obj, name, original, wrapped)
+        setattr(obj, name, wrapped if self.sampling else original)
+
+    def discard(self, obj):
+        """
+        forget wrapped attributes of obj, e.g. a removed virtual gateway
+        :param obj: instance passed to wrap
+        :return:
+        """
+        for key in [key for key, wrapped in self._wrapped.items() if wrapped[0] is obj]:
+            del self._wrapped[key]
+
+    def _install(self, sampling):
+        for obj, name, original, wrapped in self._wrapped.values():
+            setattr(obj, name, wrapped if sampling else original)
+
+    def commit(self):
+        """
+        record stage totals of the datagram just handled and start a new one
+        :return:
+        """
+        if self.sample_rate < 1:
+            if self._skip > 0:
+                self._skip -= 1
+                if self.sampling:
+                    self.sampling = False
+                    self._install(False)
+            else:
+                # gaps between sampled datagrams are geometric, same as sampling each datagram independently
+                self._skip = self._draw_skip()
+                if not self.sampling:
+                    self.sampling = True
+                    self._install(True)
+        if not self.totals:
+            return
+        total = 0.0
+        for stage, elapsed in self.totals.items():
+            self.histogram(stage).observe(elapsed)
+            total += elapsed
+        self.histogram('total').observe(total)
+        self.totals = dict()
+
+    def _draw_skip(self):
+        if self.sample_rate <= 0:
+            return float('inf')
+        return int(math.log(1.0 - self.random()) / math.log(1.0 - self.sample_rate))
+
+    def histogram(self, stage):
+        if stage not in self.histograms:
+            self.histograms[stage] = Histogram()
+        return self.histograms[stage]
+
+
+def rss_bytes():
+    """
+    :return: resident set size of this process in bytes (peak RSS where current RSS is not available), None if unknown
+    """
+    try:
+        with open('/proc/self/statm') as fd:
+            return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def format_prometheus(families):
+    """
+    :param families: list of (name, type, help, samples) where type is counter, gauge or histogram and samples is a list
+        of (labels dictionary, value).  Value of histogram samples is a Histogram
+    :return: Prometheus text exposition format
+    """
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if kind != 'histogram':
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            for bound, count in value.cumulative(step=4):
+                le = '+Inf' if bound == float('inf') else f"{bound:.6g}"
+                lines.append(f"{name}_bucket{_format_labels(dict(labels, le=le))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    def __init__(self, port, collect, host='127.0.0.1'):
+        """
+        HTTP server for GET /metrics running on a background thread
+        :param port: port to listen on
+        :param collect: function returning metric families for format_prometheus
+        :param host: address to listen on, localhost by default
+        """
+        logger = logging.getLogger('Metrics')
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = format_prometheus(collect()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} {format % args}")
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,135 @@
+"""
+Connected UDP sockets to miners, one set per virtual gateway (--miner-sockets).
+
+By default datagrams to every miner are sent from the listening socket with sendto and miners answer to it, so replies
+(PUSH_ACK, PULL_ACK, PULL_RESP) are matched to their virtual gateway by the miner's (ip, port) through
+GW2Miner.vgateways_by_addr, and two virtual gateways pointing at the same miner ip:port cannot be told apart.
+
+With MinerSockets every virtual gateway sends from its own UDP socket connect()ed to its miner, like the up and down
+sockets of the Semtech packet forwarder: one socket if serv_port_up and serv_port_down are equal, otherwise PUSH_DATA go
+out of the up socket and PULL_DATA out of the down socket.  send() on a connected socket skips the destination address
+parsing and route lookup sendto does for every datagram, and a datagram received on it can only come from that miner,
+so replies are attributed by the socket they arrive on.  All miner sockets are registered with one selector (epoll or
+kqueue) whose own file descriptor becomes readable when any of them is, so the event loops wait on it next to the
+listening socket.
+"""
+
+import logging
+import selectors
+import socket
+
+from .receiver import RECV_BUFFER_SIZE
+
+
+class _Connected:
+    __slots__ = ('vgw', 'addr', 'up', 'down')
+
+    def __init__(self, vgw, addr, up, down):
+        self.vgw = vgw
+        self.addr = addr  # (server_address, port_up, port_dn) the sockets are connected to
+        self.up = up
+        self.down = down
+
+
+class MinerSockets:
+    def __init__(self):
+        """
+        :raises ValueError: if the platform has no selector with a file descriptor (e.g. Windows)
+        """
+        self.selector = selectors.DefaultSelector()
+        if not hasattr(self.selector, 'fileno'):
+            self.selector.close()
+            raise ValueError("connected miner sockets need epoll or kqueue")
+        self.connected = dict()  # keys = vGW MAC, values = _Connected
+        self.socket_errors = 0
+        self.logger = logging.getLogger('VGW')
+
+    def fileno(self):
+        return self.selector.fileno()
+
+    def update(self, vgateways_by_mac):
+        """
+        open sockets for new virtual gateways, reconnect the ones whose miner address changed and close sockets of
+        removed virtual gateways
+        :param vgateways_by_mac: dictionary of MAC -> VirtualGateway
+        :return:
+        """
+        for mac, vgw in vgateways_by_mac.items():
+            addr = (vgw.server_address, vgw.port_up, vgw.port_dn)
+            current = self.connected.get(mac)
+            if current and current.vgw is vgw and current.addr == addr:
+                continue
+            self.remove(mac)
+            try:
+                up = self._connect(vgw, vgw.port_up)
+                down = up if vgw.port_dn == vgw.port_up else self._connect(vgw, vgw.port_dn)
+            except OSError as e:
+                self.logger.error(f"could not open socket to miner {vgw.server_address} of vgateway {mac[-8:]}: {e}")
+                continue
+            self.connected[mac] = _Connected(vgw, addr, up, down)
+        for mac in [mac for mac in self.connected if mac not in vgateways_by_mac]:
+            self.remove(mac)
+
+    def _connect(self, vgw, port):
+        family = socket.AF_INET6 if ':' in vgw.server_address else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.connect((vgw.server_address, port))
+            self.selector.register(sock, selectors.EVENT_READ, vgw)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def remove(self, mac):
+        connected = self.connected.pop(mac, None)
+        if connected is None:
+            return
+        for sock in {connected.up, connected.down}:
+            self.selector.unregister(sock)
+            sock.close()
+
+    def socket_for(self, mac, addr):
+        """
+        :param mac: MAC of virtual gateway
+        :param addr: (ip, port) the datagram is for, port_dn selects the down socket
+        :return: connected socket or None if virtual gateway has none
+        """
+        connected = self.connected.get(mac)
+        if connected is None:
+            return None
+        return connected.down if addr[1] == connected.addr[2] else connected.up
+
+    @staticmethod
+    def sendto(data, sock):
+        """
+        send function for OutboundQueues, whose destinations are connected sockets from socket_for
+        :raises BlockingIOError: if socket buffer is full
+        """
+        sock.send(data)
+
+    def receive(self):
+        """
+        read datagrams waiting on miner sockets without blocking
+        :return: list of (data, addr, VirtualGateway of socket)
+        """
+        received = []
+        for key, _ in self.selector.select(0):
+            recvfrom = key.fileobj.recvfrom
+            while True:
+                try:
+                    data, addr = recvfrom(RECV_BUFFER_SIZE)
+                except BlockingIOError:
+                    break
+                except (ConnectionRefusedError, ConnectionResetError):
+                    # ICMP port unreachable from a previous send, miner is not listening
+                    self.socket_errors += 1
+                    continue
+                received.append((data, addr, key.data))
+        return received
+
+    def close(self):
+        for mac in list(self.connected):
+            self.remove(mac)
+        self.selector.close()
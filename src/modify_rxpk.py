@@ -13,6 +13,142 @@ import logging
 import random
 import datetime as dt
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# jitter added to rssi (dBm) and lsnr (0.1dB steps) of rxpks sent to virtual gateways other than the receiving gateway
+RSSI_JITTER = range(-2, 3)
+LSNR_JITTER = range(-15, 11)
+
+# below this many (destination, rxpk) pairs NumPy array setup costs more than it saves
+NUMPY_MIN_BATCH = 64
+_numpy_rng = numpy.random.default_rng() if numpy is not None else None
+
+
+def rx_clock(rxpk, now=None):
+    """
+    get arrival time of rxpk as uS since midnight UTC
+    modify tmst (Internal timestamp of "RX finished" event (32b unsigned)) to be aligned to uS since midnight UTC
+    this will be discontinuous once a day but that is basically same effect as a gateway reset / forwarder reboot
+    acceptable for proof-of-concept
+    also note 'time' is only available if there is a gps connected BUT time could be way off if there is a poor GPS fix
+    therefore compare to current time and only trust 'time' field if within 1.5s of now.  If 'time' is not available or
+    cannot be trusted, use the current time as assumed arrival time
+    :param rxpk: per PUSH_DATA https://github.com/Lora-net/packet_forwarder/blob/master/PROTOCOL.TXT
+    :param now: current UTC datetime, defaults to utcnow().  Pass one value to convert a batch of rxpks
+    :return: tuple of (elapsed_us_u32, gps_valid)
+    """
+    if now is None:
+        now = dt.datetime.utcnow()
+    ts_dt = now
+    gps_valid = False
+    if 'time' in rxpk:
+        ts_str = rxpk['time']
+        if ts_str[-1] == 'Z':
+            ts_str = ts_str[:-1]
+            ts_dt = dt.datetime.fromisoformat(ts_str)
+        if abs((ts_dt - now).total_seconds()) > 1.5:
+            ts_dt = now
+        else:
+            gps_valid = True
+
+    ts_midnight = dt.datetime(year=ts_dt.year, month=ts_dt.month, day=ts_dt.day, hour=0, minute=0, second=0, microsecond=0)
+    elapsed_us = int((ts_dt-ts_midnight).total_seconds() * 1e6)
+    elapsed_us_u32 = elapsed_us % 2**32
+    #print(f"elapsed us: {elapsed_us} ({elapsed_us/1e6}s), as u32 = {elapsed_us_u32}")
+    return elapsed_us_u32, gps_valid
+
+
+def modify_rxpks(rxpks, src_mac, modifiers, received=None):
+    """
+    compute modified metadata of a batch of rxpks for every destination virtual gateway.  Same result as calling
+    RXMetadataModification.modify_metadata per rxpk per destination but the clock is converted once per rxpk and
+    jitter for all destinations is drawn at once.  lsnr is computed in 0.1dB integer steps, the packet forwarder reports
+    lsnr with one decimal so results are identical
+    :param rxpks: list of rxpk dictionaries, not modified
+    :param src_mac: MAC of gateway that received rxpks
+    :param modifiers: list of (dest_mac, RXMetadataModification) for each destination virtual gateway
+    :param received: list of UTC datetimes each rxpk arrived at if it was held before forwarding, defaults to now
+    :return: list with one list of (tmst, rssi, lsnr) per destination, in order of modifiers and rxpks
+    """
+    if not rxpks or not modifiers:
+        return [[] for _ in modifiers]
+    if received is None:
+        now = dt.datetime.utcnow()
+        clocks = [rx_clock(rx, now) for rx in rxpks]
+    else:
+        clocks = [rx_clock(rx, now) for rx, now in zip(rxpks, received)]
+    elapsed = [elapsed_us_u32 for elapsed_us_u32, gps_valid in clocks]
+    old_ts = [rx['tmst'] for rx in rxpks]
+    old_rssi = [rx['rssi'] for rx in rxpks]
+    old_snr10 = [round(rx['lsnr'] * 10) for rx in rxpks]
+
+    if numpy is not None and len(modifiers) * len(rxpks) >= NUMPY_MIN_BATCH:
+        rssi_rows, lsnr_rows = _modify_signal_numpy(old_rssi, old_snr10, src_mac, modifiers)
+        results = []
+        for (dest_mac, modifier), rssis, lsnrs in zip(modifiers, rssi_rows, lsnr_rows):
+            results.append(list(zip(_modify_tmst(modifier, dest_mac == src_mac, old_ts, elapsed), rssis, lsnrs)))
+    else:
+        results = _modify(old_ts, elapsed, old_rssi, old_snr10, src_mac, modifiers)
+
+    for (dest_mac, modifier), result in zip(modifiers, results):
+        if modifier.logger.isEnabledFor(logging.DEBUG):
+            for rx, (tmst, rssi, lsnr), (elapsed_us_u32, gps_valid) in zip(rxpks, result, clocks):
+                modifier.logger.debug("modified packet from GW %s to vGW %s, rssi:%s->%s, lsnr:%s->%.1f, tmst:%s->%s %s", src_mac[-8:], dest_mac[-8:], rx['rssi'], rssi, rx['lsnr'], lsnr, rx['tmst'], tmst, 'GPS SYNC' if gps_valid else '')
+    return results
+
+
+def _modify_tmst(modifier, is_src, old_ts, elapsed):
+    if is_src:
+        # receiving gateway keeps its own tmst, offset to its clock is remembered for the other rxpks
+        for ts, elapsed_us_u32 in zip(old_ts, elapsed):
+            modifier.tmst_offset = (ts - elapsed_us_u32 + 2**32) % 2**32
+        return old_ts
+    offset = modifier.tmst_offset
+    return [(elapsed_us_u32 + offset) % 2**32 for elapsed_us_u32 in elapsed]
+
+
+def _modify(old_ts, elapsed, old_rssi, old_snr10, src_mac, modifiers):
+    rows, cols = len(modifiers), len(old_ts)
+    rssi_jitter = random.choices(RSSI_JITTER, k=rows * cols)
+    lsnr_jitter = random.choices(LSNR_JITTER, k=rows * cols)
+    results = []
+    for row, (dest_mac, modifier) in enumerate(modifiers):
+        is_src = dest_mac == src_mac
+        min_rssi, max_rssi = modifier.min_rssi, modifier.max_rssi
+        min_snr10, max_snr10 = round(modifier.min_snr * 10), round(modifier.max_snr * 10)
+        first = row * cols
+        results.append([
+            (tmst, min(max_rssi, max(min_rssi, rssi + (3 if is_src else rssi_jit))),
+             min(max_snr10, max(min_snr10, snr10 + lsnr_jit)) / 10)
+            for tmst, rssi, snr10, rssi_jit, lsnr_jit in zip(
+                _modify_tmst(modifier, is_src, old_ts, elapsed), old_rssi, old_snr10,
+                rssi_jitter[first:first + cols], lsnr_jitter[first:first + cols]
+            )
+        ])
+    return results
+
+
+def _modify_signal_numpy(old_rssi, old_snr10, src_mac, modifiers):
+    rows, cols = len(modifiers), len(old_rssi)
+    is_src = numpy.array([[dest_mac == src_mac] for dest_mac, modifier in modifiers])
+    old_rssi = numpy.array(old_rssi)
+    rssi_jitter = _numpy_rng.integers(RSSI_JITTER.start, RSSI_JITTER.stop, size=(rows, cols))
+    lsnr_jitter = _numpy_rng.integers(LSNR_JITTER.start, LSNR_JITTER.stop, size=(rows, cols))
+    rssi = numpy.clip(
+        numpy.where(is_src, old_rssi + 3, old_rssi + rssi_jitter),
+        numpy.array([[modifier.min_rssi] for dest_mac, modifier in modifiers]),
+        numpy.array([[modifier.max_rssi] for dest_mac, modifier in modifiers])
+    )
+    lsnr10 = numpy.clip(
+        numpy.array(old_snr10) + lsnr_jitter,
+        numpy.array([[round(modifier.min_snr * 10)] for dest_mac, modifier in modifiers]),
+        numpy.array([[round(modifier.max_snr * 10)] for dest_mac, modifier in modifiers])
+    )
+    return rssi.tolist(), (lsnr10 / 10).tolist()
 
 
 class RXMetadataModification:
@@ -30,47 +166,37 @@ class RXMetadataModification:
         :param rxpk: per PUSH_DATA https://github.com/Lora-net/packet_forwarder/blob/master/PROTOCOL.TXT
         :return: object with metadata modified
         """
+        rxpk['tmst'], rxpk['rssi'], rxpk['lsnr'] = self.modify_metadata(rxpk, src_mac=src_mac, dest_mac=dest_mac)
+        return rxpk
+
+    def modify_metadata(self, rxpk, src_mac=None, dest_mac=None):
+        """
+        compute modified metadata for rxpk without changing rxpk, this allows the same rxpk to be shared by all
+        virtual gateways.  See modify_rxpks to modify a batch of rxpks for many virtual gateways
+        :param rxpk: per PUSH_DATA https://github.com/Lora-net/packet_forwarder/blob/master/PROTOCOL.TXT
+        :return: tuple of (tmst, rssi, lsnr) for destination vGW
+        """
 
         old_snr, old_rssi, old_ts = rxpk['lsnr'], rxpk['rssi'], rxpk['tmst']
         # simple clipping low and high, could be a lot more sophisticated to add randomness or better mapping
         if src_mac == dest_mac:
-            rxpk['rssi'] += 3  # boost RSSI for src gateway
+            rssi = old_rssi + 3  # boost RSSI for src gateway
         else:
-            rxpk['rssi'] += random.randint(-2, 2)  # randomize rssi +/- 2dBm
-        rxpk['lsnr'] = round(rxpk['lsnr'] + random.randint(-15, 10) * 0.1, 1)  # randomize snr +/- 1dB in 0.1dB increments
+            rssi = old_rssi + random.randint(-2, 2)  # randomize rssi +/- 2dBm
+        lsnr = round(old_snr + random.randint(-15, 10) * 0.1, 1)  # randomize snr +/- 1dB in 0.1dB increments
         # clip after adjustments to ensure result is still valid
-        rxpk['rssi'] = min(self.max_rssi, max(self.min_rssi, rxpk['rssi']))
-        rxpk['lsnr'] = min(self.max_snr,  max(self.min_snr,  rxpk['lsnr']))
-
-        # modify tmst (Internal timestamp of "RX finished" event (32b unsigned)) to be aligned to uS since midnight UTC
-        # this will be discontinuous once a day but that is basically same effect as a gateway reset / forwarder reboot
-        # acceptable for proof-of-concept
-        # also note 'time' is only available if there is a gps connected BUT time could be way off if there is a poor GPS fix
-        # therefore compare to current time and only trust 'time' field if within 1.5s of now.  If 'time' is not available or
-        # cannot be trusted, use the current time as assumed arrival time
-        ts_dt = dt.datetime.utcnow()
-        gps_valid = False
-        if 'time' in rxpk:
-            ts_str = rxpk['time']
-            if ts_str[-1] == 'Z':
-                ts_str = ts_str[:-1]
-                ts_dt = dt.datetime.fromisoformat(ts_str)
-            if abs((ts_dt - dt.datetime.utcnow()).total_seconds()) > 1.5:
-                ts_dt = dt.datetime.utcnow()
-            else:
-                gps_valid = True
-
-        ts_midnight = dt.datetime(year=ts_dt.year, month=ts_dt.month, day=ts_dt.day, hour=0, minute=0, second=0, microsecond=0)
-        elapsed_us = int((ts_dt-ts_midnight).total_seconds() * 1e6)
-        elapsed_us_u32 = elapsed_us % 2**32
-
-        #print(f"elapsed us: {elapsed_us} ({elapsed_us/1e6}s), as u32 = {elapsed_us_u32}")
+        rssi = min(self.max_rssi, max(self.min_rssi, rssi))
+        lsnr = min(self.max_snr,  max(self.min_snr,  lsnr))
+
+        elapsed_us_u32, gps_valid = rx_clock(rxpk)
+
+        tmst = old_ts
         if src_mac != dest_mac:
-            rxpk['tmst'] = (elapsed_us_u32 + self.tmst_offset) % 2**32
+            tmst = (elapsed_us_u32 + self.tmst_offset) % 2**32
         else:
-            tmst_offset = (rxpk['tmst'] - elapsed_us_u32 + 2**32) % 2**32
+            tmst_offset = (old_ts - elapsed_us_u32 + 2**32) % 2**32
             #  print(f"updated tmst_offset from:{self.tmst_offset} to {tmst_offset} (error: {self.tmst_offset - tmst_offset})")
             self.tmst_offset = tmst_offset
-        self.logger.debug(f"modified packet from GW {src_mac[-8:]} to vGW {dest_mac[-8:]}, rssi:{old_rssi}->{rxpk['rssi']}, lsnr:{old_snr}->{rxpk['lsnr']:.1f}, tmst:{old_ts}->{rxpk['tmst']} {'GPS SYNC' if gps_valid else ''}")
-        return rxpk
-
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("modified packet from GW %s to vGW %s, rssi:%s->%s, lsnr:%s->%.1f, tmst:%s->%s %s", src_mac[-8:], dest_mac[-8:], old_rssi, rssi, old_snr, lsnr, old_ts, tmst, 'GPS SYNC' if gps_valid else '')
+        return tmst, rssi, lsnr
@@ -0,0 +1,74 @@
+"""
+Settings of a GW2Miner.
+
+Forwarding tuning and the optional subsystems (PUSH_DATA batching, miner queues, best copy selection, downlink
+scheduling, connected miner sockets, capture, config watching, snapshots and profiling) are passed to GW2Miner as one
+Options instead of a keyword argument each.  Defaults match the command line defaults, every optional subsystem is off.
+"""
+
+from .outbound import DROP_OLDEST
+
+
+class Options:
+    def __init__(self, keepalive_interval=10, stat_interval=30, dedup_ttl=60, dedup_max_entries=100000, rcvbuf=0,
+                 recv_batch=64, miner_queue_size=64, miner_rate=0, miner_burst=10, drop_policy=DROP_OLDEST,
+                 batch_window=0, batch_max_size=1400, best_copy_window=0, best_copy_scorer='rssi',
+                 downlink_scheduler=False, miner_sockets=False, capture=None, config_watcher=None, snapshot=None,
+                 profiler=None):
+        """
+        :param keepalive_interval: seconds between PULL_DATA sent to miners
+        :param stat_interval: seconds between stat PUSH_DATA sent to miners
+        :param dedup_ttl: seconds a received packet is remembered for de-duplication
+        :param dedup_max_entries: max number of packets remembered for de-duplication
+        :param rcvbuf: receive buffer size of the listening socket in bytes, 0 for system default
+        :param recv_batch: max datagrams read from the listening socket per wake up
+        :param miner_queue_size: max datagrams waiting to be sent to each miner
+        :param miner_rate: max datagrams per second sent to each miner, 0 for no limit
+        :param miner_burst: datagrams a rate limited miner can receive at once
+        :param drop_policy: datagram dropped when a miner queue is full, outbound.DROP_OLDEST or DROP_NEWEST
+        :param batch_window: seconds rxpks for a miner are held to be sent in one PUSH_DATA, 0 to disable batching
+        :param batch_max_size: max size of batched PUSH_DATA in bytes
+        :param best_copy_window: seconds to wait for copies from other gateways and forward only the best, 0 to
+            forward the first copy
+        :param best_copy_scorer: name in best_copy.SCORERS choosing the forwarded copy
+        :param downlink_scheduler: transmit PULL_RESP from the gateway that heard the device best
+        :param miner_sockets: send to each miner from its own connected socket, see miner_sockets.MinerSockets
+        :param capture: CaptureWriter recording received datagrams for replay
+        :param config_watcher: ConfigWatcher reloading configs on change
+        :param snapshot: StateSnapshot saving state for warm restarts
+        :param profiler: Profiler handling cProfile/tracemalloc signals in --profile mode
+        """
+        self.keepalive_interval = keepalive_interval
+        self.stat_interval = stat_interval
+        self.dedup_ttl = dedup_ttl
+        self.dedup_max_entries = dedup_max_entries
+        self.rcvbuf = rcvbuf
+        self.recv_batch = recv_batch
+        self.miner_queue_size = miner_queue_size
+        self.miner_rate = miner_rate
+        self.miner_burst = miner_burst
+        self.drop_policy = drop_policy
+        self.batch_window = batch_window
+        self.batch_max_size = batch_max_size
+        self.best_copy_window = best_copy_window
+        self.best_copy_scorer = best_copy_scorer
+        self.downlink_scheduler = downlink_scheduler
+        self.miner_sockets = miner_sockets
+        self.capture = capture
+        self.config_watcher = config_watcher
+        self.snapshot = snapshot
+        self.profiler = profiler
+
+    @classmethod
+    def from_args(cls, args, **subsystems):
+        """
+        :param args: parsed command line arguments of gateways2miners.py
+        :param subsystems: capture, config_watcher, snapshot and profiler objects, built per GW2Miner by the caller
+        :return: Options
+        """
+        return cls(keepalive_interval=args.keepalive, stat_interval=args.stat, dedup_ttl=args.dedup_ttl,
+                   dedup_max_entries=args.dedup_max, rcvbuf=args.rcvbuf, miner_queue_size=args.miner_queue,
+                   miner_rate=args.miner_rate, miner_burst=args.miner_burst, drop_policy=args.drop_policy,
+                   batch_window=args.batch_window / 1000, batch_max_size=args.batch_max_size,
+                   best_copy_window=args.best_copy_window / 1000, best_copy_scorer=args.best_copy_scorer,
+                   downlink_scheduler=args.schedule_downlinks, miner_sockets=args.miner_sockets, **subsystems)
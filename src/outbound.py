@@ -0,0 +1,178 @@
+"""
+Bounded per miner queues for datagrams sent to miners.
+
+Datagrams for a miner are sent straight away when its queue is empty and its rate cap allows, otherwise they wait in
+the miner's queue.  The queue is drained later by the event loop (see GW2Miner.service_queues) so a miner that is rate
+limited, or a full socket buffer, never delays receiving from gateways or sending to other miners.  When a queue is full
+either the oldest or the newest datagram is dropped.
+"""
+
+import logging
+import time
+from collections import deque
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+
+
+class MinerQueue:
+    __slots__ = ('items', 'max_len', 'rate', 'burst', 'tokens', 'last_refill', 'sent', 'dropped', 'errors')
+
+    def __init__(self, max_len, rate, burst, now):
+        """
+        :param max_len: max datagrams waiting
+        :param rate: max datagrams per second, 0 for no limit
+        :param burst: datagrams that can be sent at once after being idle when rate limited
+        :param now: monotonic timestamp
+        """
+        self.items = deque()
+        self.max_len = max_len
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last_refill = now
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+
+    def can_send(self):
+        return not self.rate or self.tokens >= 1 - 1e-9  # tolerate float error at the computed deadline
+
+
+class OutboundQueues:
+    def __init__(self, sendto, max_len=64, rate=0, burst=10, policy=DROP_OLDEST, clock=time.monotonic):
+        """
+        :param sendto: function(data, addr) sending without blocking, raises BlockingIOError if the socket is full
+        :param max_len: default max datagrams waiting per miner
+        :param rate: default max datagrams per second per miner, 0 for no limit
+        :param burst: default datagrams a rate limited miner can receive at once
+        :param policy: DROP_OLDEST or DROP_NEWEST when a queue is full
+        :param clock: monotonic clock function
+        """
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"unknown drop policy {policy}")
+        self.sendto = sendto
+        self.max_len = max_len
+        self.rate = rate
+        self.burst = burst
+        self.policy = policy
+        self.clock = clock
+        self.queues = dict()  # keys = miner key (vGW MAC), values = MinerQueue
+        self.active = dict()  # queues with datagrams waiting, in order they became active
+        self.socket_full = False
+        self.logger = logging.getLogger('Outbound')
+
+    def queue(self, key, max_len=None, rate=None):
+        """
+        get queue for miner, creating it if needed
+        :param key: miner key
+        :param max_len: max datagrams waiting for this miner, default if None
+        :param rate: max datagrams per second for this miner, default if None
+        :return: MinerQueue
+        """
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = MinerQueue(self.max_len, self.rate, self.burst, self.clock())
+        if max_len is not None:
+            queue.max_len = max_len
+        if rate is not None:
+            queue.rate = rate
+        return queue
+
+    def remove(self, key):
+        self.queues.pop(key, None)
+        self.active.pop(key, None)
+
+    def put(self, key, data, addr):
+        """
+        send datagram to miner now if nothing is waiting for it, otherwise queue it
+        :param key: miner key
+        :param data: raw datagram
+        :param addr: (ip, port) of miner
+        :return: False if a datagram was dropped because the queue was full
+        """
+        queue = self.queues.get(key) or self.queue(key)
+        if not queue.items and not self.socket_full:
+            queue.refill(self.clock())
+            if queue.can_send():
+                try:
+                    self._send(queue, data, addr)
+                    return True
+                except BlockingIOError:
+                    self.socket_full = True
+        dropped = False
+        if len(queue.items) >= queue.max_len:
+            queue.dropped += 1
+            dropped = True
+            if self.policy == DROP_NEWEST:
+                return False
+            queue.items.popleft()
+        queue.items.append((data, addr))
+        self.active[key] = queue
+        return not dropped
+
+    def _send(self, queue, data, addr):
+        try:
+            self.sendto(data, addr)
+        except BlockingIOError:
+            raise  # nothing was sent, datagram stays queued
+        except OSError as e:
+            # e.g. ICMP port unreachable from an earlier send, datagram is dropped
+            queue.errors += 1
+            self.logger.debug(f"send to {addr} failed: {e}")
+        else:
+            queue.sent += 1
+        if queue.rate:
+            queue.tokens -= 1
+
+    def drain(self):
+        """
+        send waiting datagrams allowed by each miner's rate cap
+        :return:
+        """
+        if not self.active:
+            return
+        self.socket_full = False
+        now = self.clock()
+        for key, queue in list(self.active.items()):
+            queue.refill(now)
+            while queue.items and queue.can_send():
+                data, addr = queue.items[0]
+                try:
+                    self._send(queue, data, addr)
+                except BlockingIOError:
+                    # socket buffer is full, try again shortly
+                    self.socket_full = True
+                    return
+                queue.items.popleft()
+            if not queue.items:
+                del self.active[key]
+
+    def next_deadline(self):
+        """
+        :return: monotonic timestamp when drain should be called next or None if nothing is waiting
+        """
+        if not self.active:
+            return None
+        now = self.clock()
+        if self.socket_full:
+            return now + 0.001
+        deadline = None
+        for queue in self.active.values():
+            queue.refill(now)
+            ready = now if queue.can_send() else now + (1 - queue.tokens) / queue.rate
+            if deadline is None or ready < deadline:
+                deadline = ready
+        return deadline
+
+    def stats(self):
+        """
+        :return: dictionary of miner key -> dict(depth, sent, dropped, errors)
+        """
+        return {key: dict(depth=len(queue.items), sent=queue.sent, dropped=queue.dropped, errors=queue.errors)
+                for key, queue in list(self.queues.items())}
@@ -0,0 +1,132 @@
+"""
+Profiling mode (--profile) for finding where time goes on slow hardware.
+
+Per-stage timing is done by metrics.StageTimer for a sampled fraction of datagrams and reported every stat interval.
+Signals start and dump heavier profilers without restarting the forwarder:
+
+    kill -USR1 <pid>    start cProfile, send again to stop and write cprofile-<pid>-<time>.pstats
+    kill -USR2 <pid>    start tracemalloc, send again to write tracemalloc-<pid>-<time>.snapshot (tracing continues)
+
+Signal handlers only record the request, profilers are started and dumped from the packet loop (see poll) so a request
+is handled at the next wakeup, up to a few seconds later when there is no traffic.  Dumps are read with
+python3 -m pstats <file> or tracemalloc.Snapshot.load(<file>).
+"""
+
+import cProfile
+import logging
+import os
+import signal
+import time
+import tracemalloc
+
+REPORT_STAGES = ('receive', 'decode', 'key', 'dedup', 'modify', 'encode', 'send', 'total')
+TRACEMALLOC_FRAMES = 10
+
+
+def format_stage_report(timer):
+    """
+    :param timer: metrics.StageTimer
+    :return: list of lines with count, mean, p50, p99 and share of total time of each stage
+    """
+    total = timer.histograms.get('total')
+    if not total or not total.count:
+        return []
+    lines = [f"{'stage':>8} {'count':>8} {'mean us':>9} {'p50 us':>9} {'p99 us':>9} {'share':>6}"]
+    for stage in REPORT_STAGES:
+        hist = timer.histograms.get(stage)
+        if not hist:
+            continue
+        lines.append(f"{stage:>8} {hist.count:>8} {hist.mean() * 1e6:>9.1f} {hist.percentile(50) * 1e6:>9.1f} "
+                     f"{hist.percentile(99) * 1e6:>9.1f} {hist.sum / total.sum:>6.1%}")
+    return lines
+
+
+class Profiler:
+    def __init__(self, directory='.'):
+        """
+        :param directory: where cProfile and tracemalloc dumps are written
+        """
+        self.directory = directory
+        self.requests = []  # 'cprofile' or 'tracemalloc', appended by signal handlers
+        self.cprofile = None  # cProfile.Profile while profiling
+        self.logger = logging.getLogger('Profile')
+
+    def install_signals(self):
+        """
+        SIGUSR1 toggles cProfile, SIGUSR2 starts or dumps tracemalloc.  Does nothing where these signals do not exist
+        :return: self
+        """
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.requests.append('cprofile'))
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.requests.append('tracemalloc'))
+            self.logger.info(f"send SIGUSR1 to pid {os.getpid()} to toggle cProfile, SIGUSR2 for tracemalloc")
+        return self
+
+    def poll(self):
+        """
+        handle signals received since last call, called from the packet loop
+        :return:
+        """
+        while self.requests:
+            request = self.requests.pop(0)
+            if request == 'cprofile':
+                self.toggle_cprofile()
+            else:
+                self.tracemalloc_snapshot()
+
+    def dump_path(self, kind, extension):
+        return os.path.join(self.directory, f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+    def toggle_cprofile(self):
+        """
+        start cProfile or stop it and write stats
+        :return: path of written stats or None if profiling was started
+        """
+        if self.cprofile is None:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+            self.logger.info("cProfile started")
+            return None
+        self.cprofile.disable()
+        path = self.dump_path('cprofile', 'pstats')
+        try:
+            self.cprofile.dump_stats(path)
+        except OSError as e:
+            self.logger.error(f"could not write cProfile stats: {e}")
+            path = None
+        else:
+            self.logger.info(f"cProfile stopped, stats written to {path}")
+        self.cprofile = None
+        return path
+
+    def tracemalloc_snapshot(self):
+        """
+        start tracemalloc or write a snapshot and log the largest allocation sites
+        :return: path of written snapshot or None if tracing was started
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.logger.info("tracemalloc started")
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        path = self.dump_path('tracemalloc', 'snapshot')
+        try:
+            snapshot.dump(path)
+        except OSError as e:
+            self.logger.error(f"could not write tracemalloc snapshot: {e}")
+            path = None
+        else:
+            self.logger.info(f"tracemalloc snapshot written to {path}")
+        for stat in snapshot.statistics('lineno')[:10]:
+            self.logger.info(f"  {stat}")
+        return path
+
+    def stop(self):
+        """
+        stop profilers that are still running
+        :return:
+        """
+        if self.cprofile is not None:
+            self.toggle_cprofile()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
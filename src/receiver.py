@@ -0,0 +1,71 @@
+"""
+Receive datagrams into preallocated buffers.
+
+Every wakeup of the event loop reads all datagrams already waiting on the socket (up to the number of buffers) with
+recvfrom_into, so no bytes object is allocated per datagram and a burst from several gateways costs one select and one
+receive call per datagram plus one final call that finds the socket empty.  Buffers hold the largest UDP datagram: the
+legacy packet forwarder sends up to 4550 bytes but the sx1302 HAL forwarder sizes its PUSH_DATA for up to 255 rxpks,
+and the previous recvfrom(1024) silently truncated PUSH_DATA with several rxpks.
+"""
+
+import logging
+import socket
+
+# largest UDP datagram, 64 buffers take 4MB per listening socket
+RECV_BUFFER_SIZE = 65535
+
+
+class BatchReceiver:
+    def __init__(self, sock, count=64, size=RECV_BUFFER_SIZE):
+        """
+        :param sock: non-blocking socket to receive from
+        :param count: number of buffers, max datagrams read per call of receive
+        :param size: size of each buffer in bytes, datagrams that fill a buffer are dropped as possibly truncated
+        """
+        self.sock = sock
+        self.size = size
+        self.buffers = [bytearray(size) for _ in range(count)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.logger = logging.getLogger('Recv')
+
+        # counters
+        self.datagrams = 0
+        self.oversized = 0
+        self.socket_errors = 0
+        self.calls = 0  # recvfrom_into calls including the ones finding the socket empty
+
+    def receive(self):
+        """
+        read datagrams waiting on the socket without blocking
+        :return: list of (memoryview, addr).  Views point into the buffers and are only valid until the next call
+        """
+        received = []
+        recvfrom_into = self.sock.recvfrom_into
+        for view in self.views:
+            while True:
+                self.calls += 1
+                try:
+                    nbytes, addr = recvfrom_into(view)
+                except (BlockingIOError, socket.timeout):
+                    return received
+                except ConnectionResetError:
+                    # ICMP port unreachable from a previous send, see GW2Miner.get_messages
+                    self.socket_errors += 1
+                    continue
+                if nbytes < self.size:
+                    break
+                self.oversized += 1
+                self.logger.warning(f"dropped datagram from {addr} larger than {self.size - 1} bytes")
+            self.datagrams += 1
+            received.append((view[:nbytes], addr))
+        return received
+
+
+def set_receive_buffer(sock, size):
+    """
+    :param sock: socket
+    :param size: requested SO_RCVBUF in bytes
+    :return: SO_RCVBUF reported by the kernel (Linux doubles the requested size and caps it at net.core.rmem_max)
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
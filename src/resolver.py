@@ -0,0 +1,187 @@
+"""
+Resolution of miner server_address host names.
+
+Host names of all configs are resolved concurrently so startup does not wait for each lookup in turn.  Resolved
+addresses are cached and refreshed by a background thread every ttl seconds, so a miner whose IP changes is reached
+again without a restart.  Changes are only collected by the thread, GW2Miner applies them between datagrams.
+Host names first seen in a reloaded config are looked up in the background too so a slow DNS server never stalls
+forwarding, see resolve_all(wait=False).
+IPv6 addresses are only used if the socket sending to miners can reach them (dual-stack listener or connected miner
+sockets), otherwise host names resolve to their IPv4 address.
+"""
+
+import ipaddress
+import logging
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def is_ip(host):
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+class Resolver:
+    def __init__(self, ttl=300, max_workers=16, resolve=None, ipv6=False):
+        """
+        :param ttl: seconds between background refreshes of resolved host names
+        :param max_workers: max concurrent lookups
+        :param resolve: function resolving host name to IP, raising OSError on failure.  Defaults to getaddrinfo,
+            replaceable for testing
+        :param ipv6: True if miners can be sent to over IPv6
+        """
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.ipv6 = ipv6
+        self.resolve = resolve or self.getaddrinfo
+        self.cache = dict()  # keys = host, values = IP
+        self.changes = dict()  # keys = host, values = new IP not yet applied by GW2Miner
+        self.pending = set()  # host names looked up in the background by resolve_all(wait=False)
+        self.resolved = dict()  # keys = host, values = IP (None if lookup failed) of finished background lookups
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger('DNS')
+
+    def getaddrinfo(self, host):
+        """
+        :param host: host name
+        :return: first address of host in the order returned by the system resolver, skipping IPv6 unless self.ipv6
+        :raises OSError: if host has no usable address
+        """
+        for family, type_, proto, canonname, sockaddr in socket.getaddrinfo(host, None, type=socket.SOCK_DGRAM):
+            if family == socket.AF_INET or (family == socket.AF_INET6 and self.ipv6):
+                return sockaddr[0]
+        raise OSError("no IPv4 address" if not self.ipv6 else "no address")
+
+    def _lookup(self, host):
+        try:
+            return self.resolve(host)
+        except OSError as e:
+            self.logger.warning(f"could not resolve \"{host}\": {e}")
+            return None
+
+    def _lookup_all(self, hosts):
+        if len(hosts) <= 1:
+            return [self._lookup(host) for host in hosts]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(hosts))) as executor:
+            return list(executor.map(self._lookup, hosts))
+
+    def resolve_all(self, hosts, wait=True):
+        """
+        resolve host names concurrently, cached host names are not looked up again
+        :param hosts: iterable of host names or IPs
+        :param wait: if False host names not in cache are looked up on a background thread and left out of the result,
+            see pop_resolved
+        :return: dictionary of host -> IP, None for host names that could not be resolved
+        """
+        result = dict()
+        missing = []
+        for host in set(hosts):
+            if is_ip(host):
+                result[host] = host
+            elif host in self.cache:
+                result[host] = self.cache[host]
+            else:
+                missing.append(host)
+        if not wait:
+            self.resolve_in_background(missing)
+            return result
+        for host, ip in zip(missing, self._lookup_all(missing)):
+            result[host] = ip
+            if ip is not None:
+                with self.lock:
+                    self.cache[host] = ip
+        return result
+
+    def resolve_in_background(self, hosts):
+        """
+        look up host names on a background thread, results are cached and collected for pop_resolved
+        :param hosts: list of host names
+        :return:
+        """
+        with self.lock:
+            hosts = [host for host in hosts if host not in self.pending]
+            self.pending.update(hosts)
+        if hosts:
+            threading.Thread(target=self._resolve_pending, args=(hosts,), name='resolver-new', daemon=True).start()
+
+    def _resolve_pending(self, hosts):
+        for host, ip in zip(hosts, self._lookup_all(hosts)):
+            with self.lock:
+                if ip is not None:
+                    self.cache[host] = ip
+                self.resolved[host] = ip
+                self.pending.discard(host)
+
+    def pop_resolved(self):
+        """
+        :return: dictionary of host -> IP (None if lookup failed) for background lookups finished since last call
+        """
+        if not self.resolved:
+            return dict()
+        with self.lock:
+            resolved, self.resolved = self.resolved, dict()
+        return resolved
+
+    def prune(self, hosts):
+        """
+        forget cached host names no config uses any more so they are not refreshed forever
+        :param hosts: iterable of host names still in use
+        :return: number of forgotten host names
+        """
+        hosts = set(hosts)
+        with self.lock:
+            unused = [host for host in self.cache if host not in hosts]
+            for host in unused:
+                del self.cache[host]
+                self.changes.pop(host, None)
+        return len(unused)
+
+    def refresh(self):
+        """
+        look up all cached host names again and record the ones whose IP changed
+        :return: number of changed host names
+        """
+        hosts = list(self.cache)
+        changed = 0
+        for host, ip in zip(hosts, self._lookup_all(hosts)):
+            if ip is None or ip == self.cache.get(host):
+                continue  # keep last known address if lookup failed
+            self.logger.info(f"{host} moved from {self.cache.get(host)} to {ip}")
+            with self.lock:
+                self.cache[host] = ip
+                self.changes[host] = ip
+            changed += 1
+        return changed
+
+    def pop_changes(self):
+        """
+        :return: dictionary of host -> IP for host names whose IP changed since last call
+        """
+        if not self.changes:
+            return dict()
+        with self.lock:
+            changes, self.changes = self.changes, dict()
+        return changes
+
+    def start(self):
+        """
+        refresh cached host names every ttl seconds on a background thread
+        :return: self
+        """
+        if self.ttl > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='resolver', daemon=True)
+            self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stop_event.wait(self.ttl):
+            self.refresh()
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,125 @@
+"""
+Per virtual gateway routing rules deciding which received packets a miner gets.
+
+A virtual gateway config may contain a "routing" list of rules, a packet is sent to the miner if any rule matches.
+Every field of a rule is optional, a missing field matches anything:
+
+    "routing": [
+        {"gateways": ["AA555A0000000001"], "chan": [0, 1, 2], "datr": ["SF8BW125", "SF9BW125"], "size": [48, 80]}
+    ]
+
+Rules of all virtual gateways are compiled into one bitmask per value of each field (bit i set if rule i accepts the
+value), so the rules matching a packet are the AND of four dictionary lookups.  Results are cached by (source MAC,
+channel, datr, size) so finding the miners for a packet is a single dictionary lookup in the common case.
+"""
+
+import bisect
+import logging
+
+CACHE_MAX = 65536  # cached routing results, cleared when full to keep memory bounded
+
+
+def normalize_mac(mac):
+    """
+    :param mac: MAC string with or without ':' separators
+    :return: upper case ':' separated MAC
+    """
+    mac = mac.replace(':', '').upper()
+    if len(mac) != 16:
+        raise ValueError(f"invalid gateway MAC {mac}")
+    return ':'.join(mac[i:i + 2] for i in range(0, 16, 2))
+
+
+def parse_rules(raw):
+    """
+    :param raw: value of "routing" in a virtual gateway config
+    :return: list of rules as tuples (gateways, chans, datrs, size) where each is None (match anything), a frozenset or
+        for size a (min, max) tuple
+    :raises ValueError: if rules are malformed
+    """
+    if not isinstance(raw, list):
+        raise ValueError("routing must be a list of rules")
+    rules = []
+    for rule in raw:
+        if not isinstance(rule, dict) or set(rule) - {'gateways', 'chan', 'datr', 'size'}:
+            raise ValueError(f"invalid routing rule {rule}")
+        gateways = frozenset(normalize_mac(mac) for mac in rule['gateways']) if 'gateways' in rule else None
+        chans = frozenset(int(chan) for chan in rule['chan']) if 'chan' in rule else None
+        datrs = frozenset(str(datr).upper() for datr in rule['datr']) if 'datr' in rule else None
+        size = None
+        if 'size' in rule:
+            size = tuple(int(limit) for limit in rule['size'])
+            if len(size) != 2 or size[0] > size[1]:
+                raise ValueError(f"routing rule size must be [min, max], got {rule['size']}")
+        rules.append((gateways, chans, datrs, size))
+    return rules
+
+
+def _value_masks(rules, field):
+    """
+    :return: tuple of (dictionary of value -> mask of rules accepting it, mask of rules accepting any value)
+    """
+    wildcard = 0
+    listed = dict()
+    for i, rule in enumerate(rules):
+        if rule[field] is None:
+            wildcard |= 1 << i
+        else:
+            for value in rule[field]:
+                listed[value] = listed.get(value, 0) | 1 << i
+    return {value: mask | wildcard for value, mask in listed.items()}, wildcard
+
+
+class RoutingIndex:
+    def __init__(self, vgateways):
+        """
+        :param vgateways: list of VirtualGateway in fan-out order, vgw.routing_rules is None to receive everything
+        """
+        self.vgateways = vgateways
+        rules = []
+        self.rule_vgw = []  # vGW index of each rule
+        for index, vgw in enumerate(vgateways):
+            for rule in (vgw.routing_rules if vgw.routing_rules is not None else [(None, None, None, None)]):
+                rules.append(rule)
+                self.rule_vgw.append(index)
+        self.src_masks, self.src_wildcard = _value_masks(rules, 0)
+        self.chan_masks, self.chan_wildcard = _value_masks(rules, 1)
+        self.datr_masks, self.datr_wildcard = _value_masks(rules, 2)
+
+        # sizes are split into ranges at every rule limit, each range has one mask
+        self.size_bounds = sorted({limit for rule in rules if rule[3] for limit in (rule[3][0], rule[3][1] + 1)})
+        self.size_masks = []
+        for bucket in range(len(self.size_bounds) + 1):
+            low = self.size_bounds[bucket - 1] if bucket else -1
+            mask = 0
+            for i, rule in enumerate(rules):
+                if rule[3] is None or rule[3][0] <= low <= rule[3][1]:
+                    mask |= 1 << i
+            self.size_masks.append(mask)
+        self.cache = dict()
+        logging.getLogger('Routing').info(f"compiled {len(rules)} routing rules for {len(vgateways)} vgateways")
+
+    def targets(self, rxpk, src_mac):
+        """
+        :param rxpk: rxpk dictionary
+        :param src_mac: MAC of gateway that received rxpk
+        :return: tuple of VirtualGateway the rxpk is routed to, in fan-out order
+        """
+        key = (src_mac, rxpk.get('chan'), rxpk.get('datr'), rxpk.get('size'))
+        targets = self.cache.get(key)
+        if targets is None:
+            if len(self.cache) >= CACHE_MAX:
+                self.cache.clear()
+            targets = self.cache[key] = self._match(*key)
+        return targets
+
+    def _match(self, src_mac, chan, datr, size):
+        mask = (self.src_masks.get(src_mac, self.src_wildcard) & self.chan_masks.get(chan, self.chan_wildcard)
+                & self.datr_masks.get(datr, self.datr_wildcard)
+                & self.size_masks[bisect.bisect_right(self.size_bounds, size if size is not None else -1)])
+        indexes = set()
+        while mask:
+            low = mask & -mask
+            indexes.add(self.rule_vgw[low.bit_length() - 1])
+            mask ^= low
+        return tuple(self.vgateways[index] for index in sorted(indexes))
@@ -0,0 +1,176 @@
+"""
+Coordination between worker processes when running with multiple workers (--workers N).
+
+Every worker binds the gateway port with SO_REUSEPORT so the kernel spreads gateways (and miners) across workers.
+A transmission heard by two gateways can land on two different workers, so de-duplication is done by the worker that
+owns the rxpk key (key hash modulo number of workers).  Non owners forward the rxpk to the owner over a localhost
+socket.  Gateway addresses learned from PULL_DATA are broadcast to all workers so any worker can route a PULL_RESP.
+A TX_ACK received by a worker that did not forward the PULL_RESP it answers is broadcast to the other workers.
+The tmst offset of a virtual gateway is learned by the worker that forwards rxpks its gateway received, it is broadcast
+so all workers rewrite tmst and schedule downlinks against the same gateway clock.  With --schedule-downlinks each
+worker observes the copies it received and broadcasts the observations, so any worker can send a PULL_RESP through
+the gateway that heard the device best.
+"""
+
+import json
+import logging
+import socket
+import time
+import zlib
+
+
+# internal message types
+MSG_RXPK = 'rxpk'       # rxpks for owner to de-duplicate and forward
+MSG_GATEWAY = 'gw'      # gateway MAC discovered at (ip, port)
+MSG_STAT = 'stat'       # stat counters from a worker for stat messages sent by worker 0
+MSG_TX_ACK = 'txack'    # TX_ACK for the worker that forwarded the PULL_RESP
+MSG_OFFSET = 'offset'   # tmst offset of a virtual gateway, see modify_rxpk.RXMetadataModification
+MSG_OBSERVE = 'observe' # uplinks a gateway heard, see downlink.DownlinkScheduler.apply
+
+# tmst offsets only drift slowly, they are broadcast when they moved by more than this or after this many seconds
+OFFSET_TOLERANCE_US = 10000
+OFFSET_INTERVAL = 60
+
+
+def create_internal_sockets(count):
+    """
+    create one localhost socket per worker, must be called before starting workers so each knows the others
+    :param count: number of workers
+    :return: list of bound sockets
+    """
+    socks = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        socks.append(sock)
+    return socks
+
+
+def key_hash(key):
+    """
+    hash of rxpk key that is stable across processes (python hash() is salted per process)
+    :param key: rxpk key
+    :return: unsigned int
+    """
+    if isinstance(key, int):
+        return key
+    return zlib.crc32(repr(key).encode())
+
+
+class ShardRouter:
+    def __init__(self, index, socks, clock=time.time):
+        """
+        :param index: index of this worker
+        :param socks: list of internal sockets for all workers from create_internal_sockets
+        :param clock: function returning current unix timestamp
+        """
+        self.index = index
+        self.clock = clock
+        self.offsets_shared = dict()  # keys = vGW MAC, values = (tmst offset, ts) last broadcast
+        self.count = len(socks)
+        self.sock = socks[index]
+        self.sock.setblocking(False)
+        self.peer_addrs = [s.getsockname() for s in socks]
+        # this worker only needs its own socket
+        for i, s in enumerate(socks):
+            if i != index:
+                s.close()
+        self.logger = logging.getLogger(f"Shard{index}")
+
+    @property
+    def is_primary(self):
+        """
+        primary worker sends keepalive and stat messages on behalf of all workers
+        """
+        return self.index == 0
+
+    def owner(self, key):
+        return key_hash(key) % self.count
+
+    def owns(self, key):
+        return self.owner(key) == self.index
+
+    def send(self, index, msg):
+        try:
+            self.sock.sendto(json.dumps(msg).encode(), self.peer_addrs[index])
+        except OSError as e:
+            self.logger.error(f"failed to send {msg.get('t')} to worker {index}: {e}")
+
+    def broadcast(self, msg):
+        for i in range(self.count):
+            if i != self.index:
+                self.send(i, msg)
+
+    def forward_rxpks(self, index, rxpks, src_mac, tx_mac=None):
+        """
+        send rxpks to owning worker for de-duplication and forwarding
+        :param index: owner worker index
+        :param rxpks: list of rxpk dictionaries
+        :param src_mac: MAC of gateway that received rxpks
+        :param tx_mac: MAC of virtual gateway if rxpks are generated from PULL_RESP
+        :return:
+        """
+        self.send(index, dict(t=MSG_RXPK, MAC=src_mac, txMAC=tx_mac, rxpk=rxpks))
+
+    def broadcast_gateway(self, mac, addr):
+        self.broadcast(dict(t=MSG_GATEWAY, MAC=mac, addr=list(addr)))
+
+    def broadcast_tx_ack(self, mac, token, data):
+        self.broadcast(dict(t=MSG_TX_ACK, MAC=mac, token=token, data=data))
+
+    def broadcast_observations(self, mac, observations):
+        """
+        :param mac: MAC of gateway that heard the uplinks
+        :param observations: list of tuples returned by DownlinkScheduler.observe
+        :return:
+        """
+        observations = [[device.hex() if device is not None else None, lsnr, rssi, tmst_offset, join_us]
+                        for device, lsnr, rssi, tmst_offset, join_us in observations
+                        if device is not None or tmst_offset is not None]
+        if observations:
+            self.broadcast(dict(t=MSG_OBSERVE, MAC=mac, obs=observations))
+
+    def share_offset(self, mac, offset):
+        """
+        broadcast tmst offset of a virtual gateway if it moved since it was last broadcast
+        :param mac: MAC of virtual gateway
+        :param offset: RXMetadataModification.tmst_offset
+        :return:
+        """
+        now = self.clock()
+        shared = self.offsets_shared.get(mac)
+        if shared is not None and now - shared[1] < OFFSET_INTERVAL and \
+                abs((offset - shared[0] + 2**31) % 2**32 - 2**31) <= OFFSET_TOLERANCE_US:
+            return
+        self.offsets_shared[mac] = (offset, now)
+        self.broadcast(dict(t=MSG_OFFSET, MAC=mac, offset=offset))
+
+    def send_stat(self, counts):
+        """
+        send stat counts since last call to primary worker
+        :param counts: dictionary of vGW MAC to dictionary of counter name (vgateway.STAT_COUNTERS) to count
+        :return:
+        """
+        self.send(0, dict(t=MSG_STAT, counts=counts))
+
+    def recv(self):
+        """
+        read all pending internal messages without blocking
+        :return: list of message dictionaries
+        """
+        msgs = []
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except (BlockingIOError, socket.timeout):
+                break
+            except ConnectionResetError:
+                continue
+            try:
+                msgs.append(json.loads(data.decode()))
+            except ValueError:
+                self.logger.error(f"invalid internal message from {addr}")
+        return msgs
+
+    def fileno(self):
+        return self.sock.fileno()
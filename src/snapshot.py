@@ -0,0 +1,243 @@
+"""
+Snapshot of forwarding state so a restart does not start cold.
+
+Without it a restart forgets the de-duplication cache (copies still in flight are forwarded again), the addresses of
+gateways (PULL_RESP cannot be sent until each gateway's next PULL_DATA) and the tmst offset of each virtual gateway
+(tmst of forwarded packets jumps).
+
+File layout, all little endian:
+
+    header      MAGIC, crc32 of everything after the header, unix timestamp saved, number of dedup keys, gateways
+                and offsets (_HEADER)
+    keys        dedup keys as uint64, in no particular order
+    timestamps  unix timestamp of each dedup key as float64
+    gateways    per gateway: MAC, length of packed ip (4 or 16), port, packed ip padded to 16 bytes (_GATEWAY)
+    offsets     per virtual gateway: MAC, tmst offset (_OFFSET)
+
+Keys and timestamps are stored as columns so they are read straight from the memory mapped file.  The packet loop only
+copies state into lists (about 2ms for 100k keys, see DedupCache.columns), packing, writing and fsync happen on a
+background thread.  A snapshot is written to a temporary file and renamed over the previous one so a crash
+leaves either the old or the new snapshot, never a partial one.
+"""
+
+import logging
+import mmap
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+
+from .messages import mac_from_bytes, mac_to_bytes
+
+MAGIC = b'GW2MSNP1'
+_HEADER = struct.Struct('<8sIdIII')
+_GATEWAY = struct.Struct('<8sBH16s')
+_OFFSET = struct.Struct('<8sI')
+_FAMILIES = {4: socket.AF_INET, 16: socket.AF_INET6}
+PACK_CHUNK = 4096  # values converted per call so the writer thread holds the GIL only briefly
+
+
+class SnapshotState:
+    __slots__ = ('saved_ts', 'dedup', 'gateways', 'offsets')
+
+    def __init__(self, saved_ts, dedup, gateways, offsets):
+        """
+        :param saved_ts: unix timestamp snapshot was taken
+        :param dedup: list of (key, ts) in no particular order
+        :param gateways: dictionary of gateway MAC -> (ip, port)
+        :param offsets: dictionary of virtual gateway MAC -> tmst offset
+        """
+        self.saved_ts = saved_ts
+        self.dedup = dedup
+        self.gateways = gateways
+        self.offsets = offsets
+
+
+def _column(typecode, values):
+    column = array(typecode)
+    for i in range(0, len(values), PACK_CHUNK):
+        column.extend(values[i:i + PACK_CHUNK])
+        time.sleep(0)  # let the packet loop take the GIL without waiting for the switch interval
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+
+def pack_snapshot(saved_ts, keys, timestamps, gateways, offsets):
+    """
+    :param saved_ts: unix timestamp of snapshot
+    :param keys: list of dedup keys
+    :param timestamps: list of dedup timestamps, same length as keys
+    :param gateways: dictionary of gateway MAC -> (ip, port)
+    :param offsets: dictionary of virtual gateway MAC -> tmst offset
+    :return: list of bytes-like chunks making up the file
+    """
+    records = []
+    for mac, addr in gateways.items():
+        ip = socket.inet_pton(socket.AF_INET6 if ':' in addr[0] else socket.AF_INET, addr[0])
+        records.append(_GATEWAY.pack(mac_to_bytes(mac), len(ip), addr[1], ip))
+    for mac, offset in offsets.items():
+        records.append(_OFFSET.pack(mac_to_bytes(mac), offset))
+    chunks = [_column('Q', keys), _column('d', timestamps), b''.join(records)]
+    crc = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+    header = _HEADER.pack(MAGIC, crc, saved_ts, len(keys), len(gateways), len(offsets))
+    return [header] + chunks
+
+
+def write_snapshot(path, chunks):
+    """
+    write snapshot atomically: temporary file, fsync, rename, fsync of directory
+    :param path: path of snapshot
+    :param chunks: bytes-like chunks from pack_snapshot
+    :return:
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as fd:
+        for chunk in chunks:
+            fd.write(chunk)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def read_snapshot(path):
+    """
+    :param path: path of snapshot written by write_snapshot
+    :return: SnapshotState
+    :raises ValueError: if file is not a complete snapshot
+    :raises OSError: if file cannot be read
+    """
+    with open(path, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size < _HEADER.size:
+            raise ValueError(f"{path} is too short for a snapshot")
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            magic, crc, saved_ts, n_keys, n_gateways, n_offsets = _HEADER.unpack_from(view)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a snapshot")
+            expected = _HEADER.size + n_keys * 16 + n_gateways * _GATEWAY.size + n_offsets * _OFFSET.size
+            if size != expected:
+                raise ValueError(f"snapshot {path} has {size} bytes, expected {expected}")
+            if zlib.crc32(view[_HEADER.size:]) != crc:
+                raise ValueError(f"snapshot {path} failed checksum")
+
+            offset = _HEADER.size
+            if sys.byteorder == 'little':
+                with view[offset:offset + n_keys * 8].cast('Q') as keys, \
+                        view[offset + n_keys * 8:offset + n_keys * 16].cast('d') as timestamps:
+                    dedup = list(zip(keys.tolist(), timestamps.tolist()))
+            else:
+                keys, timestamps = array('Q'), array('d')
+                keys.frombytes(view[offset:offset + n_keys * 8])
+                timestamps.frombytes(view[offset + n_keys * 8:offset + n_keys * 16])
+                keys.byteswap()
+                timestamps.byteswap()
+                dedup = list(zip(keys, timestamps))
+            offset += n_keys * 16
+
+            gateways = dict()
+            for mac, ip_len, port, ip in _GATEWAY.iter_unpack(view[offset:offset + n_gateways * _GATEWAY.size]):
+                if ip_len not in _FAMILIES:
+                    raise ValueError(f"corrupt snapshot {path}, invalid address length {ip_len}")
+                gateways[mac_from_bytes(mac)] = (socket.inet_ntop(_FAMILIES[ip_len], ip[:ip_len]), port)
+            offset += n_gateways * _GATEWAY.size
+            offsets = {mac_from_bytes(mac): tmst_offset
+                       for mac, tmst_offset in _OFFSET.iter_unpack(view[offset:offset + n_offsets * _OFFSET.size])}
+    return SnapshotState(saved_ts, dedup, gateways, offsets)
+
+
+class StateSnapshot:
+    def __init__(self, path, interval=30, max_age=300, clock=time.time):
+        """
+        periodic snapshots of forwarding state to path, see module docstring
+        :param path: path of snapshot file
+        :param interval: seconds between snapshots
+        :param max_age: seconds after which a snapshot is too old to restore gateway addresses and tmst offsets
+        :param clock: unix time function, replaceable for testing
+        """
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.clock = clock
+        self.last_save_ts = clock()
+        self.thread = None
+        self.logger = logging.getLogger('Snapshot')
+
+        # counters for stats
+        self.saves = 0
+        self.skipped = 0  # snapshots not taken because previous write was still running
+        self.errors = 0
+        self.last_duration = 0.0
+
+    def due(self):
+        return self.clock() - self.last_save_ts >= self.interval
+
+    def save(self, dedup_cache, gateways, offsets, wait=False):
+        """
+        copy state and write it on a background thread
+        :param dedup_cache: DedupCache
+        :param gateways: dictionary of gateway MAC -> (ip, port)
+        :param offsets: dictionary of virtual gateway MAC -> tmst offset
+        :param wait: write on calling thread, e.g. on shutdown
+        :return: True if a snapshot is being written
+        """
+        self.last_save_ts = self.clock()
+        if self.thread and self.thread.is_alive():
+            if not wait:
+                self.skipped += 1
+                return False
+            self.thread.join()
+        args = (self.last_save_ts, *dedup_cache.columns(), dict(gateways), dict(offsets))
+        if wait:
+            self._write(*args)
+        else:
+            self.thread = threading.Thread(target=self._write, args=args, name='snapshot', daemon=True)
+            self.thread.start()
+        return True
+
+    def _write(self, *state):
+        start = time.perf_counter()
+        try:
+            write_snapshot(self.path, pack_snapshot(*state))
+        except OSError as e:
+            self.errors += 1
+            self.logger.error(f"could not write snapshot {self.path}: {e}")
+            return
+        self.saves += 1
+        self.last_duration = time.perf_counter() - start
+        self.logger.debug(f"wrote snapshot {self.path} in {self.last_duration * 1e3:.1f}ms")
+
+    def load(self):
+        """
+        :return: SnapshotState or None if there is no usable snapshot.  gateways and offsets are empty if the snapshot
+            is older than max_age, dedup keys are filtered by the caller's ttl
+        """
+        try:
+            state = read_snapshot(self.path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.logger.error(f"ignoring snapshot {self.path}: {e}")
+            return None
+        age = self.clock() - state.saved_ts
+        if age > self.max_age:
+            self.logger.info(f"snapshot {self.path} is {age:.0f}s old, only restoring de-duplication keys")
+            state.gateways, state.offsets = dict(), dict()
+        return state
+
+    def stats(self):
+        """
+        :return: dictionary of snapshot counters
+        """
+        return dict(saves=self.saves, skipped=self.skipped, errors=self.errors, last_ms=self.last_duration * 1e3)
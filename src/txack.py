@@ -0,0 +1,157 @@
+"""
+Lifecycle of downlinks: PULL_RESP from a miner, forwarded to a gateway, answered by that gateway's TX_ACK.
+
+Every PULL_RESP forwarded to a gateway is remembered by (gateway MAC, token) until a TX_ACK with the same token arrives
+from that gateway or timeout expires.  For each downlink is recorded:
+
+    forward  seconds from receiving the PULL_RESP to sending it to the gateway
+    ack      seconds from sending it to the gateway's TX_ACK, backhaul round trip plus gateway processing
+    lead     seconds left until the transmit time (tmst on the virtual gateway clock) when the PULL_RESP was received.
+             RX1 opens 1s after the uplink, so 1s minus lead is what the miner and the uplink path used.  Downlinks
+             whose lead is shorter than the gateway's backhaul latency come back as TOO_LATE
+
+and the result per gateway and per miner: the TX_ACK error (NONE if transmitted, TOO_LATE, TOO_EARLY,
+COLLISION_PACKET, COLLISION_BEACON, TX_FREQ, TX_POWER, GPS_UNLOCKED) or 'timeout' when no TX_ACK arrived.  Packet
+forwarders older than protocol v2 never send TX_ACK, all their downlinks time out.
+"""
+
+import time
+from collections import OrderedDict
+
+from .metrics import Histogram
+from .modify_rxpk import rx_clock
+
+RESULT_SENT = 'NONE'
+RESULT_TIMEOUT = 'timeout'
+
+_U32 = 2 ** 32
+
+
+def lead_seconds(txpk, tmst_offset):
+    """
+    :param txpk: txpk dictionary of PULL_RESP from miner
+    :param tmst_offset: tmst offset of the miner's virtual gateway clock (RXMetadataModification.tmst_offset)
+    :return: seconds from now until txpk is to be transmitted, None if it is sent immediately or at a GPS time
+    """
+    if 'tmst' not in txpk or txpk.get('imme'):
+        return None
+    now_us, _ = rx_clock({})
+    return ((txpk['tmst'] - now_us - tmst_offset + 2 ** 31) % _U32 - 2 ** 31) / 1e6
+
+
+def ack_result(data):
+    """
+    :param data: JSON payload of TX_ACK or None, e.g. {"txpk_ack": {"error": "TOO_LATE"}}
+    :return: error code, RESULT_SENT if the gateway transmitted (possibly with a warning such as adjusted power)
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('txpk_ack'), dict):
+        return RESULT_SENT
+    return str(data['txpk_ack'].get('error', RESULT_SENT))
+
+
+class TxAckTracker:
+    def __init__(self, max_in_flight=4096, timeout=10, clock=time.time):
+        """
+        :param max_in_flight: downlinks waiting for TX_ACK, the oldest counts as timed out when exceeded
+        :param timeout: seconds to wait for TX_ACK
+        :param clock: unix time function, same clock as message _UNIX_TS_, replaceable for testing
+        """
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.clock = clock
+        self.in_flight = OrderedDict()  # keys = (gateway MAC, token), values = (vGW MAC, sent ts)
+        self.by_gateway = dict()  # keys = gateway MAC, values = dict of result -> count
+        self.by_miner = dict()  # keys = vGW MAC, values = dict of result -> count
+        self.ack_latency = dict()  # keys = gateway MAC, values = Histogram of seconds from send to TX_ACK
+        self.lead = dict()  # keys = vGW MAC, values = Histogram of seconds until transmit time when received
+        self.forward_latency = Histogram()
+        self.late_on_arrival = 0  # PULL_RESP whose transmit time had already passed
+        self.unmatched = 0  # TX_ACK for no downlink in flight
+
+    def sent(self, gw_mac, token, vgw_mac, received_ts, lead=None):
+        """
+        record a PULL_RESP forwarded to a gateway
+        :param gw_mac: MAC of gateway PULL_RESP was sent to
+        :param token: token of PULL_RESP, echoed by TX_ACK
+        :param vgw_mac: MAC of virtual gateway of the miner that sent it
+        :param received_ts: unix timestamp PULL_RESP was received
+        :param lead: seconds until transmit time when received, None for immediate or GPS time transmits
+        :return:
+        """
+        now = self.clock()
+        self.forward_latency.observe(max(now - received_ts, 0.0))
+        if lead is not None:
+            if lead <= 0:
+                self.late_on_arrival += 1
+            self.lead.setdefault(vgw_mac, Histogram()).observe(max(lead, 0.0))
+        key = (gw_mac, token)
+        previous = self.in_flight.pop(key, None)
+        if previous is not None:
+            # token reused before the first downlink was acknowledged
+            self._count(gw_mac, previous[0], RESULT_TIMEOUT)
+        self.in_flight[key] = (vgw_mac, now)
+        if len(self.in_flight) > self.max_in_flight:
+            (old_gw_mac, _), (old_vgw_mac, _) = self.in_flight.popitem(last=False)
+            self._count(old_gw_mac, old_vgw_mac, RESULT_TIMEOUT)
+
+    def acked(self, gw_mac, token, data=None):
+        """
+        match a TX_ACK to the downlink it answers
+        :param gw_mac: MAC of gateway that sent TX_ACK
+        :param token: token of TX_ACK
+        :param data: JSON payload of TX_ACK or None
+        :return: tuple of (vGW MAC, result) or (None, None) if no downlink is waiting for this TX_ACK
+        """
+        entry = self.in_flight.pop((gw_mac, token), None)
+        if entry is None:
+            self.unmatched += 1
+            return None, None
+        vgw_mac, sent_ts = entry
+        result = ack_result(data)
+        self.ack_latency.setdefault(gw_mac, Histogram()).observe(max(self.clock() - sent_ts, 0.0))
+        self._count(gw_mac, vgw_mac, result)
+        return vgw_mac, result
+
+    def expire(self):
+        """
+        count downlinks without TX_ACK after timeout, called from the packet loop
+        :return: number of downlinks that timed out
+        """
+        cutoff = self.clock() - self.timeout
+        expired = 0
+        while self.in_flight:
+            (gw_mac, token), (vgw_mac, sent_ts) = next(iter(self.in_flight.items()))
+            if sent_ts > cutoff:
+                break
+            del self.in_flight[(gw_mac, token)]
+            self._count(gw_mac, vgw_mac, RESULT_TIMEOUT)
+            expired += 1
+        return expired
+
+    def _count(self, gw_mac, vgw_mac, result):
+        by_gateway = self.by_gateway.setdefault(gw_mac, dict())
+        by_gateway[result] = by_gateway.get(result, 0) + 1
+        by_miner = self.by_miner.setdefault(vgw_mac, dict())
+        by_miner[result] = by_miner.get(result, 0) + 1
+
+    def report(self):
+        """
+        :return: list of lines with results and latencies per gateway and per miner, empty if there were no downlinks
+        """
+        lines = []
+        for mac, results in list(self.by_gateway.items()):
+            hist = self.ack_latency.get(mac)
+            latency = f", TX_ACK after p50:{hist.percentile(50) * 1e3:.0f}ms p99:{hist.percentile(99) * 1e3:.0f}ms" if hist else ''
+            lines.append(f"gateway {mac[-8:]}: {results}{latency}")
+        for mac, results in list(self.by_miner.items()):
+            hist = self.lead.get(mac)
+            lead = f", lead p1:{hist.percentile(1) * 1e3:.0f}ms p50:{hist.percentile(50) * 1e3:.0f}ms" if hist else ''
+            lines.append(f"miner {mac[-8:]}: {results}{lead}")
+        return lines
+
+    def stats(self):
+        """
+        :return: dictionary of tracker counters
+        """
+        return dict(in_flight=len(self.in_flight), unmatched=self.unmatched, late_on_arrival=self.late_on_arrival,
+                    forward_p99_ms=self.forward_latency.percentile(99) * 1e3)
@@ -6,31 +6,48 @@ import logging
 if __name__ == "__main__":
     from modify_rxpk import RXMetadataModification
     from messages import decode_message, encode_message, MsgPullData, MsgPushData, MsgPullResp
+    from messages import encode_rxpk, encode_push_data_rxpks, mac_to_bytes
 else:
     from .modify_rxpk import RXMetadataModification
     from .messages import decode_message, encode_message, MsgPullData, MsgPushData, MsgPullResp
+    from .messages import encode_rxpk, encode_push_data_rxpks, mac_to_bytes
+
+# stat counters that workers report to the primary worker, which sends stat messages
+STAT_COUNTERS = ('rxnb', 'txnb', 'dwnb', 'push_sent', 'push_acked')
 
 
 class VirtualGateway:
-    def __init__(self, mac, server_address, port_up, port_dn):
+    def __init__(self, mac, server_address, port_up, port_dn, server_host=None):
         """
 
         :param mac:
         :param socket:
-        :param server_address:
+        :param server_address: IP of miner
         :param port_up:
         :param port_dn:
+        :param server_host: host name server_address was resolved from, defaults to server_address
         """
         # port
         self.mac = mac
+        self.mac_bytes = mac_to_bytes(mac)
         self.port_up = port_up
         self.port_dn = port_dn
         self.server_address = server_address
+        self.server_host = server_host or server_address
+        self.routing_rules = None  # parsed rules of src.routing, None receives all packets
 
 
         # counts number of received and transmitted packets for stats
         self.rxnb = 0
+        # downlinks the gateway reported as transmitted in its TX_ACK and PULL_RESP received from miner since last stat
         self.txnb = 0
+        self.dwnb = 0
+        # PUSH_DATA sent and PUSH_ACK received since last stat, for ackr
+        self.push_sent = 0
+        self.push_acked = 0
+        # totals for metrics, never reset
+        self.rxpks_sent = 0
+        self.datagrams_sent = 0
 
 
         # payload modifier
@@ -45,15 +62,19 @@ class VirtualGateway:
         if no message should be sent returns None, None
         :return:
         """
+        # like the packet forwarder, ackr, txnb and dwnb count since the last stat
+        ackr = min(100.0, round(100.0 * self.push_acked / self.push_sent, 1)) if self.push_sent else 0.0
+        txnb, dwnb = self.txnb, self.dwnb
+        self.push_sent = self.push_acked = self.txnb = self.dwnb = 0
         payload = dict(
             stat=dict(
                 time=dt.datetime.utcnow().isoformat()[:19] + " GMT",
                 rxnb=self.rxnb,
                 rxok=self.rxnb,
                 rxfw=self.rxnb,
-                txnb=self.txnb,
-                dwnb=self.txnb,
-                ackr=100.0
+                txnb=txnb,
+                dwnb=dwnb,
+                ackr=ackr
             )
         )
         return self.__get_PUSH_DATA__(payload)
@@ -76,9 +97,51 @@ class VirtualGateway:
         payload = dict(rxpk=new_rxpks)
 
         self.rxnb += len(new_rxpks)
-        self.logger.debug(f"sending PUSH_DATA with {len(new_rxpks)} packets from vGW:{self.mac[-8:]} to miner {(self.server_address, self.port_up)}")
+        self.logger.debug("sending PUSH_DATA with %d packets from vGW:%s to miner %s", len(new_rxpks), self.mac[-8:], (self.server_address, self.port_up))
         return self.__get_PUSH_DATA__(payload)
 
+    def get_rxpks_from_templates(self, rxpks, templates, src_mac, metadata=None):
+        """
+        build PUSH_DATA for miner from rxpks shared with all other virtual gateways.  Only the modified metadata is
+        serialized here, the rest of each rxpk is already serialized in templates
+        :param rxpks: list of rxpk dictionaries, not modified
+        :param templates: list of serialized rxpk fields from messages.rxpk_template, same order as rxpks
+        :param src_mac: MAC of gateway that received rxpks
+        :param metadata: list of (tmst, rssi, lsnr) for this vGW from modify_rxpk.modify_rxpks, computed if None
+        :return: data, address
+        """
+        return self.get_PUSH_DATA_rxpks(self.encode_rxpks(rxpks, templates, src_mac, metadata))
+
+    def encode_rxpks(self, rxpks, templates, src_mac, metadata=None):
+        """
+        serialize rxpks with metadata modified for this virtual gateway
+        :param rxpks: list of rxpk dictionaries, not modified
+        :param templates: list of serialized rxpk fields from messages.rxpk_template, same order as rxpks
+        :param src_mac: MAC of gateway that received rxpks
+        :param metadata: list of (tmst, rssi, lsnr) for this vGW from modify_rxpk.modify_rxpks, computed if None
+        :return: list of serialized rxpks
+        """
+        if metadata is None:
+            metadata = [self.rxmodifier.modify_metadata(rx, src_mac=src_mac, dest_mac=self.mac) for rx in rxpks]
+        rxpks_raw = [encode_rxpk(template, tmst, rssi, lsnr) for template, (tmst, rssi, lsnr) in zip(templates, metadata)]
+        self.rxnb += len(rxpks_raw)
+        self.rxpks_sent += len(rxpks_raw)
+        return rxpks_raw
+
+    def get_PUSH_DATA_rxpks(self, rxpks_raw):
+        """
+        build PUSH_DATA for miner from serialized rxpks
+        :param rxpks_raw: list of serialized rxpks from encode_rxpks
+        :return: data, address
+        """
+        if not rxpks_raw:
+            return None, None
+        self.logger.debug("sending PUSH_DATA with %d packets from vGW:%s to miner %s", len(rxpks_raw), self.mac[-8:], (self.server_address, self.port_up))
+        payload_raw = encode_push_data_rxpks(random.randint(0, 2**16-1), self.mac_bytes, rxpks_raw)
+        self.datagrams_sent += 1
+        self.push_sent += 1
+        return payload_raw, (self.server_address, self.port_up)
+
     def __get_PUSH_DATA__(self, payload):
         """
         Sends PUSH_DATA message to miner with payload contents
@@ -94,6 +157,8 @@ class VirtualGateway:
             data=payload
         )
         payload_raw = encode_message(top)
+        self.datagrams_sent += 1
+        self.push_sent += 1
         return payload_raw, (self.server_address, self.port_up)
 
     def get_PULL_DATA(self):
@@ -105,4 +170,5 @@ class VirtualGateway:
             MAC=self.mac
         )
         payload_raw = encode_message(payload)
+        self.datagrams_sent += 1
         return payload_raw, (self.server_address, self.port_dn)
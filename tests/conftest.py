@@ -0,0 +1,17 @@
+import pytest
+
+
+class FakeClock:
+    def __init__(self, ts=1000.0):
+        self.ts = ts
+
+    def __call__(self):
+        return self.ts
+
+
+@pytest.fixture
+def clock():
+    """
+    clock function for classes taking a clock argument, time only moves when a test changes clock.ts
+    """
+    return FakeClock()
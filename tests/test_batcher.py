@@ -0,0 +1,33 @@
+from src import messages
+from src.batcher import PushDataBatcher
+from src.vgateway import VirtualGateway
+
+
+def rxpk_raw(i):
+    rx = dict(tmst=i, chan=0, rfch=0, freq=904.1, stat=1, modu='LORA', datr='SF9BW125', codr='4/5', lsnr=1.0,
+              rssi=-100, size=52, data='A' * 72)
+    return messages.encode_rxpk(messages.rxpk_template(rx), i, -100, 1.0)
+
+
+def test_batch_sent_after_window(clock):
+    batcher = PushDataBatcher(window=0.01, clock=clock)
+    vgw = VirtualGateway('AA:55:5A:00:00:00:00:01', '127.0.0.1', port_up=1680, port_dn=1680)
+    assert batcher.add(vgw, [rxpk_raw(1)]) == []
+    assert batcher.add(vgw, [rxpk_raw(2), rxpk_raw(3)]) == []
+    assert batcher.flush_due() == []
+    clock.ts += 0.01
+    ready = batcher.flush_due()
+    assert len(ready) == 1
+    msg = messages.decode_message(ready[0][0])
+    assert [rx['tmst'] for rx in msg['data']['rxpk']] == [1, 2, 3]
+    assert batcher.next_deadline() is None
+    assert batcher.stats()['datagrams_saved'] == 1
+
+
+def test_batch_never_exceeds_max_size(clock):
+    batcher = PushDataBatcher(window=1, max_size=600, clock=clock)
+    vgw = VirtualGateway('AA:55:5A:00:00:00:00:01', '127.0.0.1', port_up=1680, port_dn=1680)
+    ready = batcher.add(vgw, [rxpk_raw(i) for i in range(10)])
+    ready += batcher.flush_all()
+    assert sum(len(messages.decode_message(data)['data']['rxpk']) for data, addr in ready) == 10
+    assert all(len(data) <= 600 for data, addr in ready)
@@ -0,0 +1,97 @@
+import datetime
+import json
+
+import pytest
+
+from src import messages
+from src.best_copy import BestCopySelector, TimerWheel
+from src.modify_rxpk import rx_clock
+from gateways2miners import GW2Miner
+
+
+def rxpk(rssi, lsnr=5.0, data='QUJD', time_field=None):
+    rx = dict(tmst=1, chan=0, rfch=0, freq=904.1, stat=1, modu='LORA', datr='SF9BW125', codr='4/5', lsnr=lsnr,
+              rssi=rssi, size=3, data=data)
+    if time_field:
+        rx['time'] = time_field
+    return rx
+
+
+def test_timer_wheel_expires_in_order():
+    wheel = TimerWheel(1.0, tick=0.001, slots=8)
+    wheel.schedule(1.005, 'b')
+    wheel.schedule(1.002, 'a')
+    wheel.schedule(1.020, 'c')  # more than one revolution away
+    assert wheel.expire(1.001) == []
+    assert wheel.next_deadline() == pytest.approx(1.002)
+    assert wheel.expire(1.010) == ['a', 'b']
+    assert wheel.expire(1.019) == []
+    assert wheel.expire(5.0) == ['c']
+    assert wheel.next_deadline() is None
+
+
+def test_best_rssi_forwarded_after_window(clock):
+    selector = BestCopySelector(window=0.02, scorer='rssi', clock=clock)
+    selector.hold(1, rxpk(-110), 'GW1')
+    assert selector.add_copy(1, rxpk(-90), 'GW2')
+    assert selector.add_copy(1, rxpk(-100), 'GW3')
+    assert selector.flush_due() == []
+    clock.ts += 0.021
+    [(best, src_mac, gateways, received)] = selector.flush_due()
+    assert (best['rssi'], src_mac, gateways) == (-90, 'GW2', 3)
+    assert not selector.add_copy(1, rxpk(-80), 'GW4')
+    assert selector.stats()['heard_by'] == {3: 1}
+
+
+def test_gps_scorer_prefers_gps_copy_then_first(clock):
+    selector = BestCopySelector(window=0.02, scorer='gps', clock=clock)
+    now = datetime.datetime.utcnow().isoformat() + 'Z'
+    selector.hold(1, rxpk(-80), 'GW1')
+    selector.add_copy(1, rxpk(-100, time_field=now), 'GW2')
+    selector.add_copy(1, rxpk(-90, time_field=now), 'GW3')
+    clock.ts += 0.021
+    [(best, src_mac, gateways, received)] = selector.flush_due()
+    assert src_mac == 'GW2'
+
+
+def test_gw2miner_forwards_one_best_copy(clock):
+    gw2miner = GW2Miner(0, [])
+    gw2miner.best_copy = BestCopySelector(window=0.02, clock=clock)
+    forwarded = []
+    gw2miner.forward_rxpks = lambda rxpks, src_mac, tx_mac=None, received=None: forwarded.append((rxpks, src_mac))
+    for mac, rssi in (('AA:55:5A:00:00:00:00:01', -110), ('AA:55:5A:00:00:00:00:02', -95)):
+        gw2miner.handle_PUSH_DATA(dict(_NAME_=messages.MsgPushData.NAME, MAC=mac, data=dict(rxpk=[rxpk(rssi)])))
+    gw2miner.service_queues()
+    assert forwarded == []
+    clock.ts += 0.021
+    gw2miner.service_queues()
+    assert [(rxpks[0]['rssi'], src_mac) for rxpks, src_mac in forwarded] == [(-95, 'AA:55:5A:00:00:00:00:02')]
+    gw2miner.sock.close()
+
+
+def test_held_copy_metadata_uses_arrival_time(tmp_path, clock):
+    # the gateway that heard the transmission has a virtual gateway of its own, the other one gets rewritten tmst
+    gw_mac, other_mac = 'AA:55:5A:00:00:00:00:01', 'AA:55:5A:00:00:00:01:00'
+    paths = []
+    for i, mac in enumerate((gw_mac, other_mac)):
+        path = tmp_path / f"{i}.json"
+        path.write_text(json.dumps(dict(gateway_conf=dict(gateway_ID=mac.replace(':', ''), server_address='127.0.0.1',
+                                                          serv_port_up=1680 + i, serv_port_down=1680 + i))))
+        paths.append(str(path))
+    gw2miner = GW2Miner(0, paths)
+    utc = [datetime.datetime(2021, 5, 4, 12, 0, 0)]
+    gw2miner.best_copy = BestCopySelector(window=0.5, clock=clock, utc_clock=lambda: utc[0])
+    sent = dict()
+    gw2miner.send_to_miner = lambda data, addr, mac=None: sent.update({mac: messages.decode_message(data)})
+    rx = rxpk(-100)
+    arrival_us = rx_clock(rx, utc[0])[0]
+    gw2miner.handle_PUSH_DATA(dict(_NAME_=messages.MsgPushData.NAME, MAC=gw_mac, data=dict(rxpk=[rx])))
+
+    # window closes half a second later
+    clock.ts += 0.5
+    utc[0] += datetime.timedelta(seconds=0.5)
+    gw2miner.service_queues()
+    assert sent[gw_mac]['data']['rxpk'][0]['tmst'] == rx['tmst']
+    assert gw2miner.vgateways_by_mac[gw_mac].rxmodifier.tmst_offset == (rx['tmst'] - arrival_us) % 2**32
+    assert sent[other_mac]['data']['rxpk'][0]['tmst'] == arrival_us
+    gw2miner.sock.close()
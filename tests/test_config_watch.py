@@ -0,0 +1,58 @@
+import json
+import os
+
+import pytest
+
+from gateways2miners import GW2Miner
+from src.config_watch import ConfigWatcher
+
+
+def write_config(directory, name, gateway_id, port):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as fd:
+        json.dump(dict(gateway_conf=dict(gateway_ID=gateway_id, server_address='127.0.0.1', serv_port_up=port,
+                                         serv_port_down=port)), fd)
+    return path
+
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_watcher_detects_changes(tmp_path, use_inotify):
+    directory = str(tmp_path)
+    path = write_config(directory, 'a.json', 'AA555A0000000001', 1680)
+    watcher = ConfigWatcher(directory, interval=0, use_inotify=use_inotify)
+    assert not watcher.poll()
+    write_config(directory, 'b.json', 'AA555A0000000002', 1681)
+    assert watcher.poll()
+    assert not watcher.poll()
+    with open(os.path.join(directory, 'notes.txt'), 'w') as fd:
+        fd.write('not a config')
+    assert not watcher.poll()
+    os.remove(path)
+    assert watcher.poll()
+    assert watcher.config_paths() == [os.path.join(directory, 'b.json')]
+    watcher.close()
+
+
+def test_reload_keeps_state_of_existing_vgateways(tmp_path):
+    directory = str(tmp_path)
+    a = write_config(directory, 'a.json', 'AA555A0000000001', 1680)
+    b = write_config(directory, 'b.json', 'AA555A0000000002', 1681)
+    gw2miner = GW2Miner(0, [a, b])
+    vgw_a = gw2miner.vgateways_by_mac['AA:55:5A:00:00:00:00:01']
+    vgw_a.rxmodifier.tmst_offset = 1234
+
+    write_config(directory, 'a.json', 'AA555A0000000001', 1690)
+    with open(b, 'w') as fd:
+        fd.write('{"gateway_conf": {')  # being written
+    c = write_config(directory, 'c.json', 'AA555A0000000003', 1682)
+    assert gw2miner.load_vgateways([a, b, c]) == (1, 0, 1)
+    assert gw2miner.vgateways_by_mac['AA:55:5A:00:00:00:00:01'] is vgw_a
+    assert vgw_a.rxmodifier.tmst_offset == 1234
+    assert gw2miner.vgateways_by_addr[('127.0.0.1', 1690)] is vgw_a
+    assert ('127.0.0.1', 1680) not in gw2miner.vgateways_by_addr
+    assert 'AA:55:5A:00:00:00:00:02' in gw2miner.vgateways_by_mac
+
+    os.remove(b)
+    assert gw2miner.load_vgateways([a, c]) == (0, 1, 0)
+    assert ('127.0.0.1', 1681) not in gw2miner.vgateways_by_addr
+    gw2miner.sock.close()
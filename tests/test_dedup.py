@@ -0,0 +1,94 @@
+import base64
+import itertools
+import random
+from hashlib import md5
+
+from src.dedup import DedupCache, rxpk_key
+
+
+def legacy_rxpk_key(rxpk):
+    # original GW2Miner.__rxpk_key__ implementation
+    hash = md5()
+    hash.update(rxpk['data'].encode())
+    key = (
+        rxpk['datr'],
+        rxpk['codr'],
+        str(round(rxpk['freq'], 2)),
+        rxpk['size'],
+        rxpk['data'] if len(rxpk['data']) < 40 else hash.hexdigest()
+    )
+    return key
+
+
+def generated_rxpks():
+    """
+    rxpks like gateways report them, generated with a fixed seed: each transmission heard by several gateways with
+    different metadata and frequencies reported with slightly different precision
+    """
+    rng = random.Random(1234)
+    rxpks = []
+    for _ in range(60):
+        size = rng.choice([1, 12, 23, 29, 52, 64])
+        payload = bytes(rng.getrandbits(8) for _ in range(size))
+        freq = rng.choice([903.9, 904.1, 904.3, 904.5, 904.7, 904.9, 905.1, 905.3])
+        tx = dict(datr=rng.choice(['SF7BW125', 'SF9BW125', 'SF10BW125']), codr=rng.choice(['4/5', '4/6']),
+                  freq=freq, size=size, data=base64.b64encode(payload).decode())
+        for _ in range(rng.randint(1, 3)):
+            rx = dict(tx, rssi=rng.randint(-130, -40), lsnr=rng.randint(-200, 100) / 10, tmst=rng.getrandbits(32))
+            rx['freq'] = round(freq + rng.choice([0, 0.000001, -0.000001, 0.004]), 6)
+            rxpks.append(rx)
+    # same payload with one field changed must be a different transmission
+    base = rxpks[0]
+    rxpks.append(dict(base, datr='SF8BW125'))
+    rxpks.append(dict(base, codr='4/8'))
+    rxpks.append(dict(base, freq=base['freq'] + 0.2))
+    rxpks.append(dict(base, size=base['size'] + 1))
+    return rxpks
+
+
+def test_rxpk_key_equality_matches_legacy():
+    rxpks = generated_rxpks()
+    for a, b in itertools.combinations(rxpks, 2):
+        assert (rxpk_key(a) == rxpk_key(b)) == (legacy_rxpk_key(a) == legacy_rxpk_key(b))
+
+
+def test_rxpk_key_is_compact_int():
+    key = rxpk_key(generated_rxpks()[0])
+    assert isinstance(key, int)
+    assert 0 <= key < 2**64
+
+
+def test_rxpk_key_ignores_base64_padding():
+    rx = dict(freq=904.3, size=4, datr='SF9BW125', codr='4/5', data=base64.b64encode(b'\x40\x01\x02\x03').decode())
+    assert rx['data'].endswith('==')
+    assert rxpk_key(rx) == rxpk_key(dict(rx, data=rx['data'].rstrip('=')))
+    assert rxpk_key(rx) != rxpk_key(dict(rx, data=base64.b64encode(b'\x40\x01\x02\x04').decode()))
+
+
+def test_repeat_inside_ttl(clock):
+    cache = DedupCache(ttl=10, clock=clock)
+    assert 'a' not in cache
+    cache['a'] = clock()
+    clock.ts += 5
+    assert 'a' in cache
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_expires_after_ttl(clock):
+    cache = DedupCache(ttl=10, clock=clock)
+    cache.add('a')
+    cache.add('b')
+    clock.ts += 11
+    assert 'a' not in cache
+    assert len(cache) == 0
+    assert cache.expired == 2
+
+
+def test_max_entries_evicts_oldest(clock):
+    cache = DedupCache(ttl=60, max_entries=3, clock=clock)
+    for key in 'abcd':
+        cache.add(key)
+    assert len(cache) == 3
+    assert 'a' not in cache
+    assert 'd' in cache
+    assert cache.evictions == 1
@@ -0,0 +1,71 @@
+import base64
+
+import pytest
+
+from src.downlink import DownlinkScheduler, lora_airtime, parse_device
+
+DEV_ADDR = bytes([0x01, 0x02, 0x03, 0x04])
+GW1 = 'AA:55:5A:00:00:00:00:01'
+GW2 = 'AA:55:5A:00:00:00:00:02'
+GW3 = 'AA:55:5A:00:00:00:00:03'
+
+
+def frame(mtype, dev_addr=DEV_ADDR):
+    return base64.b64encode(bytes([mtype << 5]) + dev_addr + bytes(12)).decode()
+
+
+def uplink(rssi, lsnr):
+    return dict(tmst=1000, freq=904.1, datr='SF9BW125', codr='4/5', rssi=rssi, lsnr=lsnr, size=17, data=frame(2))
+
+
+def downlink(tmst, data=None):
+    return dict(imme=False, tmst=tmst, freq=923.3, rfch=0, powe=27, modu='LORA', datr='SF9BW500', codr='4/5',
+                ipol=True, size=17, data=data or frame(3))
+
+
+def test_parse_device():
+    assert parse_device(frame(2)) == (2, DEV_ADDR)
+    join = base64.b64encode(bytes([0]) + bytes(8) + bytes(range(8)) + bytes(6)).decode()
+    assert parse_device(join) == (0, bytes(range(8)))
+    assert parse_device('!!') == (None, None)
+
+
+def test_lora_airtime():
+    assert lora_airtime('SF7BW125', '4/5', 20) == pytest.approx(0.05658, abs=1e-4)
+
+
+def test_downlink_goes_to_gateway_that_heard_device_best(clock):
+    scheduler = DownlinkScheduler(clock=clock)
+    scheduler.observe(uplink(-110, -5.0), GW1)
+    scheduler.observe(uplink(-90, 8.0), GW2)
+    scheduler.offsets[GW1] = (1000, 0)
+    scheduler.offsets[GW2] = (5000, 0)
+    gateways = {GW1: ('10.0.0.1', 1), GW2: ('10.0.0.2', 1)}
+    mac, tmst, result = scheduler.schedule(downlink(2000000), GW1, 1000, gateways)
+    assert (mac, tmst, result) == (GW2, 2004000, 'device')
+
+
+def test_unknown_device_falls_back_to_vgw_gateway(clock):
+    scheduler = DownlinkScheduler(clock=clock)
+    gateways = {GW1: ('10.0.0.1', 1)}
+    assert scheduler.schedule(downlink(2000000), GW1, 1000, gateways) == (GW1, 2000000, 'fallback')
+    assert scheduler.schedule(downlink(2000000), GW3, 1000, gateways) == (None, None, 'no_gateway')
+
+
+def test_overlapping_downlinks_use_next_gateway(clock):
+    scheduler = DownlinkScheduler(clock=clock)
+    scheduler.observe(uplink(-90, 8.0), GW2)
+    scheduler.observe(uplink(-100, 2.0), GW1)
+    scheduler.offsets[GW1] = (0, 1000.0)
+    scheduler.offsets[GW2] = (0, 1000.0)
+    gateways = {GW1: ('10.0.0.1', 1), GW2: ('10.0.0.2', 1)}
+    assert scheduler.schedule(downlink(2000000), GW1, 0, gateways)[0] == GW2
+    # same downlink again (e.g. from a second miner) is not transmitted twice
+    assert scheduler.schedule(downlink(2000000), GW1, 0, gateways) == (None, None, 'duplicate')
+    # a different downlink overlapping on GW2 is moved to GW1
+    other = downlink(2010000, data=frame(3, bytes([9, 9, 9, 9])))
+    scheduler.observe(dict(uplink(-80, 9.0), data=frame(2, bytes([9, 9, 9, 9]))), GW2)
+    assert scheduler.schedule(other, GW3, 0, gateways)[0] is None
+    scheduler.observe(dict(uplink(-120, -9.0), data=frame(2, bytes([9, 9, 9, 9]))), GW1)
+    assert scheduler.schedule(other, GW3, 0, gateways)[0] == GW1
+    assert scheduler.stats()['collision'] == 1
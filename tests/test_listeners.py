@@ -0,0 +1,90 @@
+import json
+import socket
+
+import pytest
+
+from gateways2miners import GW2Miner
+from src import messages
+from src.listeners import ListenerGroup, from_sockaddr, load_listeners, to_sockaddr
+
+GW = 'AA:55:5A:00:00:00:00:01'
+
+
+def write_json(path, data):
+    path.write_text(json.dumps(data))
+    return str(path)
+
+
+@pytest.mark.parametrize('listeners', [
+    [],
+    [dict(port=1680)],
+    [dict(port='x', configs='a/')],
+    [dict(name='a', port=1680, configs='a/'), dict(name='a', port=1681, configs='b/')],
+    [dict(port=1680, configs='a/'), dict(port=1680, configs='b/')],
+])
+def test_invalid_listeners(tmp_path, listeners):
+    with pytest.raises(ValueError):
+        load_listeners(write_json(tmp_path / 'listeners.json', dict(listeners=listeners)))
+
+
+def test_load_listeners(tmp_path):
+    listeners = load_listeners(write_json(tmp_path / 'listeners.json', dict(listeners=[
+        dict(name='east', port=1680, configs='east/'), dict(host='::', port=1680, configs='west/')])))
+    assert [(listener.name, listener.host, listener.port, listener.configs) for listener in listeners] == [
+        ('east', '0.0.0.0', 1680, 'east/'), ('1', '::', 1680, 'west/')]
+
+
+def test_sockaddr():
+    assert from_sockaddr(('::ffff:10.0.0.1', 1680, 0, 0)) == ('10.0.0.1', 1680)
+    assert from_sockaddr(('fe80::1', 1680, 0, 2)) == ('fe80::1', 1680)
+    assert to_sockaddr(('10.0.0.1', 1680)) == ('::ffff:10.0.0.1', 1680)
+    assert to_sockaddr(('fe80::1', 1680)) == ('fe80::1', 1680)
+
+
+def test_listeners_are_isolated(tmp_path):
+    sinks, gw2miners = [], []
+    for i, host in enumerate(['0.0.0.0', '::']):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(('127.0.0.1', 0))
+        sink.settimeout(1)
+        sinks.append(sink)
+        port = sink.getsockname()[1]
+        path = write_json(tmp_path / f"{i}.json", dict(gateway_conf=dict(
+            gateway_ID=f"AA555A00000001{i:02X}", server_address='127.0.0.1', serv_port_up=port, serv_port_down=port)))
+        gw2miners.append(GW2Miner(0, [path], host=host, name=str(i)))
+    group = ListenerGroup(['v4', 'v6'], gw2miners)
+
+    gateway = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    gateway.settimeout(1)
+    rxpk = dict(tmst=1, chan=0, rfch=0, freq=904.1, stat=1, modu='LORA', datr='SF9BW125', codr='4/5', lsnr=5.0,
+                rssi=-100, size=3, data='QUJD')
+    push = messages.encode_message(dict(_NAME_=messages.MsgPushData.NAME, identifier=messages.MsgPushData.IDENT, ver=2,
+                                        token=1, MAC=GW, data=dict(rxpk=[rxpk])))
+    pull = messages.encode_message(dict(_NAME_=messages.MsgPullData.NAME, identifier=messages.MsgPullData.IDENT, ver=2,
+                                        token=2, MAC=GW))
+    try:
+        # the same packet heard in both fleets is forwarded in both, each listener de-duplicates on its own
+        for gw2miner in gw2miners:
+            gateway.sendto(push, ('127.0.0.1', gw2miner.sock.getsockname()[1]))
+        gateway.sendto(pull, ('127.0.0.1', gw2miners[1].sock.getsockname()[1]))
+        for _ in range(5):
+            group.run_once(timeout=0.1)
+        for _ in range(3):
+            # PUSH_ACK, PUSH_ACK and PULL_ACK, sent back over IPv4 by the dual-stack listener too
+            assert gateway.recvfrom(64)[0][3] in (1, 4)
+
+        for sink in sinks:
+            rxpks = []
+            while not rxpks:
+                rxpks = messages.decode_message(sink.recv(4096)).get('data', dict()).get('rxpk', [])
+            assert len(rxpks) == 1
+        assert gw2miners[0].gw_listening_addrs == dict()
+        assert gw2miners[1].gw_listening_addrs == {GW: ('127.0.0.1', gateway.getsockname()[1])}
+        assert gw2miners[0].rxpk_cache.stats()['misses'] == gw2miners[1].rxpk_cache.stats()['misses'] == 1
+    finally:
+        gateway.close()
+        for sock in sinks:
+            sock.close()
+        for gw2miner in gw2miners:
+            gw2miner.sock.close()
+        group.selector.close()
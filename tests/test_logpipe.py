@@ -0,0 +1,90 @@
+import logging
+import queue
+import threading
+
+from src.logpipe import LogPipeline, NonBlockingQueueHandler, RateLimitFilter
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.messages = []
+
+    def emit(self, record):
+        self.records.append(record)
+        self.messages.append(record.getMessage())
+
+
+class Lazy:
+    def __init__(self):
+        self.threads = []
+
+    def __str__(self):
+        self.threads.append(threading.current_thread())
+        return 'lazy'
+
+
+def test_rate_limit_summarizes_suppressed():
+    now = [0.0]
+    rate_limit = RateLimitFilter(rate=2, interval=60, clock=lambda: now[0])
+    handler = ListHandler()
+    handler.addFilter(rate_limit)
+    logger = logging.getLogger('test_rate_limit')
+    logger.addHandler(handler)
+    logger.propagate = False
+    logging.getLogger('Log').addHandler(handler)
+    try:
+        for i in range(10):
+            logger.warning("packet %d", i)
+        logger.error("errors always pass")
+        assert handler.messages == ['packet 0', 'packet 1', 'errors always pass']
+        now[0] = 1.0
+        logger.warning("packet %d", 10)
+        logger.warning("packet %d", 11)
+        assert handler.messages[-2:] == ['packet 10', 'packet 11']
+
+        now[0] = 61.0
+        logger.warning("after interval")
+        assert handler.messages[-2:] == ["suppressed 8 messages from test_rate_limit like: packet %d", 'after interval']
+    finally:
+        logger.removeHandler(handler)
+        logging.getLogger('Log').removeHandler(handler)
+
+
+def test_pipeline_formats_in_listener():
+    handler = ListHandler()
+    pipeline = LogPipeline([handler], rate=0)
+    root_handlers, root_level = list(logging.getLogger().handlers), logging.getLogger().level
+    pipeline.start()
+    logger = logging.getLogger('test_pipeline')
+    value = Lazy()
+    try:
+        logger.debug("not logged %s", value)
+        logger.info("value %s", value)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception("failed")
+    finally:
+        pipeline.stop()
+        logging.getLogger().setLevel(root_level)
+    assert logging.getLogger().handlers == root_handlers
+    # formatted by the listener thread (other root handlers, e.g. pytest's, format on the logging thread)
+    assert handler.records[0].args == (value,)
+    assert any(thread is not threading.current_thread() for thread in value.threads)
+    assert handler.messages == ['value lazy', 'failed']
+    assert 'ValueError: boom' in handler.records[1].exc_text
+
+
+def test_full_queue_drops_and_reports():
+    log_queue = queue.Queue(2)
+    handler = NonBlockingQueueHandler(log_queue)
+    for i in range(5):
+        handler.handle(logging.LogRecord('test', logging.INFO, __file__, 1, "message %d", (i,), None))
+    assert handler.dropped == 3
+    assert [log_queue.get_nowait().getMessage() for _ in range(2)] == ['message 0', 'message 1']
+    handler.handle(logging.LogRecord('test', logging.INFO, __file__, 1, "message %d", (5,), None))
+    assert handler.dropped == 0 and handler.dropped_total == 3
+    assert [log_queue.get_nowait().getMessage() for _ in range(2)] == [
+        'message 5', 'dropped 3 log messages, log queue was full']
@@ -0,0 +1,123 @@
+import pytest
+
+from src import messages
+
+
+RXPK = dict(tmst=3512348611, chan=2, rfch=0, freq=904.3, stat=1, modu='LORA', datr='SF9BW125', codr='4/5',
+            lsnr=2.5, rssi=-95, size=3, data='AAAA')
+TXPK = dict(imme=False, tmst=3513348611, freq=927.5, rfch=0, powe=27, modu='LORA', datr='SF10BW500', codr='4/5',
+            ipol=True, size=3, data='BBBB')
+
+FIXTURES = [
+    dict(_NAME_=messages.MsgPushData.NAME, identifier=messages.MsgPushData.IDENT, ver=2, token=0xABCD,
+         MAC='AA:55:5A:00:00:00:00:01', data=dict(rxpk=[RXPK, dict(RXPK, tmst=1)])),
+    dict(_NAME_=messages.MsgPushData.NAME, identifier=messages.MsgPushData.IDENT, ver=2, token=0x0001,
+         MAC='AA:55:5A:00:00:00:00:01', data=dict(stat=dict(rxnb=1, rxok=1))),
+    dict(_NAME_=messages.MsgPullData.NAME, identifier=messages.MsgPullData.IDENT, ver=2, token=0xABCD,
+         MAC='AA:55:5A:00:00:00:00:00'),
+    dict(_NAME_=messages.MsgPullResp.NAME, identifier=messages.MsgPullResp.IDENT, ver=2, token=0x1234,
+         data=dict(txpk=TXPK)),
+    dict(_NAME_=messages.MsgTxAck.NAME, identifier=messages.MsgTxAck.IDENT, ver=2, token=0x1234,
+         MAC='AA:55:5A:00:00:00:00:02', data=dict(txpk_ack=dict(error='TOO_LATE'))),
+    dict(_NAME_=messages.MsgPushAck.NAME, identifier=messages.MsgPushAck.IDENT, ver=2, token=0xFFFF),
+    dict(_NAME_=messages.MsgPullAck.NAME, identifier=messages.MsgPullAck.IDENT, ver=2, token=0),
+]
+
+BACKENDS = ['json', 'orjson'] if messages.orjson else ['json']
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    previous = messages.json_backend
+    messages.use_json_backend(request.param)
+    yield request.param
+    messages.use_json_backend(previous)
+
+
+@pytest.mark.parametrize('payload', FIXTURES, ids=lambda p: p['_NAME_'])
+@pytest.mark.parametrize('container', [bytes, bytearray, memoryview])
+def test_round_trip(backend, payload, container):
+    raw = messages.encode_message(payload)
+    decoded = messages.decode_message(container(raw))
+    for field, value in payload.items():
+        assert decoded[field] == value
+    assert messages.encode_message(decoded) == raw
+
+
+def test_acks():
+    push = messages.encode_message(FIXTURES[0])
+    msg, ack = messages.decode_message(push, return_ack=True)
+    assert ack == push[:3] + bytes([messages.MsgPushAck.IDENT])
+    pull = messages.encode_message(FIXTURES[2])
+    msg, ack = messages.decode_message(pull, return_ack=True)
+    assert ack == pull[:3] + bytes([messages.MsgPullAck.IDENT])
+    msg, ack = messages.decode_message(messages.encode_message(FIXTURES[3]), return_ack=True)
+    assert ack is None
+
+
+def test_message_class_api():
+    raw = messages.MsgPullData().encode(FIXTURES[2])
+    msg_obj = messages.MsgPullData(raw)
+    assert msg_obj.decode()['MAC'] == FIXTURES[2]['MAC']
+    assert msg_obj.ack() == raw[:3] + bytes([messages.MsgPullAck.IDENT])
+
+
+@pytest.mark.parametrize('raw', [b'', b'\x02\x00', b'\x02\x00\x00\x09', b'\x02\x00\x00\x00\xaaUZ\x00', b'\x02\x00\x00\x00\xaaUZ\x00\x00\x00\x00\x01{bad'])
+def test_invalid_datagrams(raw):
+    with pytest.raises(ValueError):
+        messages.decode_message(raw)
+
+
+def test_mac_conversion():
+    mac = 'AA:55:5A:00:00:00:00:01'
+    assert messages.mac_from_bytes(messages.mac_to_bytes(mac)) == mac
+    assert messages.mac_to_bytes('aa:55:5a:00:00:00:00:01') == messages.mac_to_bytes(mac)
+
+
+# the same uplink as sent by the legacy packet forwarder and by the sx1302 HAL v2 forwarder, whose rxpk field order
+# differs and which adds a stat object
+FORWARDER_PAYLOADS = [
+    b'{"rxpk":[{"tmst":3512348611,"time":"2021-05-04T12:00:00.000000Z","chan":2,"rfch":0,"freq":904.300000,'
+    b'"stat":1,"modu":"LORA","datr":"SF9BW125","codr":"4/5","lsnr":7.5,"rssi":-95,"size":12,'
+    b'"data":"QAEAAAAAAQAB4kEu"}]}',
+    b'{"rxpk":[{"jver":1,"tmst":1048576,"time":"2021-05-04T12:00:00.000100Z","tmms":1304164818000,"chan":2,'
+    b'"rfch":0,"freq":904.300000,"mid":8,"stat":1,"modu":"LORA","datr":"SF9BW125","codr":"4/5","rssis":-103,'
+    b'"lsnr":-2.2,"foff":-1261,"rssi":-101,"size":12,"data":"QAEAAAAAAQAB4kEu"}],'
+    b'"stat":{"time":"2021-05-04 12:00:00 UTC","rxnb":1,"rxok":1,"rxfw":1,"ackr":100.0,"dwnb":0,"txnb":0,'
+    b'"temp":41.6}}',
+]
+
+
+def test_forwarder_payloads_decode_to_same_key(backend):
+    from src.dedup import rxpk_key
+    keys = set()
+    for payload in FORWARDER_PAYLOADS:
+        msg, ack = messages.decode_message(b'\x02\x12\x34\x00\xaaUZ\x00\x00\x00\x00\x01' + payload, return_ack=True)
+        assert ack is not None
+        rxpk, = msg['data']['rxpk']
+        assert (rxpk['freq'], rxpk['size'], rxpk['datr']) == (904.3, 12, 'SF9BW125')
+        keys.add(rxpk_key(rxpk))
+    assert len(keys) == 1
+
+
+STAT_ONLY = (b'\x02\x12\x34\x00\xaaUZ\x00\x00\x00\x00\x01{"stat":{"time":"2021-05-04 12:00:00 GMT","rxnb":0,"rxok":0,'
+             b'"rxfw":0,"ackr":100.0,"dwnb":0,"txnb":0}}')
+
+
+def test_stat_only_push_data_acked_without_parsing(monkeypatch):
+    def loads(data):
+        raise AssertionError("stat only payload parsed")
+    monkeypatch.setattr(messages, 'json_loads', loads)
+    monkeypatch.setattr(messages, 'STAT_VALIDATE_INTERVAL', 0)
+    msg, ack = messages.decode_message(STAT_ONLY, return_ack=True, skip_stat=True)
+    assert (msg['MAC'], msg['data'], ack) == ('AA:55:5A:00:00:00:00:01', dict(), b'\x02\x12\x34\x01')
+
+
+def test_stat_only_push_data_sampled_validation(monkeypatch):
+    monkeypatch.setattr(messages, 'STAT_VALIDATE_INTERVAL', 1)
+    assert messages.decode_message(STAT_ONLY, skip_stat=True)['data'] == dict()
+    with pytest.raises(ValueError):
+        messages.decode_message(STAT_ONLY[:-1], skip_stat=True)
+    # payloads with rxpks are always parsed
+    rxpk, = messages.decode_message(STAT_ONLY[:12] + FORWARDER_PAYLOADS[1], skip_stat=True)['data']['rxpk']
+    assert rxpk['size'] == 12
@@ -0,0 +1,98 @@
+import json
+import urllib.request
+
+from gateways2miners import GW2Miner
+from src import messages
+from src.metrics import Histogram, MetricsServer, StageTimer, format_prometheus
+
+
+def test_histogram_percentile():
+    hist = Histogram()
+    for us in range(1, 101):
+        hist.observe(us * 1e-6)
+    assert hist.count == 100
+    assert 45e-6 <= hist.percentile(50) <= 60e-6
+    assert hist.percentile(100) == hist.max
+
+
+def test_stage_timer_excludes_nested_stages():
+    ticks = iter(range(100)).__next__
+    timer = StageTimer(clock=ticks)
+    inner = timer.timed('send', lambda: None)
+    outer = timer.timed('encode', lambda: inner())
+    outer()
+    timer.commit()
+    # clock: encode start 0, send start 1, send end 2, encode end 3
+    assert timer.histograms['send'].sum == 1
+    assert timer.histograms['encode'].sum == 2
+    assert timer.histograms['total'].sum == 3
+
+
+def test_stage_timer_sampling_restores_originals():
+    class Stage:
+        def run(self):
+            return 'done'
+
+    stage = Stage()
+    original = stage.run
+    timer = StageTimer(sample_rate=0.5, random_func=lambda: 0.9)  # 0.9 draws a gap of 3 datagrams
+    timer.wrap(stage, 'run', 'decode')
+    sampled = []
+    for _ in range(6):
+        sampled.append(stage.run != original)
+        assert stage.run() == 'done'
+        timer.commit()
+    assert sampled == [False, True, False, False, False, True]
+    assert timer.histograms['decode'].count == 2
+
+
+def test_metrics_endpoint():
+    hist = Histogram()
+    hist.observe(3e-6)
+    families = [
+        ('gw2m_decode_errors_total', 'counter', 'datagrams that could not be decoded', [(dict(), 2)]),
+        ('gw2m_stage_seconds', 'histogram', 'time per stage', [(dict(stage='decode'), hist)]),
+    ]
+    server = MetricsServer(0, lambda: families).start()
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+            text = response.read().decode()
+    finally:
+        server.close()
+    assert 'gw2m_decode_errors_total 2\n' in text
+    assert 'gw2m_stage_seconds_bucket{stage="decode",le="+Inf"} 1\n' in text
+    assert 'gw2m_stage_seconds_count{stage="decode"} 1\n' in text
+
+
+def test_gw2miner_counters():
+    gw2miner = GW2Miner(0, [])
+    gw2miner.sendto = lambda data, addr: None
+    push = dict(_NAME_=messages.MsgPushData.NAME, identifier=messages.MsgPushData.IDENT, ver=2, token=1,
+                MAC='AA:55:5A:00:00:00:00:01', data=dict(stat=dict(rxnb=0)))
+    gw2miner.decode_datagram(messages.encode_message(push), ('127.0.0.1', 1000))
+    gw2miner.decode_datagram(b'\x02', ('127.0.0.1', 1000))
+    text = format_prometheus(gw2miner.collect_metrics())
+    assert 'gw2m_gateway_datagrams_received_total{gateway="AA:55:5A:00:00:00:00:01",type="PUSH_DATA"} 1\n' in text
+    assert 'gw2m_gateway_datagrams_sent_total{gateway="AA:55:5A:00:00:00:00:01"} 1\n' in text
+    assert 'gw2m_decode_errors_total 1\n' in text
+    gw2miner.sock.close()
+
+
+def test_stage_timing_per_listener(tmp_path):
+    listeners = []
+    for i in range(2):
+        path = tmp_path / f"{i}.json"
+        path.write_text(json.dumps(dict(gateway_conf=dict(gateway_ID=f"AA555A000000000{i}", server_address='127.0.0.1',
+                                                          serv_port_up=1680 + i, serv_port_down=1680 + i))))
+        gw2miner = GW2Miner(0, [str(path)], name=str(i))
+        gw2miner.enable_stage_timing(StageTimer())
+        listeners.append(gw2miner)
+    rxpk = dict(tmst=3512348611, chan=2, rfch=0, freq=904.3, stat=1, modu='LORA', datr='SF9BW125', codr='4/5',
+                lsnr=2.5, rssi=-95, size=12, data='QAEAAAAAAQAB4kEu')
+    listeners[0].forward_rxpks([rxpk], src_mac='AA:55:5A:FF:FF:FF:FF:FF')
+    for gw2miner in listeners:
+        gw2miner.timer.commit()
+    assert listeners[0].timer.histograms['modify'].count == 1
+    assert 'modify' not in listeners[1].timer.histograms
+    for gw2miner in listeners:
+        gw2miner.sock.close()
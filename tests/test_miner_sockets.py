@@ -0,0 +1,100 @@
+import json
+import socket
+
+from gateways2miners import GW2Miner
+from src import messages
+from src.miner_sockets import MinerSockets
+from src.options import Options
+from src.vgateway import VirtualGateway
+
+VGWS = ['AA:55:5A:00:00:00:01:00', 'AA:55:5A:00:00:00:02:00']
+
+
+def udp_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(1)
+    return sock
+
+
+def run(gw2miner, iterations=5):
+    for _ in range(iterations):
+        for msg, addr in gw2miner.get_messages(timeout=0.05):
+            gw2miner.handle_message(msg, addr)
+        gw2miner.service_queues()
+
+
+def test_replies_attributed_by_socket(tmp_path):
+    # both virtual gateways point at the same miner ip:port, which the address index cannot tell apart
+    miner = udp_socket()
+    paths = []
+    for i, mac in enumerate(VGWS):
+        path = tmp_path / f"{i}.json"
+        path.write_text(json.dumps(dict(gateway_conf=dict(gateway_ID=mac.replace(':', ''), server_address='127.0.0.1',
+                                                          serv_port_up=miner.getsockname()[1],
+                                                          serv_port_down=miner.getsockname()[1]))))
+        paths.append(str(path))
+    gw2miner = GW2Miner(0, paths, options=Options(miner_sockets=True))
+    gateways = [udp_socket() for _ in VGWS]
+    try:
+        for gateway, mac in zip(gateways, VGWS):
+            gw2miner.gw_listening_addrs[mac] = gateway.getsockname()
+        gw2miner.send_keepalive()
+        pull_data = dict()  # keys = vGW MAC, values = address PULL_DATA came from
+        for _ in VGWS:
+            data, addr = miner.recvfrom(4096)
+            pull_data[messages.decode_message(data)['MAC']] = addr
+        assert len(set(pull_data.values())) == 2
+
+        txpk = dict(imme=True, freq=923.3, rfch=0, powe=27, modu='LORA', datr='SF10BW500', codr='4/5', ipol=True,
+                    size=3, data='QUJD')
+        pull_resp = messages.encode_message(dict(_NAME_=messages.MsgPullResp.NAME, identifier=messages.MsgPullResp.IDENT,
+                                                 ver=2, token=7, data=dict(txpk=txpk)))
+        miner.sendto(pull_resp, pull_data[VGWS[1]])
+        miner.sendto(b'\x02\x00\x01' + bytes([messages.MsgPushAck.IDENT]), pull_data[VGWS[1]])
+        run(gw2miner)
+        assert messages.decode_message(gateways[1].recv(4096))['_NAME_'] == messages.MsgPullResp.NAME
+        gateways[0].settimeout(0.1)
+        try:
+            gateways[0].recv(4096)
+            assert False, "PULL_RESP sent to gateway of other virtual gateway"
+        except socket.timeout:
+            pass
+        assert [gw2miner.vgateways_by_mac[mac].dwnb for mac in VGWS] == [0, 1]
+        assert [gw2miner.vgateways_by_mac[mac].push_acked for mac in VGWS] == [0, 1]
+    finally:
+        miner.close()
+        for gateway in gateways:
+            gateway.close()
+        gw2miner.sock.close()
+        gw2miner.miner_sockets.close()
+
+
+def test_up_down_sockets_follow_miner():
+    up, down, moved = udp_socket(), udp_socket(), udp_socket()
+    vgw = VirtualGateway(VGWS[0], '127.0.0.1', port_up=up.getsockname()[1], port_dn=down.getsockname()[1])
+    miner_sockets = MinerSockets()
+    try:
+        miner_sockets.update({vgw.mac: vgw})
+        for sink in (up, down):
+            data, addr = vgw.get_PULL_DATA() if sink is down else vgw.get_stat()
+            miner_sockets.sendto(data, miner_sockets.socket_for(vgw.mac, addr))
+            assert messages.decode_message(sink.recv(4096))['MAC'] == vgw.mac
+        assert len(miner_sockets.selector.get_map()) == 2
+
+        vgw.port_up = vgw.port_dn = moved.getsockname()[1]
+        miner_sockets.update({vgw.mac: vgw})
+        assert len(miner_sockets.selector.get_map()) == 1
+        data, addr = vgw.get_PULL_DATA()
+        sock = miner_sockets.socket_for(vgw.mac, addr)
+        miner_sockets.sendto(data, sock)
+        moved.recv(4096)
+        moved.sendto(b'\x02\x00\x01\x04', sock.getsockname())
+        assert [(data, vgw_) for data, addr, vgw_ in miner_sockets.receive()] == [(b'\x02\x00\x01\x04', vgw)]
+
+        miner_sockets.update(dict())
+        assert miner_sockets.connected == dict() and sock.fileno() == -1
+    finally:
+        miner_sockets.close()
+        for sock in (up, down, moved):
+            sock.close()
@@ -0,0 +1,58 @@
+import pytest
+
+from src import modify_rxpk
+from src.modify_rxpk import RXMetadataModification, modify_rxpks, rx_clock
+
+
+RXPK = dict(tmst=3512348611, chan=2, rfch=0, freq=904.3, stat=1, modu='LORA', datr='SF9BW125', codr='4/5',
+            lsnr=-2.5, rssi=-105, size=3, data='AAAA')
+SRC_MAC = 'AA:55:5A:00:00:00:00:00'
+
+
+@pytest.fixture(params=['numpy', 'python'] if modify_rxpk.numpy else ['python'])
+def engine(request, monkeypatch):
+    if request.param == 'numpy':
+        monkeypatch.setattr(modify_rxpk, 'NUMPY_MIN_BATCH', 0)
+    else:
+        monkeypatch.setattr(modify_rxpk, 'numpy', None)
+    return request.param
+
+
+def destinations(count):
+    return [(SRC_MAC if i == 0 else f"AA:55:5A:00:00:00:00:{i:02X}", RXMetadataModification()) for i in range(count)]
+
+
+def test_batch_distribution_matches_single(engine):
+    modifiers = destinations(50)
+    batch = set()
+    for _ in range(40):
+        for result in modify_rxpks([RXPK, RXPK], SRC_MAC, modifiers[1:]):
+            batch.update((rssi, lsnr) for tmst, rssi, lsnr in result)
+    single = set()
+    for _ in range(40):
+        for dest_mac, modifier in modifiers[1:]:
+            tmst, rssi, lsnr = modifier.modify_metadata(RXPK, SRC_MAC, dest_mac)
+            single.add((rssi, lsnr))
+    assert batch == single
+    assert {rssi for rssi, lsnr in batch} == set(range(-107, -102))
+
+
+def test_source_gateway_keeps_tmst(engine):
+    modifiers = destinations(3)
+    results = modify_rxpks([RXPK], SRC_MAC, modifiers)
+    assert results[0] == [(RXPK['tmst'], -102, results[0][0][2])]
+    elapsed_us_u32, gps_valid = rx_clock(RXPK)
+    # other virtual gateways are offset from clock of the receiving gateway
+    offset = modifiers[0][1].tmst_offset
+    for dest_mac, modifier in modifiers[1:]:
+        modifier.tmst_offset = offset
+    tmst = modify_rxpks([RXPK], 'AA:55:5A:00:00:00:00:FF', modifiers)[1][0][0]
+    error = (tmst - offset - elapsed_us_u32) % 2**32
+    assert min(error, 2**32 - error) < 1e6
+
+
+def test_clipping(engine):
+    rxpk = dict(RXPK, rssi=-50, lsnr=9.5)
+    for result in modify_rxpks([rxpk], SRC_MAC, destinations(20)):
+        for tmst, rssi, lsnr in result:
+            assert rssi == -90 and lsnr == 1.9
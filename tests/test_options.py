@@ -0,0 +1,30 @@
+import warnings
+
+import pytest
+
+from gateways2miners import GW2Miner
+from src.options import Options
+
+
+def test_options_configure_gw2miner():
+    gw2miner = GW2Miner(0, [], options=Options(keepalive_interval=5, best_copy_window=0.2))
+    assert (gw2miner.keepalive_interval, gw2miner.stat_interval) == (5, 30)
+    assert gw2miner.best_copy.window == 0.2
+    gw2miner.sock.close()
+
+
+def test_baseline_arguments_still_work():
+    options = Options(stat_interval=60)
+    with pytest.warns(DeprecationWarning):
+        gw2miner = GW2Miner(0, [], 5, 7, True)
+    assert (gw2miner.keepalive_interval, gw2miner.stat_interval) == (5, 7)
+    gw2miner.sock.close()
+    with pytest.warns(DeprecationWarning):
+        gw2miner = GW2Miner(0, [], keepalive_interval=5, options=options)
+    assert (gw2miner.keepalive_interval, gw2miner.stat_interval) == (5, 60)
+    # options passed in are not modified
+    assert options.keepalive_interval == 10
+    gw2miner.sock.close()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        GW2Miner(0, []).sock.close()
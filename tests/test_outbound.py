@@ -0,0 +1,71 @@
+import pytest
+
+from src.outbound import OutboundQueues, DROP_NEWEST, DROP_OLDEST
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+        self.full = False
+        self.refused = set()
+
+    def sendto(self, data, addr):
+        if self.full:
+            raise BlockingIOError
+        if addr in self.refused:
+            raise ConnectionRefusedError
+        self.sent.append((data, addr))
+
+
+def test_sent_immediately_when_idle():
+    sock = FakeSocket()
+    queues = OutboundQueues(sock.sendto)
+    assert queues.put('A', b'1', ('127.0.0.1', 1))
+    assert sock.sent == [(b'1', ('127.0.0.1', 1))]
+    assert queues.next_deadline() is None
+    assert queues.stats()['A'] == dict(depth=0, sent=1, dropped=0, errors=0)
+
+
+@pytest.mark.parametrize('policy, expected', [(DROP_OLDEST, [b'2', b'3']), (DROP_NEWEST, [b'0', b'1'])])
+def test_drop_policy_when_socket_full(policy, expected):
+    sock = FakeSocket()
+    queues = OutboundQueues(sock.sendto, max_len=2, policy=policy)
+    sock.full = True
+    for i in range(4):
+        queues.put('A', str(i).encode(), ('127.0.0.1', 1))
+    assert queues.stats()['A']['depth'] == 2
+    assert queues.stats()['A']['dropped'] == 2
+    assert queues.next_deadline() is not None
+    sock.full = False
+    queues.drain()
+    assert [data for data, addr in sock.sent] == expected
+    assert not queues.active
+
+
+def test_rate_limit_only_delays_limited_miner(clock):
+    sock = FakeSocket()
+    queues = OutboundQueues(sock.sendto, rate=0, clock=clock)
+    queues.queue('slow', rate=10)
+    queues.queue('slow').tokens = 1
+    for i in range(3):
+        queues.put('slow', b'slow', ('127.0.0.1', 1))
+        queues.put('fast', b'fast', ('127.0.0.1', 2))
+    assert [data for data, addr in sock.sent].count(b'fast') == 3
+    assert [data for data, addr in sock.sent].count(b'slow') == 1
+    assert queues.next_deadline() == pytest.approx(clock.ts + 0.1)
+    clock.ts += 0.1
+    queues.drain()
+    assert [data for data, addr in sock.sent].count(b'slow') == 2
+    clock.ts += 0.1
+    queues.drain()
+    assert queues.stats()['slow'] == dict(depth=0, sent=3, dropped=0, errors=0)
+
+
+def test_send_error_counted_and_dropped():
+    sock = FakeSocket()
+    queues = OutboundQueues(sock.sendto)
+    sock.refused.add(('127.0.0.1', 1))
+    queues.put('A', b'1', ('127.0.0.1', 1))
+    queues.put('B', b'2', ('127.0.0.1', 2))
+    assert queues.stats()['A'] == dict(depth=0, sent=0, dropped=0, errors=1)
+    assert sock.sent == [(b'2', ('127.0.0.1', 2))]
@@ -0,0 +1,38 @@
+import os
+import pstats
+import tracemalloc
+
+from src.metrics import StageTimer
+from src.profiling import Profiler, format_stage_report
+
+
+def test_stage_report():
+    ticks = iter(range(100)).__next__
+    timer = StageTimer(clock=ticks)
+    inner = timer.timed('key', lambda: None)
+    timer.timed('decode', lambda: inner())()
+    timer.commit()
+    lines = format_stage_report(timer)
+    assert [line.split()[0] for line in lines] == ['stage', 'decode', 'key', 'total']
+    assert lines[1].endswith('66.7%')
+
+
+def test_signal_requests_write_dumps(tmp_path):
+    profiler = Profiler(str(tmp_path))
+    profiler.requests.append('cprofile')
+    profiler.poll()
+    sum(range(1000))
+    profiler.requests.append('cprofile')
+    profiler.poll()
+    [path] = os.listdir(str(tmp_path))
+    assert path.startswith(f"cprofile-{os.getpid()}-")
+    pstats.Stats(os.path.join(str(tmp_path), path))
+
+    was_tracing = tracemalloc.is_tracing()
+    profiler.requests.extend(['tracemalloc', 'tracemalloc'])
+    profiler.poll()
+    dumps = [name for name in os.listdir(str(tmp_path)) if name.startswith('tracemalloc-')]
+    assert len(dumps) == 1
+    tracemalloc.Snapshot.load(os.path.join(str(tmp_path), dumps[0]))
+    if not was_tracing:
+        profiler.stop()
@@ -0,0 +1,57 @@
+import socket
+
+import pytest
+
+from src.receiver import BatchReceiver
+
+
+@pytest.fixture
+def socks():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.setblocking(False)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind(('127.0.0.1', 0))
+    yield sock, sender
+    sock.close()
+    sender.close()
+
+
+def test_receives_all_waiting_datagrams(socks):
+    sock, sender = socks
+    receiver = BatchReceiver(sock, count=4)
+    datagrams = [bytes([i]) * (1000 + 1000 * i) for i in range(3)]
+    for data in datagrams:
+        sender.sendto(data, sock.getsockname())
+    received = receiver.receive()
+    assert [bytes(view) for view, addr in received] == datagrams
+    assert received[0][1] == sender.getsockname()
+    assert receiver.receive() == []
+
+
+def test_sx1302_sized_push_data_received(socks):
+    # the sx1302 HAL forwarder sends more rxpks per PUSH_DATA than fit the legacy 4550 byte limit
+    sock, sender = socks
+    receiver = BatchReceiver(sock, count=1)
+    data = b'\x02\x00\x01\x00' + b'x' * 30000
+    sender.sendto(data, sock.getsockname())
+    assert [bytes(view) for view, addr in receiver.receive()] == [data]
+    assert receiver.oversized == 0
+
+
+def test_count_limits_datagrams_per_call(socks):
+    sock, sender = socks
+    receiver = BatchReceiver(sock, count=2)
+    for i in range(3):
+        sender.sendto(bytes([i]), sock.getsockname())
+    assert [bytes(view) for view, addr in receiver.receive()] == [b'\x00', b'\x01']
+    assert [bytes(view) for view, addr in receiver.receive()] == [b'\x02']
+
+
+def test_oversized_datagram_dropped(socks):
+    sock, sender = socks
+    receiver = BatchReceiver(sock, count=2, size=1001)
+    sender.sendto(b'x' * 1001, sock.getsockname())
+    sender.sendto(b'ok', sock.getsockname())
+    assert [bytes(view) for view, addr in receiver.receive()] == [b'ok']
+    assert receiver.oversized == 1
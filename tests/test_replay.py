@@ -0,0 +1,28 @@
+from src.capture import CaptureWriter, read_capture
+from tools import replay
+
+
+def test_capture_round_trip(tmp_path):
+    path = str(tmp_path / 'capture.bin')
+    clock = iter([1.5, 2.5, 3.5]).__next__
+    capture = CaptureWriter(path, clock=clock)
+    capture.write(b'\x02\x00\x01\x00', ('10.0.0.1', 1680))
+    capture.write(memoryview(b'\x02\x00\x02\x02'), ('::1', 1700))
+    capture.close()
+    # record cut short when process is killed mid write
+    with open(path, 'ab') as fd:
+        fd.write(b'\x00' * 5)
+    assert list(read_capture(path)) == [
+        (1.5, b'\x02\x00\x01\x00', ('10.0.0.1', 1680)),
+        (2.5, b'\x02\x00\x02\x02', ('::1', 1700))
+    ]
+
+
+def test_replay_forwards_each_transmission_once():
+    records = replay.synthetic_records(30, gateways=3)
+    result = replay.replay(records, miners=2, speed=0, rss_interval=60)
+    assert result['sent'] == result['received'] == len(records)
+    assert result['rxpks_to_miners'] == 30 * 2
+    histograms = result['timer'].histograms
+    assert histograms['decode'].count == len(records)
+    assert histograms['modify'].count == 30
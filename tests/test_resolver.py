@@ -0,0 +1,125 @@
+import json
+import os
+import socket
+import threading
+import time
+
+from gateways2miners import GW2Miner
+from src.config_watch import ConfigWatcher
+from src.options import Options
+from src.resolver import Resolver
+
+
+class StubDNS:
+    def __init__(self, records, delay=0.0):
+        self.records = records
+        self.delay = delay
+        self.lookups = 0
+
+    def __call__(self, host):
+        self.lookups += 1
+        time.sleep(self.delay)
+        if host not in self.records:
+            raise OSError(f"unknown host {host}")
+        return self.records[host]
+
+
+def test_resolve_all_is_concurrent_and_cached():
+    dns = StubDNS({f"miner{i}.local": f"10.0.0.{i}" for i in range(20)}, delay=0.1)
+    resolver = Resolver(resolve=dns)
+    start = time.monotonic()
+    result = resolver.resolve_all([f"miner{i}.local" for i in range(20)] + ['10.1.1.1', 'missing.local'])
+    assert time.monotonic() - start < 1
+    assert result['miner3.local'] == '10.0.0.3'
+    assert result['10.1.1.1'] == '10.1.1.1'
+    assert result['missing.local'] is None
+    lookups = dns.lookups
+    resolver.resolve_all(['miner3.local'])
+    assert dns.lookups == lookups
+
+
+def test_refresh_moves_miner(tmp_path):
+    path = os.path.join(str(tmp_path), 'miner.json')
+    with open(path, 'w') as fd:
+        json.dump(dict(gateway_conf=dict(gateway_ID='AA555A0000000001', server_address='miner.local',
+                                         serv_port_up=1680, serv_port_down=1681)), fd)
+    dns = StubDNS({'miner.local': '10.0.0.1'})
+    gw2miner = GW2Miner(0, [path], resolver=Resolver(resolve=dns))
+    vgw = gw2miner.vgateways_by_mac['AA:55:5A:00:00:00:00:01']
+    assert vgw.server_address == '10.0.0.1'
+
+    dns.records['miner.local'] = '10.0.0.2'
+    assert gw2miner.resolver.refresh() == 1
+    gw2miner.apply_dns_changes()
+    assert vgw.server_address == '10.0.0.2'
+    assert gw2miner.vgateways_by_addr[('10.0.0.2', 1681)] is vgw
+    assert ('10.0.0.1', 1680) not in gw2miner.vgateways_by_addr
+
+    # failed lookup keeps last known address
+    del dns.records['miner.local']
+    assert gw2miner.resolver.refresh() == 0
+    gw2miner.apply_dns_changes()
+    assert vgw.server_address == '10.0.0.2'
+    gw2miner.sock.close()
+
+
+def test_ipv6_only_used_when_reachable(monkeypatch, tmp_path):
+    results = {
+        'dual.local': [(socket.AF_INET6, socket.SOCK_DGRAM, 17, '', ('2001:db8::1', 0, 0, 0)),
+                       (socket.AF_INET, socket.SOCK_DGRAM, 17, '', ('10.0.0.1', 0))],
+        'v6only.local': [(socket.AF_INET6, socket.SOCK_DGRAM, 17, '', ('2001:db8::2', 0, 0, 0))],
+    }
+    monkeypatch.setattr(socket, 'getaddrinfo', lambda host, port, type=0: results[host])
+    assert Resolver().resolve_all(['dual.local', 'v6only.local']) == {'dual.local': '10.0.0.1', 'v6only.local': None}
+    assert Resolver(ipv6=True).resolve_all(['dual.local', 'v6only.local']) == \
+        {'dual.local': '2001:db8::1', 'v6only.local': '2001:db8::2'}
+
+    # a dual-stack listener reaches a miner that only has an AAAA record
+    path = os.path.join(str(tmp_path), 'miner.json')
+    with open(path, 'w') as fd:
+        json.dump(dict(gateway_conf=dict(gateway_ID='AA555A0000000001', server_address='v6only.local',
+                                         serv_port_up=1680, serv_port_down=1680)), fd)
+    gw2miner = GW2Miner(0, [path], host='::')
+    assert gw2miner.vgateways_by_mac['AA:55:5A:00:00:00:00:01'].server_address == '2001:db8::2'
+    gw2miner.sock.close()
+
+
+def test_reload_resolves_new_host_names_in_background(tmp_path):
+    def write_config(host):
+        with open(path, 'w') as fd:
+            json.dump(dict(gateway_conf=dict(gateway_ID='AA555A0000000001', server_address=host,
+                                             serv_port_up=1680, serv_port_down=1680)), fd)
+    path = os.path.join(str(tmp_path), 'miner.json')
+    write_config('old.local')
+    dns = StubDNS({'old.local': '10.0.0.1', 'miner2.local': '10.0.0.2'})
+    lookup_done = threading.Event()
+    dns_answers = threading.Event()
+
+    def slow_dns(host):
+        dns_answers.wait(5)
+        try:
+            return dns(host)
+        finally:
+            lookup_done.set()
+    resolver = Resolver(resolve=dns)
+    watcher = ConfigWatcher(str(tmp_path), interval=0, use_inotify=False)
+    gw2miner = GW2Miner(0, [path], options=Options(config_watcher=watcher), resolver=resolver)
+    vgw = gw2miner.vgateways_by_mac['AA:55:5A:00:00:00:00:01']
+    resolver.resolve = slow_dns
+
+    # the reload does not wait for DNS, the virtual gateway keeps its old miner until the new host name resolved
+    write_config('miner2.local')
+    gw2miner.check_configs()
+    assert vgw.server_address == '10.0.0.1'
+    assert resolver.pending == {'miner2.local'}
+    dns_answers.set()
+    assert lookup_done.wait(5)
+    while resolver.pending:
+        time.sleep(0.01)
+    gw2miner.run_timers()
+    assert gw2miner.vgateways_by_mac['AA:55:5A:00:00:00:00:01'] is vgw
+    assert (vgw.server_host, vgw.server_address) == ('miner2.local', '10.0.0.2')
+    # the host name no config uses is not refreshed any more
+    assert resolver.cache == {'miner2.local': '10.0.0.2'}
+    gw2miner.config_watcher.close()
+    gw2miner.sock.close()
@@ -0,0 +1,81 @@
+import json
+import os
+
+import pytest
+
+from gateways2miners import GW2Miner
+from src.routing import RoutingIndex, parse_rules
+from src.vgateway import VirtualGateway
+
+GW1 = 'AA:55:5A:00:00:00:00:01'
+GW2 = 'AA:55:5A:00:00:00:00:02'
+
+
+def vgateway(index, rules=None):
+    vgw = VirtualGateway(mac=f"AA:55:5A:00:00:00:01:{index:02X}", server_address='127.0.0.1', port_up=1680 + index,
+                         port_dn=1680 + index)
+    vgw.routing_rules = parse_rules(rules) if rules is not None else None
+    return vgw
+
+
+def rxpk(chan=0, datr='SF9BW125', size=52):
+    return dict(chan=chan, datr=datr, size=size)
+
+
+@pytest.mark.parametrize('rules', [
+    dict(chan=[0]),
+    [dict(channel=[0])],
+    [dict(size=[80, 48])],
+    [dict(gateways=['AA55'])],
+])
+def test_invalid_rules(rules):
+    with pytest.raises(ValueError):
+        parse_rules(rules)
+
+
+def test_targets():
+    everything = vgateway(0)
+    poc = vgateway(1, [dict(datr=['SF8BW125', 'sf9bw125'], size=[48, 80])])
+    local = vgateway(2, [dict(gateways=['AA555A0000000001']), dict(chan=[7])])
+    nothing = vgateway(3, [])
+    router = RoutingIndex([everything, poc, local, nothing])
+
+    assert router.targets(rxpk(), GW1) == (everything, poc, local)
+    assert router.targets(rxpk(), GW2) == (everything, poc)
+    assert router.targets(rxpk(size=81), GW2) == (everything,)
+    assert router.targets(rxpk(size=48, datr='SF10BW125'), GW2) == (everything,)
+    assert router.targets(rxpk(chan=7, size=20), GW2) == (everything, local)
+    assert len(router.cache) == 5
+    assert router.targets(rxpk(), GW1) == (everything, poc, local)
+    assert len(router.cache) == 5
+
+
+def test_gw2miner_sends_only_to_matching_miners(tmp_path):
+    paths = []
+    for index, routing in enumerate([None, [dict(chan=[1])]]):
+        config = dict(gateway_ID=f"AA555A00000001{index:02X}", server_address='127.0.0.1', serv_port_up=1680 + index,
+                      serv_port_down=1680 + index)
+        if routing is not None:
+            config['routing'] = routing
+        paths.append(os.path.join(str(tmp_path), f"{index}.json"))
+        with open(paths[-1], 'w') as fd:
+            json.dump(dict(gateway_conf=config), fd)
+    gw2miner = GW2Miner(0, paths)
+    assert gw2miner.router is not None
+    sent = []
+    gw2miner.send_to_miner = lambda data, addr, mac=None: sent.append(mac)
+
+    rxpks = [dict(tmst=1, chan=chan, rfch=0, freq=904.1, stat=1, modu='LORA', datr='SF9BW125', codr='4/5', lsnr=5.0,
+                  rssi=-100, size=3, data='QUJD') for chan in (0, 1)]
+    gw2miner.forward_rxpks(rxpks[:1], GW1)
+    assert sent == ['AA:55:5A:00:00:00:01:00']
+    sent.clear()
+    gw2miner.forward_rxpks(rxpks[1:], GW1)
+    assert sorted(sent) == ['AA:55:5A:00:00:00:01:00', 'AA:55:5A:00:00:00:01:01']
+
+    # invalid rules keep the previous config of that miner
+    with open(paths[1], 'w') as fd:
+        json.dump(dict(gateway_ID='AA555A0000000101', server_address='127.0.0.1', routing=[dict(chan='x')]), fd)
+    gw2miner.load_vgateways(paths)
+    assert gw2miner.vgateways_by_mac['AA:55:5A:00:00:00:01:01'].routing_rules == parse_rules([dict(chan=[1])])
+    gw2miner.sock.close()
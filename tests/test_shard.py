@@ -0,0 +1,145 @@
+import base64
+import json
+import select
+
+import pytest
+
+from gateways2miners import GW2Miner
+from src import messages
+from src.options import Options
+from src import shard as sharding
+from src.dedup import rxpk_key
+
+# first gateway has a virtual gateway of its own so its tmst offset is learned, the second only forwards
+GATEWAYS = ['AA:55:5A:00:00:00:00:01', 'AA:55:5A:00:00:00:00:02']
+VGWS = ['AA:55:5A:00:00:00:00:01', 'AA:55:5A:00:00:00:01:00']
+MINER = ('127.0.0.1', 1680)
+RXPK = dict(tmst=3512348611, chan=2, rfch=0, freq=904.3, stat=1, modu='LORA', datr='SF9BW125', codr='4/5', lsnr=2.5,
+            rssi=-95, size=12, data='QAEAAAAAAQAB4kEu')
+
+
+@pytest.fixture
+def workers(tmp_path):
+    paths = []
+    for i, mac in enumerate(VGWS):
+        path = tmp_path / f"{i}.json"
+        path.write_text(json.dumps(dict(gateway_conf=dict(gateway_ID=mac.replace(':', ''), server_address=MINER[0],
+                                                          serv_port_up=MINER[1] + i, serv_port_down=MINER[1] + i))))
+        paths.append(str(path))
+    socks = sharding.create_internal_sockets(2)
+    # each worker closes the sockets of the others, as after forking, so every worker gets its own copies.  dup()
+    # resets the shared blocking flag so all copies are made before any router makes its socket non-blocking
+    copies = [[sock.dup() for sock in socks] for _ in range(2)]
+    for sock in socks:
+        sock.close()
+    workers = [GW2Miner(0, paths, options=Options(downlink_scheduler=True), shard=sharding.ShardRouter(i, copies[i]))
+               for i in range(2)]
+    for gw2miner in workers:
+        gw2miner.sent = []  # (data, addr) sent to miners
+        gw2miner.send_to_miner = lambda data, addr, mac=None, sent=gw2miner.sent: sent.append((data, addr))
+        gw2miner.gateway_sent = []  # (data, addr) sent to gateways
+        gw2miner.sendto = lambda data, addr, sent=gw2miner.gateway_sent: sent.append((data, addr))
+    yield workers
+    for gw2miner in workers:
+        gw2miner.shard.sock.close()
+        gw2miner.sock.close()
+
+
+def exchange(workers, rounds=5):
+    # deliver internal messages until the workers have nothing more to say to each other
+    for _ in range(rounds):
+        readable, _, _ = select.select([gw2miner.shard for gw2miner in workers], [], [], 0.05)
+        if not readable:
+            return
+        for gw2miner in workers:
+            if gw2miner.shard in readable:
+                gw2miner.handle_shard_messages()
+
+
+def push_data(gateway, rxpk):
+    return dict(_NAME_=messages.MsgPushData.NAME, MAC=gateway, data=dict(rxpk=[rxpk]))
+
+
+def test_copies_on_two_workers_forwarded_once(workers):
+    owner = workers[0].shard.owner(rxpk_key(RXPK))
+    observed = []
+    for gw2miner in workers:
+        gw2miner.downlink.observe = lambda rxpk, src_mac, observe=gw2miner.downlink.observe: \
+            observed.append(src_mac) or observe(rxpk, src_mac)
+    # first copy lands on the worker that does not own the key and is forwarded to the owner
+    workers[1 - owner].handle_PUSH_DATA(push_data(GATEWAYS[0], dict(RXPK, rssi=-90)))
+    workers[owner].handle_PUSH_DATA(push_data(GATEWAYS[1], dict(RXPK, rssi=-100)))
+    exchange(workers)
+
+    assert workers[1 - owner].sent == []
+    pushes = [messages.decode_message(data) for data, addr in workers[owner].sent]
+    assert sorted(addr for data, addr in workers[owner].sent) == [MINER, (MINER[0], MINER[1] + 1)]
+    assert all(push['data']['rxpk'][0]['data'] == RXPK['data'] for push in pushes)
+    # every copy is counted once by the downlink scheduler, on the worker that received it
+    assert sorted(observed) == GATEWAYS
+
+
+def test_tmst_offset_shared(workers):
+    owner = workers[0].shard.owner(rxpk_key(RXPK))
+    workers[owner].handle_PUSH_DATA(push_data(GATEWAYS[0], RXPK))
+    exchange(workers)
+    offsets = [gw2miner.vgateways_by_mac[VGWS[0]].rxmodifier.tmst_offset for gw2miner in workers]
+    assert offsets[owner] != 0
+    assert offsets[0] == offsets[1]
+
+
+def test_downlink_observations_shared(workers):
+    # a data uplink of device 01020304 heard only by a gateway whose PUSH_DATA lands on worker 0
+    dev_addr = bytes([1, 2, 3, 4])
+    uplink = dict(RXPK, data=base64.b64encode(b'\x40' + dev_addr + bytes(12)).decode())
+    workers[0].handle_PUSH_DATA(push_data(GATEWAYS[1], uplink))
+    exchange(workers)
+    assert workers[1].downlink.candidates(dev_addr) == [GATEWAYS[1]]
+    assert GATEWAYS[1] in workers[1].downlink.offsets
+
+    # the miner's PULL_RESP for the device lands on worker 1, which sends it through that gateway
+    gateway_addr = ('127.0.0.1', 1701)
+    workers[1].gw_listening_addrs[GATEWAYS[1]] = gateway_addr
+    txpk = dict(imme=True, freq=923.3, rfch=0, powe=27, modu='LORA', datr='SF9BW500', codr='4/5', ipol=True, size=17,
+                data=base64.b64encode(b'\x60' + dev_addr + bytes(12)).decode())
+    workers[1].handle_PULL_RESP(dict(_NAME_=messages.MsgPullResp.NAME, token=8, data=dict(txpk=txpk)),
+                                (MINER[0], MINER[1] + 1))
+    assert [addr for data, addr in workers[1].gateway_sent] == [gateway_addr]
+
+
+def test_gateway_and_tx_ack_broadcast(workers):
+    gateway_addr = ('127.0.0.1', 1700)
+    workers[1].handle_PULL_DATA(dict(_NAME_=messages.MsgPullData.NAME, MAC=VGWS[1]), gateway_addr)
+    exchange(workers)
+    assert workers[0].gw_listening_addrs[VGWS[1]] == gateway_addr
+
+    # worker 0 forwards the PULL_RESP, the gateway's TX_ACK lands on worker 1
+    txpk = dict(imme=True, freq=904.1, rfch=0, powe=27, modu='LORA', datr='SF9BW125', codr='4/5', ipol=True, size=3,
+                data='QUJD')
+    workers[0].handle_PULL_RESP(dict(_NAME_=messages.MsgPullResp.NAME, token=7, data=dict(txpk=txpk)),
+                                (MINER[0], MINER[1] + 1))
+    assert workers[0].gateway_sent[0][1] == gateway_addr
+    workers[1].handle_TX_ACK(dict(_NAME_=messages.MsgTxAck.NAME, MAC=VGWS[1], token=7,
+                                  data=dict(txpk_ack=dict(error='NONE'))), gateway_addr)
+    exchange(workers)
+    assert workers[0].vgateways_by_mac[VGWS[1]].txnb == 1
+    assert workers[0].tx_tracker.in_flight == dict()
+    assert workers[1].vgateways_by_mac[VGWS[1]].txnb == 0
+
+
+def test_stats_sent_by_primary(workers):
+    workers[1].vgateways_by_mac[VGWS[0]].rxnb += 3
+    workers[0].vgateways_by_mac[VGWS[0]].rxnb += 2
+    workers[1].vgateways_by_mac[VGWS[0]].txnb += 1
+    workers[1].send_stats()
+    exchange(workers)
+    assert workers[1].sent == []
+    assert workers[1].vgateways_by_mac[VGWS[0]].rxnb == 0
+    workers[0].send_stats()
+    stats = {addr: messages.decode_message(data)['data']['stat'] for data, addr in workers[0].sent}
+    assert (stats[MINER]['rxnb'], stats[MINER]['txnb']) == (5, 1)
+    # txnb counts per stat interval as in single process mode
+    workers[0].sent.clear()
+    workers[0].send_stats()
+    stats = {addr: messages.decode_message(data)['data']['stat'] for data, addr in workers[0].sent}
+    assert (stats[MINER]['rxnb'], stats[MINER]['txnb']) == (5, 0)
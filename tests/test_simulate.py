@@ -0,0 +1,27 @@
+import pytest
+
+from tools import simulate
+
+
+def test_parse_mix():
+    assert simulate.parse_mix('3') == ([3], [1.0])
+    assert simulate.parse_mix('1:50,3:40,8:10') == ([1, 3, 8], [50.0, 90.0, 100.0])
+    for text in ['', '1:0', 'a:1']:
+        with pytest.raises(ValueError):
+            simulate.parse_mix(text)
+
+
+def test_simulation_delivers_each_transmission_once():
+    simulation = simulate.Simulation(gateways=6, miners=3, overlap='1:1,3:1', downlink_rate=2, keepalive=1)
+    try:
+        simulation.start()
+        result = simulation.run_stage(rate=20, duration=1)
+    finally:
+        simulation.stop()
+    assert result['transmissions'] > 0
+    assert result['delivered'] == result['transmissions'] * 3
+    assert result['duplicates'] == result['stale'] == 0
+    assert result['push_acked'] == result['push_data']
+    # every miner has a simulated gateway's MAC so all downlinks reach a gateway
+    assert result['downlinks_routable'] == result['downlinks_sent'] > 0
+    assert result['downlinks'] == result['downlinks_sent']
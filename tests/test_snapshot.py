@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from gateways2miners import GW2Miner
+from src.dedup import DedupCache
+from src.options import Options
+from src.snapshot import StateSnapshot, pack_snapshot, read_snapshot, write_snapshot
+
+GW1 = 'AA:55:5A:00:00:00:00:01'
+GW2 = 'AA:55:5A:00:00:00:00:02'
+
+
+def test_round_trip_and_corruption(tmp_path):
+    path = str(tmp_path / 'state.snap')
+    gateways = {GW1: ('10.0.0.1', 40001), GW2: ('2001:db8::1', 40002)}
+    write_snapshot(path, pack_snapshot(123.5, [2 ** 64 - 1, 7], [100.0, 101.0], gateways,
+                                       {GW1: 2 ** 32 - 1}))
+    state = read_snapshot(path)
+    assert (state.saved_ts, state.dedup, state.gateways, state.offsets) == \
+        (123.5, [(2 ** 64 - 1, 100.0), (7, 101.0)], gateways, {GW1: 2 ** 32 - 1})
+    assert not os.path.exists(path + '.tmp')
+
+    with open(path, 'r+b') as fd:
+        fd.seek(-6, os.SEEK_END)
+        fd.write(b'\xff')
+    with pytest.raises(ValueError, match='checksum'):
+        read_snapshot(path)
+    with open(path, 'r+b') as fd:
+        fd.truncate(40)
+    with pytest.raises(ValueError):
+        read_snapshot(path)
+    assert StateSnapshot(path).load() is None
+
+
+def test_dedup_columns_restore_in_time_order(clock):
+    cache = DedupCache(ttl=60, clock=clock)
+    for key, ts in ((1, 950.0), (2, 930.0), (3, 990.0)):
+        cache.add(key, ts)
+    cache.add(2, 995.0)  # re-added key moves to the back
+    keys, timestamps = cache.columns()
+    restored = DedupCache(ttl=60, clock=clock)
+    assert restored.restore(zip(keys, timestamps)) == 3
+    assert list(restored.items()) == [(1, 950.0), (3, 990.0), (2, 995.0)]
+    clock.ts = 1030.0
+    restored.expire()
+    assert list(restored.items()) == [(3, 990.0), (2, 995.0)]
+
+
+def test_gw2miner_warm_restart(tmp_path, clock):
+    path = str(tmp_path / 'state.snap')
+    gw2miner = GW2Miner(0, [], options=Options(snapshot=StateSnapshot(path, clock=clock)))
+    gw2miner.rxpk_cache[42] = gw2miner.rxpk_cache.clock()
+    gw2miner.gw_listening_addrs[GW1] = ('10.0.0.1', 40001)
+    gw2miner.save_snapshot(wait=True)
+    gw2miner.sock.close()
+
+    restarted = GW2Miner(0, [], options=Options(snapshot=StateSnapshot(path, clock=clock)))
+    assert 42 in restarted.rxpk_cache
+    assert restarted.gw_listening_addrs == {GW1: ('10.0.0.1', 40001)}
+    restarted.sock.close()
+
+    # gateway addresses of an old snapshot are not trusted
+    clock.ts += 301
+    stale = GW2Miner(0, [], options=Options(snapshot=StateSnapshot(path, clock=clock)))
+    assert stale.gw_listening_addrs == dict()
+    stale.sock.close()
@@ -0,0 +1,75 @@
+import json
+
+from gateways2miners import GW2Miner
+from src import messages
+from src.txack import RESULT_TIMEOUT, TxAckTracker, ack_result
+
+GW = 'AA:55:5A:00:00:00:00:01'
+VGW = 'AA:55:5A:00:00:00:01:00'
+MINER = ('127.0.0.1', 1680)
+
+
+def test_ack_result():
+    assert ack_result(None) == 'NONE'
+    assert ack_result(dict(txpk_ack=dict(error='NONE'))) == 'NONE'
+    assert ack_result(dict(txpk_ack=dict(warn='TX_POWER', value=20))) == 'NONE'
+    assert ack_result(dict(txpk_ack=dict(error='TOO_LATE'))) == 'TOO_LATE'
+
+
+def test_tracker_matches_and_expires():
+    now = [100.0]
+    tracker = TxAckTracker(max_in_flight=2, timeout=5, clock=lambda: now[0])
+    tracker.sent(GW, 1, VGW, received_ts=99.99, lead=0.8)
+    tracker.sent(GW, 2, VGW, received_ts=100.0, lead=-0.1)
+    now[0] = 100.05
+    assert tracker.acked(GW, 1, dict(txpk_ack=dict(error='TOO_LATE'))) == (VGW, 'TOO_LATE')
+    assert tracker.acked(GW, 1) == (None, None)
+    assert tracker.unmatched == 1
+    assert tracker.late_on_arrival == 1
+    assert abs(tracker.ack_latency[GW].max - 0.05) < 1e-9
+
+    tracker.sent(GW, 3, VGW, received_ts=100.05)
+    tracker.sent(GW, 4, VGW, received_ts=100.05)  # evicts token 2
+    assert list(tracker.in_flight) == [(GW, 3), (GW, 4)]
+    now[0] = 105.05
+    assert tracker.expire() == 2
+    assert tracker.by_gateway[GW] == {'TOO_LATE': 1, RESULT_TIMEOUT: 3}
+    assert tracker.by_miner[VGW] == tracker.by_gateway[GW]
+
+
+def test_gw2miner_stats_from_tx_ack(tmp_path):
+    path = tmp_path / 'miner.json'
+    path.write_text(json.dumps(dict(gateway_conf=dict(gateway_ID=VGW.replace(':', ''), server_address=MINER[0],
+                                                      serv_port_up=MINER[1], serv_port_down=MINER[1]))))
+    gw2miner = GW2Miner(0, [str(path)])
+    sent = []
+    gw2miner.sendto = lambda data, addr: sent.append((data, addr))
+    gw2miner.send_to_miner = lambda data, addr, mac=None: sent.append((data, addr))
+    gw2miner.gw_listening_addrs[VGW] = ('127.0.0.1', 1700)
+
+    txpk = dict(imme=True, freq=904.1, rfch=0, powe=27, modu='LORA', datr='SF9BW125', codr='4/5', ipol=True, size=3,
+                data='QUJD')
+    pull_resp = dict(_NAME_=messages.MsgPullResp.NAME, identifier=messages.MsgPullResp.IDENT, ver=2, token=0x1234,
+                     data=dict(txpk=txpk))
+    gw2miner.handle_PULL_RESP(pull_resp, MINER)
+    assert sent[0][1] == ('127.0.0.1', 1700)
+    tx_ack = dict(_NAME_=messages.MsgTxAck.NAME, identifier=messages.MsgTxAck.IDENT, ver=2, token=0x1234, MAC=VGW,
+                  data=dict(txpk_ack=dict(error='NONE')))
+    msg, addr = gw2miner.decode_datagram(messages.encode_message(tx_ack), ('127.0.0.1', 1700))
+    gw2miner.handle_message(msg, addr)
+    vgw = gw2miner.vgateways_by_mac[VGW]
+    assert (vgw.txnb, vgw.dwnb) == (1, 1)
+    assert gw2miner.tx_tracker.by_miner[VGW] == {'NONE': 1}
+
+    data, addr = vgw.get_stat()
+    stat = messages.decode_message(data)['data']['stat']
+    assert (stat['txnb'], stat['dwnb'], stat['ackr']) == (1, 1, 0.0)
+    # miner acknowledges the stat PUSH_DATA
+    push_ack = dict(_NAME_=messages.MsgPushAck.NAME, identifier=messages.MsgPushAck.IDENT, ver=2, token=1)
+    msg, addr = gw2miner.decode_datagram(messages.encode_message(push_ack), MINER)
+    gw2miner.handle_message(msg, addr)
+    data, addr = vgw.get_stat()
+    stat = messages.decode_message(data)['data']['stat']
+    # like the packet forwarder, counts are per stat interval
+    assert (stat['txnb'], stat['dwnb'], stat['ackr']) == (0, 0, 100.0)
+    gw2miner.sock.close()
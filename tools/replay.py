@@ -0,0 +1,299 @@
+"""
+Replays datagrams recorded with gateways2miners.py --capture (or synthetic traffic) through an in-process GW2Miner
+and reports throughput, per-stage latency and memory use.
+
+Stub gateways (one localhost UDP socket per gateway address in the capture) send the recorded datagrams to GW2Miner,
+stub miners (localhost UDP sockets) receive what is forwarded.  Only datagrams sent by gateways (PUSH_DATA, PULL_DATA
+and TX_ACK) are replayed, PULL_RESP from miners are skipped.
+
+    python3 tools/replay.py capture.bin --speed 1 --miners 10      # real time
+    python3 tools/replay.py capture.bin --speed 20                 # 20x faster than recorded
+    python3 tools/replay.py --synthetic 5000 --gateways 3 --speed 0   # as fast as GW2Miner keeps up
+
+Stage latencies are per datagram: receive (all datagrams of a wakeup, counted with the first), decode (parse + ack),
+key (rxpk keys), dedup (cache), modify (metadata for all miners), encode (PUSH_DATA for all miners) and send (all sendto
+calls).
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import gateways2miners
+from src import messages
+from src.capture import read_capture
+from src.metrics import StageTimer, rss_bytes
+from src.options import Options
+
+STAGES = ['receive', 'decode', 'key', 'dedup', 'modify', 'encode', 'send', 'total']
+GATEWAY_IDENTS = {messages.MsgPushData.IDENT, messages.MsgPullData.IDENT, messages.MsgTxAck.IDENT}
+
+
+def load_capture(path):
+    """
+    :param path: capture file
+    :return: list of (ts, data, addr) sent by gateways
+    """
+    return [(ts, data, addr) for ts, data, addr in read_capture(path) if len(data) >= 4 and data[3] in GATEWAY_IDENTS]
+
+
+def synthetic_records(packets, gateways=3, rate=50.0, seed=1):
+    """
+    generate traffic where every transmission is heard by every gateway, each gateway starts with a PULL_DATA
+    :param packets: number of transmissions
+    :param gateways: number of gateways hearing each transmission
+    :param rate: transmissions per second
+    :param seed: random seed so runs are repeatable
+    :return: list of (ts, data, addr)
+    """
+    rng = random.Random(seed)
+    macs = [f"AA:55:5A:00:00:01:00:{i:02X}" for i in range(gateways)]
+    addrs = [('127.0.0.1', 20000 + i) for i in range(gateways)]
+    records = []
+    for mac, addr in zip(macs, addrs):
+        records.append((0.0, messages.encode_message(dict(
+            _NAME_=messages.MsgPullData.NAME, identifier=messages.MsgPullData.IDENT, ver=2,
+            token=rng.getrandbits(16), MAC=mac)), addr))
+    for i in range(packets):
+        payload = base64.b64encode(rng.getrandbits(8 * 24).to_bytes(24, 'little')).decode()
+        freq = rng.choice([904.1, 904.3, 904.5])
+        tx_ts = 0.1 + i / rate
+        for mac, addr in zip(macs, addrs):
+            rxpk = dict(
+                tmst=rng.getrandbits(32), chan=rng.randint(0, 7), rfch=0, freq=freq,
+                stat=1, modu='LORA', datr='SF9BW125', codr='4/5', lsnr=round(rng.uniform(-10, 10), 1),
+                rssi=rng.randint(-120, -60), size=24, data=payload
+            )
+            records.append((tx_ts + rng.uniform(0, 0.05), messages.encode_message(dict(
+                _NAME_=messages.MsgPushData.NAME, identifier=messages.MsgPushData.IDENT, ver=2,
+                token=rng.getrandbits(16), MAC=mac, data=dict(rxpk=[rxpk]))), addr))
+    records.sort(key=lambda record: record[0])
+    return records
+
+
+def write_configs(directory, miner_ports):
+    paths = []
+    for i, port in enumerate(miner_ports):
+        path = os.path.join(directory, f"miner{i}.json")
+        with open(path, 'w') as fd:
+            json.dump(dict(gateway_conf=dict(
+                gateway_ID=f"AA555A{i:010X}", server_address='127.0.0.1', serv_port_up=port, serv_port_down=port
+            )), fd)
+        paths.append(path)
+    return paths
+
+
+class StubMiners:
+    def __init__(self, count):
+        """
+        localhost UDP sockets receiving forwarded datagrams on a background thread
+        :param count: number of stub miners
+        """
+        self.socks = []
+        self.selector = selectors.DefaultSelector()
+        for _ in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            sock.bind(('127.0.0.1', 0))
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ)
+            self.socks.append(sock)
+        self.push_data = 0
+        self.rxpks = 0
+        self.other = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def ports(self):
+        return [sock.getsockname()[1] for sock in self.socks]
+
+    def run(self):
+        while not self.stop.is_set():
+            for key, _ in self.selector.select(timeout=0.05):
+                while True:
+                    try:
+                        data = key.fileobj.recv(65535)
+                    except BlockingIOError:
+                        break
+                    self.count(data)
+
+    def count(self, data):
+        try:
+            msg = messages.decode_message(data)
+        except ValueError:
+            self.other += 1
+            return
+        if msg['_NAME_'] == messages.MsgPushData.NAME and 'rxpk' in msg.get('data', {}):
+            self.push_data += 1
+            self.rxpks += len(msg['data']['rxpk'])
+        else:
+            self.other += 1
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        for sock in self.socks:
+            sock.close()
+
+
+def replay(records, miners=4, speed=1.0, window=64, rss_interval=1.0, batch_window=0):
+    """
+    replay records through GW2Miner
+    :param records: list of (ts, data, addr) in order to send
+    :param miners: number of stub miners
+    :param speed: replay speed relative to recorded timestamps, 0 sends as fast as GW2Miner keeps up
+    :param window: max datagrams sent but not yet read by GW2Miner when speed is 0
+    :param rss_interval: seconds between RSS samples
+    :param batch_window: GW2Miner batch window in seconds
+    :return: dictionary of results
+    """
+    stub_miners = StubMiners(miners)
+    gateway_socks = dict()  # keys = recorded address, values = stub gateway socket
+    for ts, data, addr in records:
+        if addr not in gateway_socks:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            gateway_socks[addr] = sock
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        gw2miner = gateways2miners.GW2Miner(0, write_configs(tmpdir, stub_miners.ports()),
+                                            options=Options(batch_window=batch_window))
+    gw2miner.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    gw2miner_addr = ('127.0.0.1', gw2miner.sock.getsockname()[1])
+    timer = StageTimer()
+    gw2miner.enable_stage_timing(timer)
+
+    in_flight = threading.Semaphore(window)
+    decode = gw2miner.decode_datagram
+    received = [0]
+
+    def decode_datagram(data, addr):
+        received[0] += 1
+        in_flight.release()
+        return decode(data, addr)
+    gw2miner.decode_datagram = decode_datagram
+
+    sent = [0]
+    done = threading.Event()
+
+    def send():
+        start = time.perf_counter()
+        first_ts = records[0][0] if records else 0
+        for ts, data, addr in records:
+            if speed > 0:
+                delay = start + (ts - first_ts) / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                in_flight.acquire()
+            gateway_socks[addr].sendto(data, gw2miner_addr)
+            sent[0] += 1
+        done.set()
+
+    stub_miners.thread.start()
+    sender = threading.Thread(target=send, daemon=True)
+    rss_samples = []
+    start = time.perf_counter()
+    last_rx = start
+    next_rss = start
+    sender.start()
+    try:
+        while True:
+            now = time.perf_counter()
+            if now >= next_rss:
+                rss_samples.append((now - start, rss_bytes()))
+                next_rss += rss_interval
+            gw2miner.run_timers()
+            for msg, addr in gw2miner.get_messages(timeout=gw2miner.poll_timeout(0.05)):
+                last_rx = time.perf_counter()
+                gw2miner.handle_message(msg, addr)
+                timer.commit()
+            gw2miner.service_queues()
+            timer.commit()
+            if done.is_set() and (received[0] >= sent[0] or time.perf_counter() - last_rx > 1):
+                break
+        elapsed = last_rx - start
+        if gw2miner.batcher:
+            for data, addr in gw2miner.batcher.flush_all():
+                gw2miner.send_to_miner(data, addr)
+        while gw2miner.outbound.active:
+            gw2miner.outbound.drain()
+        rss_samples.append((time.perf_counter() - start, rss_bytes()))
+        time.sleep(0.2)  # let stub miners drain
+    finally:
+        stub_miners.close()
+        for sock in gateway_socks.values():
+            sock.close()
+        gw2miner.sock.close()
+
+    return dict(
+        sent=sent[0],
+        received=received[0],
+        seconds=elapsed,
+        push_data_to_miners=stub_miners.push_data,
+        rxpks_to_miners=stub_miners.rxpks,
+        timer=timer,
+        rss=rss_samples
+    )
+
+
+def print_report(result):
+    seconds = max(result['seconds'], 1e-9)
+    print(f"replayed {result['sent']} datagrams ({result['received']} received by GW2Miner) in {seconds:.2f}s: "
+          f"{result['received'] / seconds:.0f} datagrams/s")
+    print(f"miners received {result['rxpks_to_miners']} rxpks in {result['push_data_to_miners']} PUSH_DATA "
+          f"({result['push_data_to_miners'] / seconds:.0f}/s)")
+    print()
+    print(f"{'stage':>8} {'count':>8} {'mean us':>9} {'p50 us':>9} {'p90 us':>9} {'p99 us':>9} {'max us':>9}")
+    for stage in STAGES:
+        hist = result['timer'].histograms.get(stage)
+        if not hist:
+            continue
+        print(f"{stage:>8} {hist.count:>8} {hist.mean() * 1e6:>9.1f} {hist.percentile(50) * 1e6:>9.1f} "
+              f"{hist.percentile(90) * 1e6:>9.1f} {hist.percentile(99) * 1e6:>9.1f} {hist.max * 1e6:>9.1f}")
+    print()
+    print(f"{'t (s)':>8} {'RSS MB':>8}")
+    for ts, rss in result['rss']:
+        print(f"{ts:>8.1f} {rss / 2**20 if rss else float('nan'):>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser("replay captured gateway traffic through GW2Miner and measure the forwarding path")
+    parser.add_argument('capture', help='capture file from gateways2miners.py --capture', nargs='?')
+    parser.add_argument('--synthetic', help='replay this many synthetic transmissions instead of a capture', type=int)
+    parser.add_argument('-g', '--gateways', help='gateways hearing each synthetic transmission', default=3, type=int)
+    parser.add_argument('-r', '--rate', help='synthetic transmissions per second at speed 1', default=50, type=float)
+    parser.add_argument('-m', '--miners', help='number of stub miners', default=4, type=int)
+    parser.add_argument('-x', '--speed', help='replay speed, 1 = as recorded, 0 = as fast as possible', default=1, type=float)
+    parser.add_argument('--window', help='max datagrams in flight at speed 0', default=64, type=int)
+    parser.add_argument('--rss-interval', help='seconds between RSS samples', default=1, type=float)
+    parser.add_argument('--batch-window', help='GW2Miner batch window in ms', default=0, type=float)
+    parser.add_argument('-d', '--debug', action='store_true', help="print GW2Miner log messages")
+    args = parser.parse_args()
+
+    if args.capture:
+        records = load_capture(args.capture)
+    elif args.synthetic:
+        records = synthetic_records(args.synthetic, args.gateways, args.rate)
+    else:
+        parser.error("capture file or --synthetic is required")
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    result = replay(records, miners=args.miners, speed=args.speed, window=args.window,
+                    rss_interval=args.rss_interval, batch_window=args.batch_window / 1000)
+    print_report(result)
+
+
+if __name__ == '__main__':
+    main()
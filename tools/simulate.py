@@ -0,0 +1,660 @@
+"""
+Load test for gateways2miners.py with simulated gateways and miners exchanging Semtech UDP datagrams over localhost.
+
+N gateways send PULL_DATA keepalives and PUSH_DATA, each transmission is heard by k of them (--overlap) with payload
+sizes drawn from --sizes.  M miners, split over --miner-procs worker processes, acknowledge PULL_DATA and PUSH_DATA from
+the middleman and send PULL_RESP downlinks, which the middleman forwards to the gateway with the miner's MAC and that
+gateway answers with TX_ACK.  Every payload carries a sequence number and the time it was sent, so miners count
+delivery, duplicates and latency of uplinks (and gateways of downlinks) without sharing state with the sender.
+
+The middleman is started as a subprocess with one config per simulated miner (extra options with --middleman-args) and
+driven through a ramp of transmission rates, one stage per rate.  After each stage a row reports delivery, duplicates,
+latency, middleman CPU and memory, and datagrams the kernel dropped on the middleman's socket or on the simulator's own
+sockets (Linux only).  The ramp stops at the first stage delivering less than --min-delivery.
+
+    python3 tools/simulate.py --gateways 100 --miners 20 --rates 10,50,100,200
+    python3 tools/simulate.py --gateways 1000 --miners 500 --overlap 1:50,3:40,8:10 --rates 1,2,5,10 --duration 20
+    python3 tools/simulate.py --middleman-args "--engine asyncio --rcvbuf 4194304"
+
+Mixes are "value:weight" lists, e.g. --sizes 24:70,52:20,120:10 sends 70% of transmissions with 24 byte payloads.
+When the simulator itself cannot keep up it shows as send lag (how late datagrams left compared to schedule) and drops
+on simulator sockets.  Results of such stages describe the simulator, not the middleman: add --miner-procs on a machine
+with more cores.
+"""
+
+import argparse
+import base64
+import binascii
+import heapq
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import selectors
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from src import messages
+from src.metrics import Histogram
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# start of every simulated payload: kind, sequence number, miner index (downlinks), unix time sent
+PAYLOAD = struct.Struct('>BIId')
+UPLINK, DOWNLINK = 0, 1
+FREQS = [903.9, 904.1, 904.3, 904.5, 904.7, 904.9, 905.1, 905.3]
+DATRS = ['SF7BW125', 'SF8BW125', 'SF9BW125', 'SF10BW125']
+TX_ACK_BODY = b'{"txpk_ack":{"error":"NONE"}}'
+
+
+def parse_mix(text):
+    """
+    :param text: comma separated "value:weight" items, weight defaults to 1, e.g. "1:50,3:40,8:10" or "3"
+    :return: tuple of (values, cumulative weights) for random.choices
+    :raises ValueError: if an item is malformed or a weight is not positive
+    """
+    values, weights = [], []
+    for item in text.split(','):
+        value, _, weight = item.partition(':')
+        values.append(int(value))
+        weights.append(float(weight) if weight else 1.0)
+    if min(weights) <= 0:
+        raise ValueError(f"weights of {text} must be positive")
+    return values, list(itertools.accumulate(weights))
+
+
+def simulated_mac(index, prefix=0xAA555A00):
+    """
+    :param index: gateway or miner number
+    :param prefix: upper 4 bytes of MAC
+    :return: MAC as 'AA:55:5A:00:00:00:00:01'
+    """
+    raw = ((prefix << 32) | index).to_bytes(8, 'big').hex().upper()
+    return ':'.join(raw[i:i + 2] for i in range(0, 16, 2))
+
+
+def miner_mac(index, gateways):
+    """
+    miners share the MAC of a simulated gateway so their downlinks can be transmitted, miners beyond the number of
+    gateways get MACs no gateway has
+    """
+    return simulated_mac(index) if index < gateways else simulated_mac(index, prefix=0xAA555AFF)
+
+
+def merge_histograms(histograms):
+    merged = Histogram()
+    for hist in histograms:
+        merged.counts = [a + b for a, b in zip(merged.counts, hist.counts)]
+        merged.count += hist.count
+        merged.sum += hist.sum
+        merged.max = max(merged.max, hist.max)
+    return merged
+
+
+def udp_drops(ports):
+    """
+    :param ports: local UDP ports
+    :return: datagrams dropped by the kernel on sockets bound to these ports, None where /proc/net/udp is not available
+    """
+    ports = set(ports)
+    total = None
+    for path in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(path) as fd:
+                lines = fd.readlines()[1:]
+        except OSError:
+            continue
+        total = total or 0
+        for line in lines:
+            fields = line.split()
+            if int(fields[1].rsplit(':', 1)[1], 16) in ports:
+                total += int(fields[-1])
+    return total
+
+
+def process_usage(pid):
+    """
+    :return: tuple of (CPU seconds, RSS in bytes) of process, (None, None) where /proc is not available
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as fd:
+            fields = fd.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None, None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class MinerGroup:
+    def __init__(self, first_index, count, gateways, seed=1):
+        """
+        simulated miners with one UDP socket each, run in a worker process
+        :param first_index: index of first miner of this group
+        :param count: number of miners in this group
+        :param gateways: number of simulated gateways, miners with a lower index have a gateway's MAC
+        :param seed: random seed
+        """
+        self.first_index = first_index
+        self.rng = random.Random(seed)
+        self.selector = selectors.DefaultSelector()
+        self.socks = []
+        for i in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            sock.bind(('127.0.0.1', 0))
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, i)
+            self.socks.append(sock)
+        self.routable = [first_index + i < gateways for i in range(count)]
+        self.middleman_addrs = [None] * count  # learned from PULL_DATA of each miner's virtual gateway
+        self.downlink_rate = 0
+        self.downlinks_due = []
+        self.downlink_seq = 0
+        self.reset(0)
+
+    def ports(self):
+        return [sock.getsockname()[1] for sock in self.socks]
+
+    def reset(self, first_seq):
+        """
+        start counting a new stage
+        :param first_seq: first uplink sequence number of the stage, earlier uplinks arriving late are counted as stale
+        """
+        self.first_seq = first_seq
+        self.seen = set()
+        self.delivered = 0
+        self.duplicates = 0
+        self.stale = 0
+        self.echoes = 0
+        self.downlinks_sent = 0
+        self.downlinks_routable = 0
+        self.latency = Histogram()
+
+    def schedule_downlinks(self, rate):
+        """
+        :param rate: PULL_RESP per second sent by each miner (Poisson), 0 to stop
+        """
+        self.downlink_rate = rate
+        now = time.time()
+        self.downlinks_due = [(now + self.rng.expovariate(rate), i) for i in range(len(self.socks))] if rate else []
+        heapq.heapify(self.downlinks_due)
+
+    def report(self):
+        times = os.times()
+        return dict(delivered=self.delivered, duplicates=self.duplicates, stale=self.stale, echoes=self.echoes,
+                    downlinks_sent=self.downlinks_sent, downlinks_routable=self.downlinks_routable,
+                    latency=self.latency, cpu=times.user + times.system)
+
+    def run(self, conn):
+        """
+        serve miners until 'stop' is received on conn.  Commands are ('stage', first_seq, downlink_rate), ('pause',)
+        to stop downlinks, ('report',) answered with a dictionary of counts and ('stop',)
+        :param conn: multiprocessing Connection to controlling process
+        """
+        self.selector.register(conn, selectors.EVENT_READ, None)
+        try:
+            while True:
+                now = time.time()
+                while self.downlinks_due and self.downlinks_due[0][0] <= now:
+                    due, i = self.downlinks_due[0]
+                    self.send_downlink(i, now)
+                    heapq.heapreplace(self.downlinks_due, (due + self.rng.expovariate(self.downlink_rate), i))
+                timeout = min(0.05, max(0.0, self.downlinks_due[0][0] - now)) if self.downlinks_due else 0.05
+                for key, _ in self.selector.select(timeout):
+                    if key.data is not None:
+                        self.receive(key.data)
+                        continue
+                    command = conn.recv()
+                    if command[0] == 'stage':
+                        self.reset(command[1])
+                        self.schedule_downlinks(command[2])
+                    elif command[0] == 'pause':
+                        self.schedule_downlinks(0)
+                    elif command[0] == 'report':
+                        conn.send(self.report())
+                    else:
+                        return
+        finally:
+            self.selector.close()
+            for sock in self.socks:
+                sock.close()
+
+    def receive(self, i):
+        sock = self.socks[i]
+        while True:
+            try:
+                data, addr = sock.recvfrom(65535)
+            except BlockingIOError:
+                return
+            if len(data) < 4:
+                continue
+            if data[3] == messages.MsgPullData.IDENT:
+                sock.sendto(data[:3] + bytes([messages.MsgPullAck.IDENT]), addr)
+                self.middleman_addrs[i] = addr
+            elif data[3] == messages.MsgPushData.IDENT:
+                sock.sendto(data[:3] + bytes([messages.MsgPushAck.IDENT]), addr)
+                now = time.time()
+                for rxpk in json.loads(data[12:]).get('rxpk', ()):
+                    self.count_rxpk(i, rxpk, now)
+
+    def count_rxpk(self, i, rxpk, now):
+        try:
+            kind, seq, _, sent_ts = PAYLOAD.unpack_from(base64.b64decode(rxpk['data']))
+        except (KeyError, binascii.Error, struct.error):
+            return
+        if kind == DOWNLINK:
+            # fake rxpk the middleman makes of other miners' PULL_RESP
+            self.echoes += 1
+        elif seq < self.first_seq:
+            self.stale += 1
+        elif (i, seq) in self.seen:
+            self.duplicates += 1
+        else:
+            self.seen.add((i, seq))
+            self.delivered += 1
+            self.latency.observe(now - sent_ts)
+
+    def send_downlink(self, i, now):
+        addr = self.middleman_addrs[i]
+        if addr is None:
+            return
+        payload = PAYLOAD.pack(DOWNLINK, self.downlink_seq, self.first_index + i, now)
+        self.downlink_seq = (self.downlink_seq + 1) & 0xFFFFFFFF
+        txpk = dict(imme=True, freq=923.3, rfch=0, powe=27, modu='LORA', datr='SF10BW500', codr='4/5', ipol=True,
+                    size=len(payload), data=base64.b64encode(payload).decode())
+        self.socks[i].sendto(messages.encode_message(dict(
+            _NAME_=messages.MsgPullResp.NAME, identifier=messages.MsgPullResp.IDENT, ver=2,
+            token=self.rng.getrandbits(16), data=dict(txpk=txpk))), addr)
+        self.downlinks_sent += 1
+        self.downlinks_routable += self.routable[i]
+
+
+def run_miners(conn, first_index, count, gateways, seed):
+    """
+    entry point of miner worker processes, sends the ports of its miners on conn then serves them
+    """
+    miners = MinerGroup(first_index, count, gateways, seed)
+    conn.send(miners.ports())
+    miners.run(conn)
+
+
+class GatewayFleet:
+    def __init__(self, count, target, seed=1):
+        """
+        simulated gateways with one UDP socket each, run in the controlling process
+        :param count: number of gateways
+        :param target: (ip, port) of middleman
+        :param seed: random seed
+        """
+        self.target = target
+        self.rng = random.Random(seed)
+        self.macs = [simulated_mac(i) for i in range(count)]
+        self.mac_bytes = [messages.mac_to_bytes(mac) for mac in self.macs]
+        self.tmst_base = [self.rng.getrandbits(32) for _ in range(count)]
+        self.selector = selectors.DefaultSelector()
+        self.socks = []
+        for i in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, i)
+            self.socks.append(sock)
+        self.reset()
+
+    def ports(self):
+        return [sock.getsockname()[1] for sock in self.socks]
+
+    def reset(self):
+        self.push_sent = 0
+        self.push_acked = 0
+        self.pull_sent = 0
+        self.pull_acked = 0
+        self.downlinks = 0
+        self.downlink_latency = Histogram()
+
+    def send_pull_data(self, i):
+        self.socks[i].sendto(messages.encode_message(dict(
+            _NAME_=messages.MsgPullData.NAME, identifier=messages.MsgPullData.IDENT, ver=2,
+            token=self.rng.getrandbits(16), MAC=self.macs[i])), self.target)
+        self.pull_sent += 1
+
+    def send_push_data(self, i, rxpk, now):
+        """
+        :param i: gateway index
+        :param rxpk: fields of rxpk shared by all gateways hearing the transmission
+        :param now: unix time, sets the gateway's tmst
+        """
+        rxpk = dict(rxpk, tmst=(self.tmst_base[i] + int(now * 1e6)) & 0xFFFFFFFF, rssi=self.rng.randint(-120, -60),
+                    lsnr=round(self.rng.uniform(-15, 10), 1))
+        self.socks[i].sendto(messages.encode_message(dict(
+            _NAME_=messages.MsgPushData.NAME, identifier=messages.MsgPushData.IDENT, ver=2,
+            token=self.rng.getrandbits(16), MAC=self.macs[i], data=dict(rxpk=[rxpk]))), self.target)
+        self.push_sent += 1
+
+    def poll(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            self.receive(key.data)
+
+    def receive(self, i):
+        sock = self.socks[i]
+        while True:
+            try:
+                data, addr = sock.recvfrom(65535)
+            except BlockingIOError:
+                return
+            if len(data) < 4:
+                continue
+            if data[3] == messages.MsgPushAck.IDENT:
+                self.push_acked += 1
+            elif data[3] == messages.MsgPullAck.IDENT:
+                self.pull_acked += 1
+            elif data[3] == messages.MsgPullResp.IDENT:
+                sock.sendto(data[:3] + bytes([messages.MsgTxAck.IDENT]) + self.mac_bytes[i] + TX_ACK_BODY, addr)
+                try:
+                    kind, _, _, sent_ts = PAYLOAD.unpack_from(base64.b64decode(json.loads(data[4:])['txpk']['data']))
+                except (KeyError, ValueError, binascii.Error, struct.error):
+                    continue
+                if kind == DOWNLINK:
+                    self.downlinks += 1
+                    self.downlink_latency.observe(time.time() - sent_ts)
+
+
+class Simulation:
+    def __init__(self, gateways=10, miners=4, overlap='3', sizes='24:70,52:20,120:10', copy_spread=0.02, keepalive=10,
+                 downlink_rate=0.01, miner_procs=1, middleman_args='', seed=1):
+        """
+        :param gateways: number of simulated gateways
+        :param miners: number of simulated miners
+        :param overlap: mix of number of gateways hearing each transmission, see parse_mix
+        :param sizes: mix of payload sizes in bytes, see parse_mix
+        :param copy_spread: seconds over which copies of a transmission are sent after the first one
+        :param keepalive: seconds between PULL_DATA of each gateway
+        :param downlink_rate: PULL_RESP per second sent by each miner
+        :param miner_procs: number of worker processes the miners are split over
+        :param middleman_args: extra command line options of gateways2miners.py
+        :param seed: random seed
+        """
+        self.gateways = gateways
+        self.miners = miners
+        self.overlap = parse_mix(overlap)
+        self.sizes = parse_mix(sizes)
+        if min(self.sizes[0]) < PAYLOAD.size or min(self.overlap[0]) < 1:
+            raise ValueError(f"payload sizes must be at least {PAYLOAD.size} bytes and overlap at least 1 gateway")
+        self.copy_spread = copy_spread
+        self.keepalive = keepalive
+        self.downlink_rate = downlink_rate
+        self.miner_procs = max(1, min(miner_procs, miners))
+        self.middleman_args = shlex.split(middleman_args)
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.seq = 0
+        self.schedule = []  # heap of (due, order, gateway index, rxpk or None for PULL_DATA)
+        self.order = itertools.count()
+        self.lag = Histogram()
+        self.workers = []
+        self.middleman = None
+        self.fleet = None
+        self.tmpdir = None
+
+    def start(self, timeout=30):
+        """
+        start miner workers and middleman, wait until middleman acknowledges PULL_DATA and schedule keepalives
+        :raises RuntimeError: if middleman exits or does not answer within timeout
+        """
+        raise_fd_limit(self.gateways + self.miners + 64)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        per_proc = math.ceil(self.miners / self.miner_procs)
+        miner_ports = []
+        for first in range(0, self.miners, per_proc):
+            conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=run_miners, daemon=True, args=(
+                child_conn, first, min(per_proc, self.miners - first), self.gateways, self.seed + first))
+            proc.start()
+            self.workers.append((proc, conn))
+            miner_ports.extend(conn.recv())
+        self.miner_ports = miner_ports
+
+        configs = os.path.join(self.tmpdir.name, 'configs')
+        os.mkdir(configs)
+        for i, port in enumerate(miner_ports):
+            with open(os.path.join(configs, f"miner{i}.json"), 'w') as fd:
+                json.dump(dict(gateway_conf=dict(gateway_ID=miner_mac(i, self.gateways).replace(':', ''),
+                                                 server_address='127.0.0.1', serv_port_up=port, serv_port_down=port)), fd)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.log_path = os.path.join(self.tmpdir.name, 'middleman.log')
+        self.middleman = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'gateways2miners.py'), '-p', str(self.port), '-c', configs,
+             '--log-file', self.log_path, '--dns-ttl', '0'] + self.middleman_args,
+            cwd=self.tmpdir.name, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        self.fleet = GatewayFleet(self.gateways, ('127.0.0.1', self.port), self.seed)
+        deadline = time.time() + timeout
+        while not self.fleet.pull_acked:
+            self.check_middleman()
+            if time.time() > deadline:
+                raise RuntimeError(f"middleman did not answer PULL_DATA within {timeout}s")
+            self.fleet.send_pull_data(0)
+            self.fleet.poll(0.1)
+        # first keepalives spread over a second so they do not arrive as one burst
+        now = time.time()
+        for i in range(self.gateways):
+            heapq.heappush(self.schedule, (now + i / self.gateways * min(1, self.keepalive), next(self.order), i, None))
+        self.pump(now + 1.5)
+
+    def check_middleman(self):
+        if self.middleman.poll() is not None:
+            raise RuntimeError(f"middleman exited with {self.middleman.returncode}:\n{self.log_tail()}")
+
+    def log_tail(self, lines=20):
+        try:
+            with open(self.log_path) as fd:
+                return ''.join(fd.readlines()[-lines:])
+        except OSError:
+            return ''
+
+    def transmit(self, ts):
+        """
+        schedule PUSH_DATA from each gateway hearing a new transmission, the first copy at ts and the others within
+        copy_spread seconds
+        """
+        k = self.rng.choices(*self.overlap)[0]
+        size = self.rng.choices(*self.sizes)[0]
+        payload = PAYLOAD.pack(UPLINK, self.seq, 0, ts) + self.rng.randbytes(size - PAYLOAD.size)
+        self.seq += 1
+        rxpk = dict(chan=self.rng.randint(0, 7), rfch=0, freq=self.rng.choice(FREQS), stat=1, modu='LORA',
+                    datr=self.rng.choice(DATRS), codr='4/5', size=size, data=base64.b64encode(payload).decode())
+        for n, i in enumerate(self.rng.sample(range(self.gateways), min(k, self.gateways))):
+            delay = self.rng.uniform(0, self.copy_spread) if n else 0
+            heapq.heappush(self.schedule, (ts + delay, next(self.order), i, rxpk))
+
+    def pump(self, until, rate=0):
+        """
+        send scheduled datagrams and receive answers until unix time until
+        :param rate: new transmissions per second (Poisson arrivals), 0 to only send what is already scheduled
+        """
+        next_tx = time.time() + self.rng.expovariate(rate) if rate else math.inf
+        while True:
+            now = time.time()
+            if now >= until:
+                return
+            while next_tx <= now:
+                self.transmit(next_tx)
+                next_tx += self.rng.expovariate(rate)
+                if next_tx >= until:
+                    next_tx = math.inf
+            while self.schedule and self.schedule[0][0] <= now:
+                due, _, i, rxpk = heapq.heappop(self.schedule)
+                if rxpk is None:
+                    self.fleet.send_pull_data(i)
+                    heapq.heappush(self.schedule, (due + self.keepalive, next(self.order), i, None))
+                else:
+                    self.fleet.send_push_data(i, rxpk, now)
+                    self.lag.observe(now - due)
+            wake = min(until, next_tx, self.schedule[0][0] if self.schedule else until)
+            self.fleet.poll(min(0.05, max(0.0, wake - time.time())))
+
+    def run_stage(self, rate, duration, settle=1.0):
+        """
+        send transmissions at rate for duration seconds, wait settle seconds for stragglers and collect results
+        :param rate: transmissions per second
+        :return: dictionary of results
+        """
+        self.check_middleman()
+        first_seq = self.seq
+        for proc, conn in self.workers:
+            conn.send(('stage', first_seq, self.downlink_rate))
+        self.fleet.reset()
+        self.lag = Histogram()
+        middleman_drops = udp_drops([self.port])
+        sim_ports = self.fleet.ports() + self.miner_ports
+        sim_drops = udp_drops(sim_ports)
+        cpu_before, _ = process_usage(self.middleman.pid)
+        start = time.time()
+        self.pump(start + duration, rate)
+        for proc, conn in self.workers:
+            conn.send(('pause',))
+        self.pump(time.time() + settle)
+        cpu_after, rss = process_usage(self.middleman.pid)
+        reports = []
+        for proc, conn in self.workers:
+            conn.send(('report',))
+            reports.append(conn.recv())
+        self.check_middleman()
+
+        transmissions = self.seq - first_seq
+        delivered = sum(report['delivered'] for report in reports)
+        routable = sum(report['downlinks_routable'] for report in reports)
+        drops_after = udp_drops([self.port]), udp_drops(sim_ports)
+        return dict(
+            rate=rate,
+            transmissions=transmissions,
+            push_data=self.fleet.push_sent,
+            push_acked=self.fleet.push_acked,
+            delivered=delivered,
+            delivery=delivered / (transmissions * self.miners) if transmissions else 1.0,
+            duplicates=sum(report['duplicates'] for report in reports),
+            stale=sum(report['stale'] for report in reports),
+            latency=merge_histograms(report['latency'] for report in reports),
+            downlinks_sent=sum(report['downlinks_sent'] for report in reports),
+            downlinks_routable=routable,
+            downlinks=self.fleet.downlinks,
+            downlink_latency=self.fleet.downlink_latency,
+            middleman_cpu=(cpu_after - cpu_before) / (time.time() - start) if cpu_before is not None else None,
+            middleman_rss=rss,
+            middleman_drops=drops_after[0] - middleman_drops if middleman_drops is not None else None,
+            sim_drops=drops_after[1] - sim_drops if sim_drops is not None else None,
+            lag=self.lag
+        )
+
+    def stop(self):
+        for proc, conn in self.workers:
+            try:
+                conn.send(('stop',))
+            except OSError:
+                pass
+            proc.join(5)
+        if self.middleman:
+            self.middleman.terminate()
+            self.middleman.wait()
+        if self.fleet:
+            for sock in self.fleet.socks:
+                sock.close()
+            self.fleet.selector.close()
+        if self.tmpdir:
+            self.tmpdir.cleanup()
+
+
+def raise_fd_limit(needed):
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard == resource.RLIM_INFINITY else min(hard, needed * 2), hard))
+
+
+HEADER = (f"{'tx/s':>6} {'sent':>7} {'ack %':>6} {'deliv %':>8} {'dups':>6} {'up p50':>7} {'up p99':>7} {'dl':>5} "
+          f"{'dl %':>6} {'dl p99':>7} {'mm CPU':>7} {'mm MB':>6} {'mm drop':>7} {'sim drop':>8} {'lag p99':>7}")
+
+
+def format_stage(result):
+    def ms(hist, pct):
+        return f"{hist.percentile(pct) * 1e3:.1f}" if hist.count else '-'
+
+    def optional(value, fmt):
+        return format(value, fmt) if value is not None else '-'
+
+    ack = 100 * result['push_acked'] / result['push_data'] if result['push_data'] else 100.0
+    downlinks = 100 * result['downlinks'] / result['downlinks_routable'] if result['downlinks_routable'] else 100.0
+    cpu = result['middleman_cpu'] * 100 if result['middleman_cpu'] is not None else None
+    rss = result['middleman_rss'] / 2**20 if result['middleman_rss'] is not None else None
+    return (f"{result['rate']:>6g} {result['transmissions']:>7} {ack:>6.1f} {result['delivery'] * 100:>8.2f} "
+            f"{result['duplicates']:>6} {ms(result['latency'], 50):>7} {ms(result['latency'], 99):>7} "
+            f"{result['downlinks_sent']:>5} {downlinks:>6.1f} {ms(result['downlink_latency'], 99):>7} "
+            f"{optional(cpu, '>6.0f')}% {optional(rss, '>6.1f')} {optional(result['middleman_drops'], '>7')} "
+            f"{optional(result['sim_drops'], '>8')} {ms(result['lag'], 99):>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser("simulate gateways and miners around gateways2miners.py and find where it breaks")
+    parser.add_argument('-g', '--gateways', help='number of simulated gateways', default=100, type=int)
+    parser.add_argument('-m', '--miners', help='number of simulated miners', default=20, type=int)
+    parser.add_argument('-r', '--rates', help='comma separated transmissions per second, one stage each', default='10,20,50,100,200')
+    parser.add_argument('-t', '--duration', help='seconds per stage', default=10, type=float)
+    parser.add_argument('-k', '--overlap', help='mix of gateways hearing each transmission, e.g. 1:50,3:40,8:10', default='3')
+    parser.add_argument('-s', '--sizes', help='mix of payload sizes in bytes', default='24:70,52:20,120:10')
+    parser.add_argument('--copy-spread', help='ms over which copies of a transmission arrive from its gateways', default=20, type=float)
+    parser.add_argument('--keepalive', help='seconds between PULL_DATA of each gateway', default=10, type=float)
+    parser.add_argument('--downlink-rate', help='PULL_RESP per second sent by each miner', default=0.01, type=float)
+    parser.add_argument('--miner-procs', help='worker processes simulating miners (default one per 100 miners, at most one per CPU)', default=0, type=int)
+    parser.add_argument('--min-delivery', help='stop the ramp at the first stage delivering less than this percentage', default=99, type=float)
+    parser.add_argument('--settle', help='seconds to wait for late datagrams after each stage', default=1, type=float)
+    parser.add_argument('--middleman-args', help='extra options for gateways2miners.py, e.g. "--engine asyncio"', default='')
+    parser.add_argument('--seed', help='random seed', default=1, type=int)
+    args = parser.parse_args()
+
+    try:
+        rates = [float(rate) for rate in args.rates.split(',')]
+        miner_procs = args.miner_procs or min(math.ceil(args.miners / 100), os.cpu_count() or 1)
+        simulation = Simulation(args.gateways, args.miners, args.overlap, args.sizes, args.copy_spread / 1000,
+                                args.keepalive, args.downlink_rate, miner_procs, args.middleman_args, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+
+    print(f"{args.gateways} gateways (overlap {args.overlap}), {args.miners} miners in {simulation.miner_procs} "
+          f"processes, {args.duration:g}s per stage, latencies in ms")
+    try:
+        simulation.start()
+        print(HEADER)
+        broke_at = None
+        for rate in rates:
+            result = simulation.run_stage(rate, args.duration, args.settle)
+            print(format_stage(result), flush=True)
+            if result['delivery'] * 100 < args.min_delivery:
+                broke_at = rate
+                break
+        if broke_at is None:
+            print(f"delivery stayed above {args.min_delivery:g}% up to {rates[-1]:g} transmissions/s")
+        else:
+            print(f"delivery fell below {args.min_delivery:g}% at {broke_at:g} transmissions/s")
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        simulation.stop()
+
+
+if __name__ == '__main__':
+    main()